@@ -0,0 +1,103 @@
+"""pileup sort benchmark.
+
+Compares the buffered pileup_sort with the previous implementation, that reopened the output file for every line.
+Both use the same sort, so the difference is the writing of the output.
+
+Usage:
+  pileup_sort_benchmark.py [--lines=<n>] [--work_dir=<dir>] [--gzip] [--seed=<seed>]
+  pileup_sort_benchmark.py (-h | --help)
+
+Options:
+  -h --help          Show this screen.
+  --lines=<n>        Number of lines of the generated pileup [default: 10000000].
+  --work_dir=<dir>   Directory of the generated pileup and the outputs [default: /tmp/].
+  --gzip             Also time pileup_sort with gzip output.
+  --seed=<seed>      Seed of the generated pileup [default: 0].
+
+"""
+import os
+import random
+import time
+from docopt import docopt
+from Utility.Pileup_class import Pileup_line
+from Utility.generators_utilities import key_sorted_gen, class_generator
+from Processing.pileup_sorting import pileup_sort, get_key_tuple_from_pileup
+
+
+def legacy_pileup_sort(in_pileup, out_pileup):
+    """
+    the previous pileup_sort, that opens the output in append mode for every sorted line
+    """
+    with open(in_pileup, "r") as file_pileup:
+        gen_pileup = class_generator(Pileup_line, file=file_pileup)
+        gen_sorted_pileup = key_sorted_gen(get_key_tuple_from_pileup, file=file_pileup, gen=gen_pileup)
+        open(out_pileup, "w").close()
+
+        for line in gen_sorted_pileup:
+            with open(out_pileup, "a+") as file1:
+                file1.write(line)
+
+
+def generate_pileup(filename, number_of_lines, seed=0):
+    """
+    writes an unsorted pileup of random sites
+    """
+    rand = random.Random(seed)
+    chromosomes = ["chr%s" % name for name in list(range(1, 23)) + ["X", "Y", "M"]]
+    with open(filename, "w") as fp:
+        batch = []
+        for _ in range(number_of_lines):
+            depth = rand.randint(1, 20)
+            reads = "".join(rand.choice("..,,..,,AcGt") for _ in range(depth))
+            batch.append("%s\t%d\t%s\t%d\t%s\t%s\n" % (rand.choice(chromosomes), rand.randint(1, 250000000),
+                                                      rand.choice("ACGT"), depth, reads, "I" * depth))
+            if len(batch) == 100000:
+                fp.writelines(batch)
+                batch = []
+        fp.writelines(batch)
+
+
+def timed(name, func, *args, **kwargs):
+    start = time.perf_counter()
+    func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    print("%-25s %10.2f sec" % (name, elapsed))
+    return elapsed
+
+
+def files_equal(first, second):
+    with open(first, "rb") as first_fp, open(second, "rb") as second_fp:
+        while True:
+            first_chunk = first_fp.read(1024 * 1024)
+            if first_chunk != second_fp.read(1024 * 1024):
+                return False
+            if not first_chunk:
+                return True
+
+
+def run_benchmark(number_of_lines, work_dir, with_gzip=False, seed=0):
+    in_pileup = os.path.join(work_dir, "pileup_sort_benchmark_input.pileup")
+    legacy_out = os.path.join(work_dir, "pileup_sort_benchmark_legacy.pileup")
+    buffered_out = os.path.join(work_dir, "pileup_sort_benchmark_buffered.pileup")
+    outputs = [in_pileup, legacy_out, buffered_out]
+
+    print("generating %d lines pileup" % number_of_lines)
+    generate_pileup(in_pileup, number_of_lines, seed)
+    try:
+        legacy_time = timed("legacy pileup_sort", legacy_pileup_sort, in_pileup, legacy_out)
+        buffered_time = timed("buffered pileup_sort", pileup_sort, in_pileup, buffered_out)
+        if with_gzip:
+            outputs.append(buffered_out + ".gz")
+            timed("buffered gzip pileup_sort", pileup_sort, in_pileup, buffered_out + ".gz")
+
+        print("speedup: %.2fx" % (legacy_time / buffered_time))
+        print("outputs are identical: %s" % files_equal(legacy_out, buffered_out))
+    finally:
+        for filename in outputs:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    run_benchmark(int(arguments['--lines']), arguments['--work_dir'], arguments['--gzip'], int(arguments['--seed']))
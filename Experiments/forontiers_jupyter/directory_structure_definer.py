@@ -48,6 +48,7 @@ class PileupStage(Enum):
     pileup=2
     sorted_pileup=3
     combined_sam=4 
+    coverage_summary=5
 
 class ConcensusStage(Enum):
     filtered=0
@@ -124,6 +125,8 @@ class DirectoryStructure():
                 name += '.bam'
             elif stage == Stages.pileup_generation and 'sam' in aux.name:
                 name += '.sam'
+            elif stage == Stages.pileup_generation and 'coverage' in aux.name:
+                name += '.bedgraph'
             else:
                 name += '.pileup'
 
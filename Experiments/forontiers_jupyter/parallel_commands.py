@@ -1,7 +1,31 @@
 import logging
 # from billiard.pool import Pool
-from multiprocessing.pool import ThreadPool
+import concurrent.futures
+import multiprocessing
+import pickle
+import time
 import traceback
+from collections import namedtuple
+
+# the executors of parallel_commands:
+# inline - the commands run one by one in the calling thread
+# thread - a pool of threads, for commands that wait on subprocesses or release the GIL
+# process - a pool of processes (forkserver, or spawn where forkserver is not available), for pure python cpu bound
+# commands. the commands are pickled, so their functions must be module level functions
+# spawn / forkserver - a process pool with that start method
+INLINE = "inline"
+THREAD = "thread"
+PROCESS = "process"
+EXECUTORS = (INLINE, THREAD, PROCESS, "spawn", "forkserver")
+
+# the result of a command: the name of its function, its arguments, its running time in seconds, and its exception
+# (None if it succeeded)
+CommandResult = namedtuple('CommandResult', ['name', 'args', 'seconds', 'error'])
+
+
+def command_name(f):
+	return getattr(f, "__qualname__", None) or getattr(f, "__name__", None) or repr(f)
+
 
 def apply(*command):
 	f=command[0]
@@ -19,21 +43,158 @@ def apply(*command):
 
 	return res
 
-# recives a list of Command class items
-def parallel_commands(list_commands,parallel_limit=2,Disable_parallel=True):
 
+def timed_apply(*command):
+	"""
+	apply that also measures the running time of the command
+	:return: (result of the command, running time in seconds)
+	"""
+	start = time.perf_counter()
+	res = apply(*command)
+	return res, time.perf_counter() - start
+
+
+def process_start_method(executor):
+	if executor in ("spawn", "forkserver"):
+		return executor
+	return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+
+class CommandExecutor:
+	"""
+	runs commands (a function and its arguments) on an inline, thread or process executor:
+
+	with CommandExecutor(PROCESS, parallel_limit=6) as executor:
+		result = executor.run([filter_no_change, pileup, filtered_pileup])
+	"""
+
+	def __init__(self, executor=THREAD, parallel_limit=2):
+		if executor not in EXECUTORS:
+			raise ValueError(f"unknown executor {executor}, expected one of {EXECUTORS}")
+		self.executor = executor
+		self.parallel_limit = parallel_limit
+		# the submitted futures that are not done, cancelled by shutdown(cancel=True)
+		self.pending = set()
+		if executor == INLINE:
+			self.pool = None
+		elif executor == THREAD:
+			self.pool = concurrent.futures.ThreadPoolExecutor(parallel_limit)
+		else:
+			self.pool = concurrent.futures.ProcessPoolExecutor(
+				parallel_limit, mp_context=multiprocessing.get_context(process_start_method(executor)))
+
+	@property
+	def is_process(self):
+		return self.executor not in (INLINE, THREAD)
+
+	def check_picklable(self, command):
+		"""
+		raises a TypeError if a command can't be sent to a process executor (e.g. its function is a nested function)
+		"""
+		if not self.is_process:
+			return
+		try:
+			pickle.dumps(tuple(command))
+		except (pickle.PicklingError, AttributeError, TypeError) as e:
+			raise TypeError(f"command {command_name(command[0])} can't be run by the {self.executor} executor, "
+							f"its function and arguments must be picklable (module level functions): {e}")
+
+	def submit(self, command):
+		"""
+		:return: a future of (result of the command, running time in seconds)
+		"""
+		command = tuple(command)
+		self.check_picklable(command)
+		if self.pool is not None:
+			future = self.pool.submit(timed_apply, *command)
+			self.pending.add(future)
+			future.add_done_callback(self.pending.discard)
+			return future
+		future = concurrent.futures.Future()
+		try:
+			future.set_result(timed_apply(*command))
+		except Exception as e:
+			future.set_exception(e)
+		return future
+
+	def run(self, command):
+		"""
+		runs a command and waits for it
+		:return: the result of the command
+		"""
+		return self.submit(command).result()[0]
+
+	def shutdown(self, cancel=False):
+		"""
+		waits for the running commands
+		:param cancel: cancel the submitted commands that didn't start
+		"""
+		if self.pool is not None:
+			# the futures are cancelled here rather than by shutdown(cancel_futures=...), which needs python 3.9
+			if cancel:
+				for future in list(self.pending):
+					future.cancel()
+			self.pool.shutdown(wait=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_val, exc_tb):
+		self.shutdown(cancel=exc_type is not None)
+
+
+# recives a list of Command class items
+def parallel_commands(list_commands,parallel_limit=2,Disable_parallel=True,executor=None):
+	"""
+	runs the commands, each a list of a function and its arguments
+	:param parallel_limit: cap on the number of commands running together
+	:param Disable_parallel: run the commands one by one (the inline executor), if executor is not given
+	:param executor: inline, thread (the default when Disable_parallel is False) or process (spawn / forkserver)
+	:return: list of CommandResult of the commands, in their order
+	:raise: the exception of the first command that failed (the first failure to happen), the commands that didn't
+	start are cancelled
+	"""
 	commands=[tuple(com) for com in list_commands]
+	if executor is None:
+		executor = INLINE if Disable_parallel else THREAD
 
-	if Disable_parallel:
+	with CommandExecutor(executor, parallel_limit) as command_executor:
+		# fail before running anything if a command can't be sent to the executor
 		for command in commands:
-			apply(*command)
+			command_executor.check_picklable(command)
 
-	else:
-		pool = ThreadPool(parallel_limit)
+		first_error = None
+		if command_executor.pool is None:
+			futures = []
+			for command in commands:
+				futures.append(command_executor.submit(command))
+				if futures[-1].exception() is not None:
+					first_error = futures[-1].exception()
+					break
+		else:
+			futures = [command_executor.submit(command) for command in commands]
+			# in the order the commands finish, so the error raised is of the first failure to happen
+			for future in concurrent.futures.as_completed(futures):
+				if not future.cancelled() and future.exception() is not None:
+					first_error = future.exception()
+					command_executor.shutdown(cancel=True)
+					break
 
-		pool.starmap(apply, commands)
+		results = []
+		for command, future in zip(commands, futures):
+			if future.cancelled():
+				continue
+			if future.exception() is not None:
+				results.append(CommandResult(command_name(command[0]), command[1:], None, future.exception()))
+			else:
+				results.append(CommandResult(command_name(command[0]), command[1:], future.result()[1], None))
 
-		pool.close()
-		pool.join()
+	for result in results:
+		if result.error is None:
+			logging.info(f" {result.name} took {result.seconds:.2f} seconds")
+	if first_error is not None:
+		logging.error(f" {sum(result.error is not None for result in results)} of {len(commands)} commands failed, "
+					  f"{len(commands) - len(results)} were cancelled")
+		raise first_error
 
-	return
\ No newline at end of file
+	return results
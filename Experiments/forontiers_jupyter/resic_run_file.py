@@ -4,7 +4,7 @@ import os
 from os import listdir
 from os.path import isfile, join, isdir
 import shutil
-from Processing.merge_sams import merge_sams
+from Processing.sam_to_pileup import sam_to_pileup as native_sam_to_pileup, coverage_summary_counts
 import Filtering.filter_ambiguous_reads as filter_read
 from Filtering.filter_pileup_for_unique_sites import write_unique_sites
 from Filtering.filter_hyper_non_relevant_sites import filter_hyper_non_relevant_editing_sites
@@ -15,9 +15,15 @@ import subprocess
 from functools import partial
 import Processing.include_exclude_alignment as in_ex_align
 import Processing.genome_3nt as genome_3nt
-from Processing.analyze_editing_percent import filter_pileup_by_categories, analyse_multiple_editing_percent_files
-from Processing.pileup_sorting import pileup_sort
-from Filtering.filter_pileup_by_multiple_existing_snps import snp_algebra, snp_detect, snp_algebra_from_vcf_file
+from Processing.analyze_editing_percent import filter_pileup_by_categories, analyse_multiple_editing_percent_files, \
+    analyse_editing_percent, \
+    filter_pileup_chain, any_change_stage, reads_threshold_stage, site_filter_stage, editing_percent_stage
+from Processing.pileup_sorting import pileup_sort, merge_sorted_pileups
+from Processing.reference_store import ReferenceStore
+from Filtering.filter_pileup_by_multiple_existing_snps import snp_algebra, snp_detect, snp_algebra_from_vcf_file, \
+    IndexedSitesFilter, negative_snp_index, snp_algebra_indexed
+from Utility.vcf_index import vcf_position_index
+from Utility.count_utils import write_site_count
 from Filtering.filter_pileup_by_consensus_site import filter_by_consensus
 from Experiments.forontiers_jupyter.site_loss_by_group_plot import site_loss_by_group_plot
 from Experiments.forontiers_jupyter.editing_type_count_by_group_plot import editing_type_count_by_group_plot
@@ -27,12 +33,13 @@ from Experiments.forontiers_jupyter.pipe_utils import all_genome_pair_combinatio
 from Experiments.forontiers_jupyter.directory_structure_definer import\
     DirectoryStructure, Stages, AlignStage, PileupStage, ConcensusStage, SiteLossStage, EditTypeStage
 from PIL import Image
-from Experiments.forontiers_jupyter.parallel_commands import parallel_commands
+from Experiments.forontiers_jupyter.parallel_commands import parallel_commands, apply, CommandExecutor, INLINE, THREAD
 from Experiments.forontiers_jupyter.aligner_wrapper import AlignerWrapper
 from Utility.multiline_sort import multiline_sort_pileup, multiline_sort
 from Utility.Pileup_class import Pileup_line
 from Utility.generators_utilities import class_generator
 from Utility.parallel_generator import parallel_generator
+from Utility.dag_scheduler import DagScheduler
 from random import randint
 from Experiments.forontiers_jupyter.editing_type_count_by_group_plot import editing_site_count_per_type
 
@@ -41,13 +48,146 @@ global_list_colors = ['#d12325', '#7C00BE', '#55E5D8', '#41C109', '#DEF407', '#9
                       '#ab6b5f', '#1eb1cf', '#1a48a7']
 
 
+def sam_to_pileup(sam_name, fasta_name, bam_name, sorted_bam_name, pileup_name, sorted_pileup_name):
+    # FLAG: updates this command:
+    # command=(   f"oldsamtools view -bS {sam_name} > {bam_name} && " +
+    #             f"oldsamtools sort {bam_name} {sorted_bam_name} && " +
+    #             f"oldsamtools mpileup -f {fasta_name} {sorted_bam_name}.bam > {pileup_name} &&" + #| tail -n +3
+    #             f"sed -r '/^[\t]*$/d' <{pileup_name} | sort -k1,1 -k2,2n -o {sorted_pileup_name} "
+    #             )
+    command = (f"samtools view -bS {sam_name} > {bam_name} && " +
+               f"samtools sort -o {sorted_bam_name} {bam_name} && " +
+               # | tail -n +3
+               # the C locale orders the chromosomes bytewise, like pileup_sort and the merges of sorted pileups
+               f"samtools mpileup -f {fasta_name} {sorted_bam_name} > {pileup_name} &&" +
+               f"sed -r '/^[\t]*$/d' <{pileup_name} | LC_ALL=C sort -k1,1 -k2,2n -o {sorted_pileup_name} "
+               )
+    try:
+        outout = subprocess.check_output(command, shell=True)
+    except subprocess.CalledProcessError as e:
+        logging.error(f"pileup conversions of {sam_name} failed")
+        raise e
+    #multiline_sort_pileup(1, '~~~', 1, pileup_name, 2, sorted_pileup_name)
+    return
+
+
+def sams_to_pileup(fasta_name, sam_name, bam_name, sorted_bam_name, pileup_name, sorted_pileup_name, antisense_sam):
+    """
+    piles up the sense and antisense sams of a node independently (in parallel) and merges their sorted pileups at
+    the site level (see pileup_sorting.merge_sorted_pileups), instead of merging and sorting the sams
+    """
+    strand_commands = []
+    for strand, strand_sam in (("sense", sam_name), ("antisense", antisense_sam)):
+        strand_commands.append([sam_to_pileup, strand_sam, fasta_name] +
+                               [f"{name}.{strand}" for name in (bam_name, sorted_bam_name, pileup_name,
+                                                                sorted_pileup_name)])
+    parallel_commands(strand_commands, parallel_limit=2, executor=THREAD)
+    strand_pileups = [command[-1] for command in strand_commands]
+    merge_sorted_pileups(strand_pileups, sorted_pileup_name)
+    for strand_pileup in strand_pileups:
+        os.remove(strand_pileup)
+    return
+
+
+def mismatch_pileup_creation(sam_names, fasta_name, no_change_pileup, coverage_summary, sorted_pileup_name,
+                             min_mismatches):
+    """
+    creates the no change pileup of the sams directly (see Processing.sam_to_pileup), the sites without changes are
+    only summarized in coverage_summary. the number of all the covered sites is written as the site count of the
+    sorted pileup (that is not written) and the number of the written sites as the site count of the no change pileup,
+    for the site loss plot
+    """
+    native_sam_to_pileup(sam_names, fasta_name, no_change_pileup, min_mismatches=min_mismatches,
+                         coverage_summary_file=coverage_summary)
+    covered_sites, emitted_sites = coverage_summary_counts(coverage_summary)
+    write_site_count(sorted_pileup_name, covered_sites)
+    write_site_count(no_change_pileup, emitted_sites)
+    return
+
+
+def filter_no_change(pileup, filtered_pileup):
+    filter_pileup_by_categories(
+        pileup, filtered_pileup, None, True, None, None)
+    return
+
+
+def filter_by_threshold(pileup, filtered_pileup, thresh):
+    filter_pileup_by_categories(
+        pileup, filtered_pileup, thresh, None, None, None)
+    return
+
+
+def filter_editperc(pileup, filtered_pileup, edit_min_thresh, edit_max_thresh, noise_thresh, editing_read_thresh):
+    filter_pileup_by_categories(pileup, filtered_pileup, None, None,
+                                edit_min_thresh, edit_max_thresh, noise_thresh, editing_read_thresh)
+    return
+
+
+def filter_chain(pileup, no_change_pileup, read_threshold_pileup, snp_removal_pileup, editing_percent_pileup,
+                 read_thresh, edit_min_thresh, edit_max_thresh, noise_thresh, editing_read_thresh,
+                 snp_index=None, snp_database=None, write_intermediate=True, pileup_has_changes=False):
+    """
+    the no change, read threshold, snp removal and editing percent filters (with the parameters of their stages in
+    PipeTester) in a single pass over the pileup
+    :param snp_index: the position index of the snp removal (see PipeTester.snp_index)
+    :param snp_database: the vcf of the snp removal, used (by its compiled index) if there is no snp_index
+    :param write_intermediate: if False the no change, read threshold and snp removal stages only write their counts
+    :param pileup_has_changes: True if pileup is the no change pileup (see mismatch_pileup_creation), the no change
+    stage then only tags the sites and writes their count
+    """
+    if snp_index is not None:
+        sites_filter = IndexedSitesFilter(snp_index)
+    else:
+        sites_filter = IndexedSitesFilter(vcf_position_index(snp_database))
+    with sites_filter:
+        filter_pileup_chain(pileup, [
+            any_change_stage(no_change_pileup, write=write_intermediate and not pileup_has_changes),
+            reads_threshold_stage(read_threshold_pileup, read_thresh, write=write_intermediate),
+            site_filter_stage(snp_removal_pileup, sites_filter, "snp_removal", write=write_intermediate),
+            editing_percent_stage(editing_percent_pileup, edit_min_thresh, edit_max_thresh, noise_thresh,
+                                  editing_read_thresh)])
+    return
+
+
+def run_command(command, command_executor=None):
+    """
+    runs a command of parallel_commands (a list of the function and its arguments), None is a skipped command
+    :param command_executor: optional CommandExecutor to run the command on, it runs in the calling thread if None
+    """
+    if command is None:
+        return None
+    if command_executor is not None:
+        return command_executor.run(command)
+    return apply(*command)
+
+
 class PipeTester():
     '''
     @param@ snp_database: list of file locations of snp database(s) in vcf format 
+    @param@ reference_store_dir: optional directory of a store of the derived references and their indexes,
+    shared by all the libraries and nodes (and by runs that use the same directory)
+    @param@ cpu_budget: number of cpus the alignment steps of a library may use together (default: all the cpus),
+    a step reserves the -p threads of its aligner flags
+    @param@ memory_budget, memory_hints: optional bytes of memory the alignment steps may use together, and a dict
+    of step id to the bytes of memory the step needs
+    @param@ snp_index_dir: directory of the cached snp indexes of the negative libraries and of the compiled snp
+    database (default: in root_dir)
+    @param@ executor: the executor of the stage commands (see parallel_commands): inline, thread or process.
+    default: inline if Disable_parallel, else thread. the filters are pure python, process runs them on parallel_limit
+    cores
+    @param@ pileup_engine: "samtools" (the default) creates the pileups with samtools view, sort and mpileup (and an
+    intermediate bam), "native" with Processing.sam_to_pileup straight from the sam files (opt in: no BAQ, no
+    overlapping mates correction and canonical reads strings, so its pileups are not identical to mpileup's)
+    @param@ min_pileup_mismatches: if positive (native engine only) the pileup creation writes the no change pileups
+    directly, with only the sites of at least min_pileup_mismatches mismatch reads (1 gives the sites of the no change
+    filter), and a coverage summary of the other sites instead of the sorted pileups. the no change filter is then
+    skipped, and the snp index of the negative libraries is built from their no change pileups
     '''
 
     def __init__(self, root_dir, positive_fastqs, negative_fastqs, fasta, graph_dict, spec_dict, group_dict, aligner,
-                 parallel_limit, Disable_parallel, skip_existing_files=False, snp_database=[]):
+                 parallel_limit, Disable_parallel, skip_existing_files=False, snp_database=[], reference_store_dir=None,
+                 cpu_budget=None, memory_budget=None, memory_hints=None, executor=None, snp_index_dir=None,
+                 pileup_engine="samtools", min_pileup_mismatches=0):
         self.root_dir = root_dir
         self.positive_fastqs = positive_fastqs
         self.negative_fastqs = negative_fastqs
@@ -60,6 +200,18 @@ class PipeTester():
         self.parallel_limit = parallel_limit
         self.Disable_parallel = Disable_parallel
         self.skip_existing_files = skip_existing_files
+        self.reference_store = ReferenceStore(reference_store_dir) if reference_store_dir is not None else None
+        self.cpu_budget = cpu_budget
+        self.memory_budget = memory_budget
+        self.memory_hints = memory_hints
+        self.executor = executor
+        self.snp_index_dir = snp_index_dir if snp_index_dir is not None else os.path.join(root_dir, "snp_index")
+        if pileup_engine not in ("native", "samtools"):
+            raise ValueError(f"unknown pileup engine {pileup_engine}")
+        self.pileup_engine = pileup_engine
+        if min_pileup_mismatches > 0 and pileup_engine != "native":
+            raise ValueError("mismatch only pileups are created by the native pileup engine")
+        self.min_pileup_mismatches = min_pileup_mismatches
         # create directory structure
         self.dirstruct = DirectoryStructure(root_dir)
 
@@ -86,7 +238,8 @@ class PipeTester():
 
             temp = os.path.join(root_dir, fastq_name + "2")
             shutil.copyfile(fastq, temp)
-            filter_read.extract_from_fastq(temp, fastq)
+            filter_read.extract_from_fastq(temp, fastq,
+                                           processes=1 if self.Disable_parallel else self.parallel_limit)
             os.remove(temp)
 
     def include_exclude_alignment_test(self):
@@ -101,315 +254,302 @@ class PipeTester():
         skip_existing_files = self.skip_existing_files
         aligner = self.aligner
 
-        for fastq in positive_fastqs + negative_fastqs:
-            in_ex_align.do_include_exclude_alignment(
-                fastq, reference_library, spec_dict, graph_dict, dirstruct, aligner, skip_existing_files)
+        # the graphs of all the libraries are scheduled together, as one DAG of (library, step) nodes
+        in_ex_align.do_include_exclude_alignment_libraries(
+            positive_fastqs + negative_fastqs, reference_library, spec_dict, graph_dict, dirstruct, aligner,
+            skip_existing_files, reference_store=self.reference_store, cpu_budget=self.cpu_budget,
+            memory_budget=self.memory_budget, memory_hints=self.memory_hints)
+
+    def pileup_creation_command(self, fastq, node):
+        """
+        :return: the pileup creation command of the library fastq and the graph node, None if it is skipped
+        """
+        dirstruct = self.dirstruct
+        sam_name = dirstruct.pathName(
+            fastq, node, Stages.graph_aligner, AlignStage.post_sam, True)
+        bam_name = dirstruct.pathName(
+            fastq, node, Stages.pileup_generation, PileupStage.bam, True)
+        sorted_bam_name = dirstruct.pathName(
+            fastq, node, Stages.pileup_generation, PileupStage.sorted_bam, True)
+        pileup_name = dirstruct.pathName(
+            fastq, node, Stages.pileup_generation, PileupStage.pileup, True)
+        sorted_pileup_name = dirstruct.pathName(
+            fastq, node, Stages.pileup_generation, PileupStage.sorted_pileup, True)
+        antisense_sam = dirstruct.pathName(
+            fastq, node, Stages.graph_aligner, AlignStage.antisense_post_sam, True)
+        fasta = self.fasta
+
+        created_pileup_name = sorted_pileup_name
+        if self.min_pileup_mismatches > 0:
+            created_pileup_name = dirstruct.pathName(fastq, node, Stages.no_change, need_suffix=True)
+
+        if self.skip_existing_files and os.path.isfile(created_pileup_name):
+            logging.info(f"SKIP pileup creation for file {sam_name} since {created_pileup_name} already exists")
+            return None
+        # FLAG: added check for cases where files were not created
+        # if node == "norep" or node == "rep":
+        if self.pileup_engine == "native":
+            # the sense and antisense sams of a node are counted together, without a combined sam
+            if os.path.isfile(sam_name) and (node == "norep" or node == "rep"):
+                sam_names = [sam_name]
+            elif (node != "norep" and node != "rep") and os.path.isfile(antisense_sam) and os.path.isfile(sam_name):
+                sam_names = [sam_name, antisense_sam]
+            else:
+                logging.info(f"SKIP pileup creation for file {sam_name}, file was not created")
+                return None
+            if self.min_pileup_mismatches > 0:
+                coverage_summary = dirstruct.pathName(
+                    fastq, node, Stages.pileup_generation, PileupStage.coverage_summary, True)
+                return [mismatch_pileup_creation, sam_names, fasta, created_pileup_name, coverage_summary,
+                        sorted_pileup_name, self.min_pileup_mismatches]
+            return [native_sam_to_pileup, sam_names, fasta, sorted_pileup_name]
+        if os.path.isfile(sam_name) and (node == "norep" or node == "rep"):
+            return [sam_to_pileup, sam_name, fasta, bam_name,
+                    sorted_bam_name, pileup_name, sorted_pileup_name]
+        if (node != "norep" and node != "rep") and os.path.isfile(antisense_sam) and os.path.isfile(sam_name):
+            return [sams_to_pileup, fasta, sam_name, bam_name, sorted_bam_name,
+                    pileup_name, sorted_pileup_name, antisense_sam]
+        logging.info(f"SKIP pileup creation for file {sam_name}, file was not created")
+        return None
 
     def pileup_creation_test(self):
+        commands = [self.pileup_creation_command(fastq, node)
+                    for fastq in self.positive_fastqs + self.negative_fastqs for node in self.graph_dict.keys()]
 
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        negative_fastqs = self.negative_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def filter_nochange_command(self, fastq, node):
+        """
+        :return: the no change filtering command of the library fastq and the graph node, None if it is skipped
+        """
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
+        pileup_name = dirstruct.pathName(
+            fastq, node, Stages.pileup_generation, PileupStage.sorted_pileup, True)
+        filtered_pileup_name = dirstruct.pathName(
+            fastq, node, Stages.no_change, need_suffix=True)
 
-        def sam_to_pileup(sam_name, fasta_name, bam_name, sorted_bam_name, pileup_name, sorted_pileup_name):
-            # FLAG: updates this command:
-            # command=(   f"oldsamtools view -bS {sam_name} > {bam_name} && " +
-            #             f"oldsamtools sort {bam_name} {sorted_bam_name} && " +
-            #             f"oldsamtools mpileup -f {fasta_name} {sorted_bam_name}.bam > {pileup_name} &&" + #| tail -n +3
-            #             f"sed -r '/^[\t]*$/d' <{pileup_name} | sort -k1,1 -k2,2n -o {sorted_pileup_name} "
-            #             )
-            command = (f"samtools view -bS {sam_name} > {bam_name} && " +
-                       f"samtools sort -o {sorted_bam_name} {bam_name} && " +
-                       # | tail -n +3
-                       f"samtools mpileup -f {fasta_name} {sorted_bam_name} > {pileup_name} &&" +
-                       f"sed -r '/^[\t]*$/d' <{pileup_name} | sort -k1,1 -k2,2n -o {sorted_pileup_name} "
-                       )
-            try:
-                outout = subprocess.check_output(command, shell=True)
-            except subprocess.CalledProcessError as e:
-                logging.error(f"pileup conversions of {sam_name} failed")
-                raise e
-            #multiline_sort_pileup(1, '~~~', 1, pileup_name, 2, sorted_pileup_name)
-            return
-
-        def sams_to_pileup(fasta_name, sam_name, bam_name, sorted_bam_name, pileup_name, sorted_pileup_name, antisense_sam, combined_sam_name):
-            merge_sams([sam_name, antisense_sam], combined_sam_name)
-            sam_to_pileup(combined_sam_name, fasta_name, bam_name,
-                          sorted_bam_name, pileup_name, sorted_pileup_name)
-            return
+        if self.min_pileup_mismatches > 0:
+            logging.info(f"SKIP pileup no change filtering for file {pileup_name}, {filtered_pileup_name} is written by the pileup creation")
+            return None
+        if self.skip_existing_files and os.path.isfile(filtered_pileup_name):
+            logging.info(f"SKIP pileup no change filtering for file {pileup_name} since {filtered_pileup_name} already exists")
+            return None
 
-        commands = []
-        for fastq in positive_fastqs+negative_fastqs:
-            for node in graph_dict.keys():
-                sam_name = dirstruct.pathName(
-                    fastq, node, Stages.graph_aligner, AlignStage.post_sam, True)
-                bam_name = dirstruct.pathName(
-                    fastq, node, Stages.pileup_generation, PileupStage.bam, True)
-                sorted_bam_name = dirstruct.pathName(
-                    fastq, node, Stages.pileup_generation, PileupStage.sorted_bam, True)
-                pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.pileup_generation, PileupStage.pileup, True)
-                sorted_pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.pileup_generation, PileupStage.sorted_pileup, True)
-                antisense_sam = dirstruct.pathName(
-                    fastq, node, Stages.graph_aligner, AlignStage.antisense_post_sam, True)
-                combined_sam_name = dirstruct.pathName(
-                    fastq, node, Stages.pileup_generation, PileupStage.combined_sam, True)
-                fasta = reference_library
-
-                if skip_existing_files and os.path.isfile(sorted_pileup_name):
-                    logging.info(f"SKIP pileup creation for file {sam_name} since {sorted_pileup_name} already exists")
-                    continue
-                # FLAG: added check for cases where files were not created
-                # if node == "norep" or node == "rep":
-                if os.path.isfile(sam_name) and (node == "norep" or node == "rep"):
-                    command = [sam_to_pileup, sam_name, fasta, bam_name,
-                               sorted_bam_name, pileup_name, sorted_pileup_name]
-                else:
-                    if (node != "norep" and node != "rep") and os.path.isfile(antisense_sam) and os.path.isfile(sam_name):
-                        command = [sams_to_pileup, fasta, sam_name, bam_name, sorted_bam_name,
-                                   pileup_name, sorted_pileup_name, antisense_sam, combined_sam_name]
-                    else:
-                        logging.info(f"SKIP pileup creation for file {sam_name}, file was not created")
-                        continue
-
-                commands.append(command)
+        # Todo I added this:
+        if not os.path.isfile(pileup_name):
+            logging.info(f"SKIP pileup no change filtering for file {pileup_name} since {pileup_name} was not created / does not exist")
+            return None
 
-        parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
+        return [filter_no_change, pileup_name, filtered_pileup_name]
 
     def filter_nochange_test(self):
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
-        dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
+        commands = [self.filter_nochange_command(fastq, node)
+                    for fastq in self.positive_fastqs for node in self.graph_dict.keys()]
 
-        def filter_no_change(pileup, filtered_pileup):
-            filter_pileup_by_categories(
-                pileup, filtered_pileup, None, True, None, None)
-            return
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
 
-        commands = []
-        for fastq in positive_fastqs:
-            for node in graph_dict.keys():
-                pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.pileup_generation, PileupStage.sorted_pileup, True)
-                filtered_pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.no_change, need_suffix=True)
-
-                if skip_existing_files and os.path.isfile(filtered_pileup_name):
-                    logging.info(f"SKIP pileup no change filtering for file {pileup_name} since {filtered_pileup_name} already exists")
-                    continue
-
-                # Todo I added this:
-                if not os.path.isfile(pileup_name):
-                    logging.info(f"SKIP pileup no change filtering for file {pileup_name} since {pileup_name} was not created / does not exist")
-                    continue
+    def filter_readthreshold_command(self, fastq, node, threshold=1):
+        """
+        :return: the read threshold filtering command of the library fastq and the graph node, None if it is skipped
+        """
+        dirstruct = self.dirstruct
+        pileup_name = dirstruct.pathName(
+            fastq, node, Stages.no_change, need_suffix=True)
+        filtered_pileup_name = dirstruct.pathName(
+            fastq, node, Stages.read_threshold, need_suffix=True)
 
-                command = [filter_no_change, pileup_name, filtered_pileup_name]
-                commands.append(command)
+        if self.skip_existing_files and os.path.isfile(filtered_pileup_name):
+            logging.info(f"SKIP pileup read threshold filtering for file {pileup_name} since {filtered_pileup_name} already exists")
+            return None
+        # FLAG: Added check for cases where files were not created
+        if not os.path.isfile(pileup_name):
+            logging.info(f"SKIP pileup read threshold filtering for file {pileup_name} since {pileup_name} does not exist / was not created")
+            return None
 
-        parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
+        return [filter_by_threshold, pileup_name, filtered_pileup_name, threshold]
 
     def filter_readthreshold_test(self, threshold=1):
+        commands = [self.filter_readthreshold_command(fastq, node, threshold)
+                    for fastq in self.positive_fastqs for node in self.graph_dict.keys()]
+
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def snp_index(self):
+        """
+        the position index of the snp removal, built once:
+        the compiled snp database (see Utility.vcf_index), cached while the vcf doesn't change, or
+        the snp positions of all the negative pileups (from all nodes), cached by the contents of the negatives
+        (see filter_pileup_by_multiple_existing_snps.negative_snp_index)
+        :return: the directory of the index
+        """
+        if self.snp_database != []:
+            index_dir = os.path.join(self.snp_index_dir, os.path.basename(self.snp_database[0]) + ".pidx")
+            return vcf_position_index(self.snp_database[0], index_dir).index_dir
 
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
+        # all negative pileups from all nodes
+        # FLAG: Added check that files were created
+        # (with mismatch only pileups the no change pileups, that hold the same changed sites)
+        if self.min_pileup_mismatches > 0:
+            negative_pileups = [self.dirstruct.pathName(neg, node, Stages.no_change)
+                                for neg in self.negative_fastqs for node in self.graph_dict.keys()]
+        else:
+            negative_pileups = [self.dirstruct.pathName(neg, node, Stages.pileup_generation, PileupStage.sorted_pileup)
+                                for neg in self.negative_fastqs for node in self.graph_dict.keys()]
+        negative_pileups = [pileup for pileup in negative_pileups if os.path.isfile(pileup)]
+        return negative_snp_index(negative_pileups, self.snp_index_dir, snp_detect)
+
+    def snp_removal_command(self, fastq, node, snp_index):
+        """
+        :param snp_index: the snp index (see snp_index), None to use the snp database
+        :return: the snp removal command of the library fastq and the graph node, None if it is skipped
+        """
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
-
-        def filter_by_threshold(pileup, filtered_pileup, thresh):
-            filter_pileup_by_categories(
-                pileup, filtered_pileup, thresh, None, None, None)
-            return
-
-        commands = []
-        for fastq in positive_fastqs:
-            for node in graph_dict.keys():
-                pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.no_change, need_suffix=True)
-                filtered_pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.read_threshold, need_suffix=True)
-
-                if skip_existing_files and os.path.isfile(filtered_pileup_name):
-                    logging.info(f"SKIP pileup read threshold filtering for file {pileup_name} since {filtered_pileup_name} already exists")
-                    continue
-                # FLAG: Added check for cases where files were not created
-                if not os.path.isfile(pileup_name):
-                    logging.info(f"SKIP pileup read threshold filtering for file {pileup_name} since {pileup_name} does not exist / was not created")
-                    continue
-
-                command = [filter_by_threshold, pileup_name,
-                           filtered_pileup_name, threshold]
-                commands.append(command)
+        pileup_name = dirstruct.pathName(
+            fastq, node, Stages.read_threshold, need_suffix=True)
+        filtered_pileup_name = dirstruct.pathName(
+            fastq, node, Stages.snp_removal, need_suffix=True)
+
+        if self.skip_existing_files and os.path.isfile(filtered_pileup_name):
+            logging.info(f"SKIP pileup snp removal filtering for file {pileup_name} since {filtered_pileup_name} already exists")
+            return None
+        # FLAG: Added check that files were created
+        if not os.path.isfile(pileup_name):
+            logging.info(f"SKIP pileup snp removal filtering for file {pileup_name} since {pileup_name} doesn't exist / was not created")
+            return None
 
-        parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
+        # the positions of the positive pileup are looked up in the snp index of the negatives or of the database
+        if snp_index is not None:
+            return [snp_algebra_indexed, pileup_name, snp_index, filtered_pileup_name]
+        return [snp_algebra_from_vcf_file, pileup_name,
+                self.snp_database[0], filtered_pileup_name, True]
 
     def snp_removal_test(self):
-
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        negative_fastqs = self.negative_fastqs
-        snp_database = self.snp_database
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
+        snp_index = self.snp_index()
+
+        commands = [self.snp_removal_command(fastq, node, snp_index)
+                    for fastq in self.positive_fastqs for node in self.graph_dict.keys()]
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def editing_percent_command(self, fastq, node, editing_min_threshold=30, editing_max_threshold=99,
+                                noise_threshold=3, editing_read_thresh=2):
+        """
+        :return: the editing percent filtering command of the library fastq and the graph node, None if it is skipped
+        """
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
-
-        # all negative pileups from all nodes
-        negative_pileups = [dirstruct.pathName(neg, node, Stages.pileup_generation, PileupStage.sorted_pileup)
-                            for neg in negative_fastqs for node in graph_dict.keys()]
-
-        # combine all negatives into single filtered negative, to save runtime in snp_removal
-        # parameters for parallel generator
+        pileup_name = dirstruct.pathName(
+            fastq, node, Stages.snp_removal, need_suffix=True)
+        filtered_pileup_name = dirstruct.pathName(
+            fastq, node, Stages.editing_percent, need_suffix=True)
+
+        if self.skip_existing_files and os.path.isfile(filtered_pileup_name):
+            logging.info(f"SKIP pileup editing percent filtering for file {pileup_name} since {filtered_pileup_name} already exists")
+            return None
         # FLAG: Added check that files were created
-        neg_obj_list = [open(p) for p in negative_pileups if os.path.isfile(p)]
-        neg_gen_list = []
-        def get_pos_and_id(x): return (x.reference_id, x.gene_pos)
-
-        not_snp_database = True
-        if snp_database != []:
-            not_snp_database = False
-
-        if not_snp_database:
-            # filter out bad lines from negatives
-            filtered_negatives = self.root_dir + "/" + "ALL_NEGATIVES_UNFILTERED.pileup"
-            for file_obj in neg_obj_list:
-                neg_gen_list.append(class_generator(
-                    Pileup_line, file=file_obj))
-            with open(filtered_negatives, 'w') as out:
-                parallel_gen = parallel_generator(
-                    neg_gen_list, [get_pos_and_id for i in range(len(neg_gen_list))])
-                for parallel_line_list in parallel_gen:
-                    snp = False
-                    for pileup_list in parallel_line_list:
-                        if pileup_list is not None:
-                            if pileup_list[0].is_with_any_change():
-                                snp = True
-
-                                break
-                    if not snp:
-                        line_to_write = next(
-                            item for item in parallel_line_list if item is not None)
-                        out.write(str(line_to_write[0]) + "\n")
-            for obj in neg_obj_list:
-                obj.close()
-            # TODO: maybe move the above code to a different function
+        if not os.path.isfile(pileup_name):
+            logging.info(f"SKIP pileup editing percent filtering for file {pileup_name} since {pileup_name} does not exist / was not created")
+            return None
 
-        commands = []
-        for fastq in positive_fastqs:
-            for node in graph_dict.keys():
-                pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.read_threshold, need_suffix=True)
-                filtered_pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.snp_removal, need_suffix=True)
-
-                if skip_existing_files and os.path.isfile(filtered_pileup_name):
-                    logging.info(f"SKIP pileup snp removal filtering for file {pileup_name} since {filtered_pileup_name} already exists")
-                    continue
-                # FLAG: Added check that files were created
-                if not os.path.isfile(pileup_name):
-                    logging.info(f"SKIP pileup snp removal filtering for file {pileup_name} since {pileup_name} doesn't exist / was not created")
-                    continue
-
-                # snp algebre interface is (pos,neg_list,snp_detector_func,out_put_name,is_input_sorted,not_snp_database)
-                if not_snp_database:
-                    command = [snp_algebra, pileup_name, [
-                        filtered_negatives], snp_detect, filtered_pileup_name, True, False]
-                else:
-                    command = [snp_algebra_from_vcf_file, pileup_name,
-                               snp_database[0], filtered_pileup_name, True]
-                commands.append(command)
-        parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
-
-        # snp algebre interface is (pos,neg_list,snp_detector_func,out_put_name,is_input_sorted)
+        return [filter_editperc, pileup_name, filtered_pileup_name,
+                editing_min_threshold, editing_max_threshold, noise_threshold, editing_read_thresh]
 
     def editing_percent_test(self, editing_min_threshold=30, editing_max_threshold=99, noise_threshold=3, editing_read_thresh=2):
-
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
+        commands = [self.editing_percent_command(fastq, node, editing_min_threshold, editing_max_threshold,
+                                                 noise_threshold, editing_read_thresh)
+                    for fastq in self.positive_fastqs for node in self.graph_dict.keys()]
+
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def editing_percent_files(self, fastq, nodes, log_name):
+        """
+        :return: the existing editing percent pileups of the library fastq and the nodes
+        """
+        pileups = []
+        for node in nodes:
+            # FLAG: Added check that files were created
+            pileup_name = self.dirstruct.pathName(fastq, node, Stages.editing_percent, need_suffix=True)
+            if os.path.isfile(pileup_name):
+                pileups.append(pileup_name)
+            else:
+                logging.info(f"SKIP pileup {log_name} filtering for file {pileup_name} since this file does not exist / was not created")
+        return pileups
+
+    def filter_chain_command(self, fastq, node, snp_index, threshold=2, editing_min_threshold=30,
+                             editing_max_threshold=99, noise_threshold=3, editing_read_thresh=2,
+                             write_intermediate=True):
+        """
+        :param snp_index: the snp index (see snp_index), None to use the snp database
+        :return: the command of the filters from no change to editing percent of the library fastq and the graph node
+        in a single pass (see filter_chain), None if it is skipped
+        """
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
-
-        def filter_editperc(pileup, filtered_pileup, edit_min_thresh, edit_max_thresh, noise_thresh):
-            filter_pileup_by_categories(pileup, filtered_pileup, None, None,
-                                        edit_min_thresh, edit_max_thresh, noise_thresh, editing_read_thresh)
-            return
-
-        commands = []
-        for fastq in positive_fastqs:
-            for node in graph_dict.keys():
-                pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.snp_removal, need_suffix=True)
-                filtered_pileup_name = dirstruct.pathName(
-                    fastq, node, Stages.editing_percent, need_suffix=True)
-
-                if skip_existing_files and os.path.isfile(filtered_pileup_name):
-                    logging.info(f"SKIP pileup editing percent filtering for file {pileup_name} since {filtered_pileup_name} already exists")
-                    continue
-                # FLAG: Added check that files were created
-                if not os.path.isfile(pileup_name):
-                    logging.info(f"SKIP pileup editing percent filtering for file {pileup_name} since {pileup_name} does not exist / was not created")
-                    continue
-
-                command = [filter_editperc, pileup_name, filtered_pileup_name,
-                           editing_min_threshold, editing_max_threshold, noise_threshold]
-                commands.append(command)
-
-        parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
+        pileup_name = dirstruct.pathName(
+            fastq, node, Stages.pileup_generation, PileupStage.sorted_pileup, True)
+        outputs = [dirstruct.pathName(fastq, node, stage, need_suffix=True)
+                   for stage in (Stages.no_change, Stages.read_threshold, Stages.snp_removal, Stages.editing_percent)]
+        # mismatch only pileups are created as the no change pileups
+        pileup_has_changes = self.min_pileup_mismatches > 0
+        if pileup_has_changes:
+            pileup_name = outputs[0]
+
+        if self.skip_existing_files and os.path.isfile(outputs[-1]):
+            logging.info(f"SKIP pileup filter chain for file {pileup_name} since {outputs[-1]} already exists")
+            return None
+        if not os.path.isfile(pileup_name):
+            logging.info(f"SKIP pileup filter chain for file {pileup_name} since {pileup_name} was not created / does not exist")
+            return None
+
+        snp_database = self.snp_database[0] if snp_index is None else None
+        return [filter_chain, pileup_name, *outputs, threshold, editing_min_threshold, editing_max_threshold,
+                noise_threshold, editing_read_thresh, snp_index, snp_database, write_intermediate, pileup_has_changes]
+
+    def filter_chain_test(self, threshold=2, editing_min_threshold=30, editing_max_threshold=99, noise_threshold=3,
+                          editing_read_thresh=2, write_intermediate=True):
+        """
+        filter_nochange_test, filter_readthreshold_test, snp_removal_test and editing_percent_test in a single pass
+        over each pileup
+        :param write_intermediate: if False only the counts of the no change, read threshold and snp removal stages are
+        written (enough for the site loss plot)
+        """
+        snp_index = self.snp_index()
+
+        commands = [self.filter_chain_command(fastq, node, snp_index, threshold, editing_min_threshold,
+                                              editing_max_threshold, noise_threshold, editing_read_thresh,
+                                              write_intermediate)
+                    for fastq in self.positive_fastqs for node in self.graph_dict.keys()]
+
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def hyper_non_relevant_command(self, fastq, node):
+        """
+        :return: the hyper non relevant sites filtering command of the library fastq and the graph node
+        """
+        return [filter_hyper_non_relevant_editing_sites,
+                self.editing_percent_files(fastq, [node], "hyper non-relevant")]
 
     def hyper_non_relevant_editing_site_test(self):
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
-        dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
-
         all_pileup_files_from_last_stage = []
-        for fastq in positive_fastqs:
-            for node in graph_dict.keys():
-                # FLAG: Added check that files were created
-                if os.path.isfile(dirstruct.pathName(fastq, node, Stages.editing_percent, need_suffix=True)):
-                    all_pileup_files_from_last_stage.append(dirstruct.pathName(
-                        fastq, node, Stages.editing_percent, need_suffix=True))
-                else:
-                    logging.info(f"SKIP pileup hyper non-relevant filtering for file {dirstruct.pathName(fastq,node,Stages.editing_percent,need_suffix=True)} since this file does not exist / was not created")
+        for fastq in self.positive_fastqs:
+            all_pileup_files_from_last_stage += self.editing_percent_files(fastq, self.graph_dict.keys(),
+                                                                           "hyper non-relevant")
 
         filter_hyper_non_relevant_editing_sites(
             all_pileup_files_from_last_stage)
 
-    def unique_site_test(self):
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
-        dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
+    def unique_site_command(self, fastq):
+        """
+        :return: the unique sites command of the library fastq (over all the graph nodes)
+        """
+        return [write_unique_sites, self.editing_percent_files(fastq, self.graph_dict.keys(), "unique site test"), True]
 
-        commands = []
-        for fastq in positive_fastqs:
-            pileup_files_from_all_nodes = []
-            for node in graph_dict.keys():
-                if os.path.isfile(dirstruct.pathName(fastq, node, Stages.editing_percent, need_suffix=True)):
-                    pileup_files_from_all_nodes.append(dirstruct.pathName(
-                        fastq, node, Stages.editing_percent, need_suffix=True))
-                else:
-                    logging.info(f"SKIP pileup unique site test filtering for file {dirstruct.pathName(fastq,node,Stages.editing_percent,need_suffix=True)} since this file does not exist / was not created")
+    def unique_site_test(self):
+        for fastq in self.positive_fastqs:
+            pileup_files_from_all_nodes = self.editing_percent_files(fastq, self.graph_dict.keys(), "unique site test")
 
             write_unique_sites(pileup_files_from_all_nodes, sorted_input=True)
 
@@ -418,92 +558,99 @@ class PipeTester():
 
         # parallel_commands(commands,parallel_limit=self.parallel_limit,Disable_parallel=self.Disable_paralle
 
-    def concensus_test(self, consensus_threshold=0.5):
-
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
+    def concensus_command(self, node, consensus_threshold=0.5):
+        """
+        :return: the consensus filtering command of the graph node over all the libraries, None if it is skipped
+        """
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
+        positive_fastqs = self.positive_fastqs
+        # the filtered output of each existing pileup is the one of its library
+        fastqs = [fastq for fastq in positive_fastqs
+                  if os.path.isfile(dirstruct.pathName(fastq, node, Stages.editing_percent_unique))]
+        pileups = [dirstruct.pathName(fastq, node, Stages.editing_percent_unique) for fastq in fastqs]
+        filtered_pileups = [dirstruct.pathName(
+            fastq, node, Stages.concensus, ConcensusStage.filtered) for fastq in fastqs]
+        concensus_pileup = dirstruct.pathName(
+            None, node, Stages.concensus, ConcensusStage.concensus)
+
+        if self.skip_existing_files and \
+                all([os.path.isfile(file) for file in filtered_pileups+[concensus_pileup]]):
+
+            logging.info(
+                f"SKIP pileup concensus filtering for file {node} since {filtered_pileups + [concensus_pileup]} already exists")
+            return None
+
+        # format for filter by concensus is (in_pileups,thresh,out_pileups,concensus_pileup,is_sorted)
+        return [filter_by_consensus, pileups, consensus_threshold,
+                filtered_pileups, concensus_pileup, True]
 
-        commands = []
-        for node in graph_dict.keys():
-            pileups = [dirstruct.pathName(fastq, node, Stages.editing_percent_unique) for fastq in positive_fastqs if os.path.isfile(
-                dirstruct.pathName(fastq, node, Stages.editing_percent_unique))]
-            filtered_pileups = [dirstruct.pathName(
-                fastq, node, Stages.concensus, ConcensusStage.filtered) for fastq in positive_fastqs]
-            concensus_pileup = dirstruct.pathName(
-                None, node, Stages.concensus, ConcensusStage.concensus)
-
-            if skip_existing_files and \
-                    all([os.path.isfile(file) for file in filtered_pileups+[concensus_pileup]]):
-
-                logging.info(
-                    f"SKIP pileup concensus filtering for file {node} since {filtered_pileups + [concensus_pileup]} already exists")
-                continue
-
-            # format for filter by concensus is (in_pileups,thresh,out_pileups,concensus_pileup,is_sorted)
-            command = [filter_by_consensus, pileups, consensus_threshold,
-                       filtered_pileups, concensus_pileup, True]
-            commands.append(command)
+    def concensus_test(self, consensus_threshold=0.5):
+        commands = [self.concensus_command(node, consensus_threshold) for node in self.graph_dict.keys()]
 
-        parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
+        parallel_commands([command for command in commands if command is not None],
+                          parallel_limit=self.parallel_limit, Disable_parallel=self.Disable_parallel, executor=self.executor)
 
-    def site_loss_plot_test(self):
-
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
-        dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
-        group_dict = self.group_dict
+    def site_loss_plot_command(self, fastq, dict_colors=None):
+        """
+        :return: the site loss plot command of the library fastq
+        """
+        if dict_colors is None:
+            dict_colors = calculate_dictinary_colors_for_site_loss()
+        return [site_loss_by_group_plot, fastq,
+                list(self.graph_dict.keys()), self.group_dict, self.dirstruct, dict_colors]
 
+    def site_loss_plot_test(self):
         dict_colors = calculate_dictinary_colors_for_site_loss()
 
-        commands = []
-        node_names = list(graph_dict.keys())
-        for fastq in positive_fastqs:
-            command = [site_loss_by_group_plot, fastq,
-                       node_names, group_dict, dirstruct, dict_colors]
-            commands.append(command)
+        commands = [self.site_loss_plot_command(fastq, dict_colors) for fastq in self.positive_fastqs]
 
         parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
-
-    def editing_percent_plot_generate_summaries(self, editing_min_thresh=0, editing_max_thresh=100, noise_thresh=1, read_thresh=2):
+                          Disable_parallel=self.Disable_parallel, executor=self.executor)
 
-        reference_library = self.fasta
-        positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
+    def editing_percent_summaries(self, pairs, editing_min_thresh=0, editing_max_thresh=100, noise_thresh=1, read_thresh=2):
+        """
+        calculate editing percent and editing site distribution summary of (node, fastq) pairs
+        """
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
-        group_dict = self.group_dict
-
-        nodes = list(graph_dict.keys())
-        # calculate editing percent and editing site distribution summary for each lib and node
-        in_pileups = [dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered) for node, fastq
-                      in itertools.product(nodes, positive_fastqs) if os.path.isfile(dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered))]
-        out_pileups = [dirstruct.pathName(fastq, node, Stages.editing_type_count, EditTypeStage.edit_percent_pileup) for node, fastq
-                       in itertools.product(nodes, positive_fastqs) if os.path.isfile(dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered))]
-        out_summaries = [dirstruct.pathName(fastq, node, Stages.editing_type_count, EditTypeStage.file_summary) for node, fastq
-                         in itertools.product(nodes, positive_fastqs) if os.path.isfile(dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered))]
+        pairs = [(node, fastq) for node, fastq in pairs
+                 if os.path.isfile(dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered))]
+        in_pileups = [dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered) for node, fastq in pairs]
+        out_pileups = [dirstruct.pathName(fastq, node, Stages.editing_type_count, EditTypeStage.edit_percent_pileup)
+                       for node, fastq in pairs]
+        out_summaries = [dirstruct.pathName(fastq, node, Stages.editing_type_count, EditTypeStage.file_summary)
+                         for node, fastq in pairs]
 
         analyse_multiple_editing_percent_files(in_pileups, out_pileups, out_summaries, total_summary_file=None,
                                                add_headers=True, summary_only=False, min_editing=editing_min_thresh, max_editing=editing_max_thresh,
                                                max_noise=noise_thresh, min_reads=read_thresh, edit_tag='edited', parallel_limit=self.parallel_limit,
-                                               Disable_parallel=self.Disable_parallel)
+                                               Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def editing_percent_summary_command(self, fastq, node, editing_min_thresh=0, editing_max_thresh=100, noise_thresh=1,
+                                        read_thresh=2):
+        """
+        :return: the editing percent and editing site distribution summary command of the (node, fastq) pair
+        (as in editing_percent_summaries), None if the pair has no consensus filtered pileup
+        """
+        dirstruct = self.dirstruct
+        in_pileup = dirstruct.pathName(fastq, node, Stages.concensus, ConcensusStage.filtered)
+        if not os.path.isfile(in_pileup):
+            return None
+        out_pileup = dirstruct.pathName(fastq, node, Stages.editing_type_count, EditTypeStage.edit_percent_pileup)
+        out_summary = dirstruct.pathName(fastq, node, Stages.editing_type_count, EditTypeStage.file_summary)
+
+        # the arguments of analyse_multiple_editing_percent_files in editing_percent_summaries
+        return [analyse_editing_percent, in_pileup, out_pileup, out_summary, True, False, editing_min_thresh,
+                noise_thresh, read_thresh, 'edited']
+
+    def editing_percent_plot_generate_summaries(self, editing_min_thresh=0, editing_max_thresh=100, noise_thresh=1, read_thresh=2):
+        nodes = list(self.graph_dict.keys())
+        # calculate editing percent and editing site distribution summary for each lib and node
+        self.editing_percent_summaries(itertools.product(nodes, self.positive_fastqs), editing_min_thresh,
+                                       editing_max_thresh, noise_thresh, read_thresh)
 
     def editing_percent_plot_generate_plot(self):
-        reference_library = self.fasta
         positive_fastqs = self.positive_fastqs
-        spec_dict = self.spec_dict
-        graph_dict = self.graph_dict
         dirstruct = self.dirstruct
-        skip_existing_files = self.skip_existing_files
         group_dict = self.group_dict
 
         dict_colors = calculate_dictinary_colors_for_editing_percent(
@@ -518,7 +665,88 @@ class PipeTester():
             commands.append(command)
 
         parallel_commands(commands, parallel_limit=self.parallel_limit,
-                          Disable_parallel=self.Disable_parallel)
+                          Disable_parallel=self.Disable_parallel, executor=self.executor)
+
+    def pipelined_test(self, read_threshold=2, editing_min_threshold=30, editing_max_threshold=99, noise_threshold=3,
+                       editing_read_thresh=2, consensus_threshold=0.5, summary_editing_min_thresh=30,
+                       summary_editing_max_thresh=99, summary_noise_thresh=3, summary_read_thresh=2,
+                       write_intermediate_pileups=True):
+        """
+        runs the stages from pileup_creation_test to editing_percent_plot_generate_plot (with the same
+        parameters) as one dependency graph instead of stage after stage: every (library, node) chain moves to its
+        next stage as soon as its own previous stage is done.
+        only the stages that combine libraries or nodes wait for all their inputs: the snp index of the negative
+        pileups (for snp removal), the unique sites of a library (all its nodes), the consensus of a node (all the
+        libraries), and the plots.
+        at most parallel_limit stages run together (one if Disable_parallel).
+        the filters from no change to editing percent run in a single pass over each pileup (see filter_chain_test),
+        with write_intermediate_pileups False only the counts of their intermediate stages are written
+        """
+        positive_fastqs = self.positive_fastqs
+        negative_fastqs = self.negative_fastqs
+        nodes = list(self.graph_dict.keys())
+        scheduler = DagScheduler(cpu_budget=1 if self.Disable_parallel else self.parallel_limit)
+        negatives = dict()
+        # the stages run in the threads of the scheduler, with a process executor their commands are sent to a pool
+        # of parallel_limit processes
+        command_executor = None
+        if self.executor not in (None, INLINE, THREAD):
+            command_executor = CommandExecutor(self.executor, self.parallel_limit)
+
+        def add_stage(stage_id, dependencies, function, *args):
+            scheduler.add_node(stage_id, lambda cpus: function(*args), dependencies=dependencies)
+
+        def add_command(stage_id, dependencies, build_command, *args):
+            # the command is built when the stage starts, after the files of its dependencies were written
+            add_stage(stage_id, dependencies, lambda: run_command(build_command(*args), command_executor))
+
+        def build_snp_index():
+            negatives["snp_index"] = self.snp_index()
+
+        def filter_chain_command(fastq, node):
+            return self.filter_chain_command(fastq, node, negatives["snp_index"], read_threshold, editing_min_threshold,
+                                             editing_max_threshold, noise_threshold, editing_read_thresh,
+                                             write_intermediate_pileups)
+
+        for fastq in positive_fastqs + negative_fastqs:
+            for node in nodes:
+                add_command(("pileup", fastq, node), [], self.pileup_creation_command, fastq, node)
+        add_stage(("negatives",), [("pileup", neg, node) for neg in negative_fastqs for node in nodes],
+                  build_snp_index)
+
+        for fastq in positive_fastqs:
+            for node in nodes:
+                # the filters from no change to editing percent in a single pass over the pileup
+                add_command(("filter_chain", fastq, node), [("pileup", fastq, node), ("negatives",)],
+                            filter_chain_command, fastq, node)
+                add_command(("hyper_non_relevant", fastq, node), [("filter_chain", fastq, node)],
+                            self.hyper_non_relevant_command, fastq, node)
+            add_command(("unique", fastq), [("hyper_non_relevant", fastq, node) for node in nodes],
+                        self.unique_site_command, fastq)
+
+        for node in nodes:
+            add_command(("concensus", node), [("unique", fastq) for fastq in positive_fastqs],
+                        self.concensus_command, node, consensus_threshold)
+            for fastq in positive_fastqs:
+                # a single command on the shared executor, not a parallel_commands pool of its own
+                add_command(("summary", fastq, node), [("concensus", node)], self.editing_percent_summary_command,
+                            fastq, node, summary_editing_min_thresh, summary_editing_max_thresh,
+                            summary_noise_thresh, summary_read_thresh)
+
+        site_loss_colors = calculate_dictinary_colors_for_site_loss()
+        for fastq in positive_fastqs:
+            add_command(("site_loss_plot", fastq), [("concensus", node) for node in nodes],
+                        self.site_loss_plot_command, fastq, site_loss_colors)
+        add_stage(("editing_percent_plot",), [("summary", fastq, node) for fastq in positive_fastqs for node in nodes],
+                  self.editing_percent_plot_generate_plot)
+
+        # the longest chains of stages start first
+        scheduler.prioritize_critical_path()
+        try:
+            scheduler.run()
+        finally:
+            if command_executor is not None:
+                command_executor.shutdown(cancel=True)
 
 
 def Resic_graph_config(bowtie_parrallel=1):
@@ -663,12 +891,15 @@ def real_pipe():
     # these can be DNA reads or mutant strains that are lacking the editing mechanism.
     negative_fastqs = []
 
-    # Optional - a dbSNP vcf file, currently WITH NO HEADERS, to exclude SNPs.
+    # Optional - a dbSNP vcf file (plain or .gz, compiled once into a position index), to exclude SNPs.
     # remove all lines that start with #
     snp_database = []
 
     # Note: currently we support using either a snp database or negative files and not both at once.
 
+    # Optional - a directory in which the 3nt references and their indexes are built once and reused by later runs.
+    reference_store_dir = None
+
     if not os.path.exists(root_dir):
         os.makedirs(root_dir)
 
@@ -697,7 +928,8 @@ def real_pipe():
 
     test_pipe = PipeTester(root_dir, positive_fastqs, negative_fastqs, reference_library,
                            graph_dict, spec_dict, group_dict, aligner, parallel_limit=6, Disable_parallel=False,
-                           skip_existing_files=True, snp_database=snp_database)
+                           skip_existing_files=True, snp_database=snp_database,
+                           reference_store_dir=reference_store_dir)
 
     """
     You can comment function that you want to skip. All functions together creats RECIC
@@ -709,29 +941,36 @@ def real_pipe():
 
     test_pipe.include_exclude_alignment_test()
 
-    test_pipe.pileup_creation_test()
+    # the stages from the pileup creation to the plots, every library and node moves to its next stage as soon as
+    # its previous stage is done (the thresholds are those of the stage by stage calls below)
+    test_pipe.pipelined_test(read_threshold=2, editing_min_threshold=30, editing_max_threshold=99, noise_threshold=3,
+                             editing_read_thresh=2, consensus_threshold=0.5, summary_editing_min_thresh=30,
+                             summary_editing_max_thresh=99, summary_noise_thresh=3, summary_read_thresh=2)
 
-    test_pipe.filter_nochange_test()
+    # or stage by stage, to skip some of the stages:
+    # test_pipe.pileup_creation_test()
 
-    test_pipe.filter_readthreshold_test(threshold=2)
+    # test_pipe.filter_nochange_test()
 
-    test_pipe.snp_removal_test()
+    # test_pipe.filter_readthreshold_test(threshold=2)
 
-    test_pipe.editing_percent_test(
-        editing_min_threshold=30, editing_max_threshold=99, noise_threshold=3, editing_read_thresh=2)
+    # test_pipe.snp_removal_test()
 
-    test_pipe.hyper_non_relevant_editing_site_test()
+    # test_pipe.editing_percent_test(
+    #     editing_min_threshold=30, editing_max_threshold=99, noise_threshold=3, editing_read_thresh=2)
 
-    test_pipe.unique_site_test()
+    # test_pipe.hyper_non_relevant_editing_site_test()
 
-    test_pipe.concensus_test(consensus_threshold=0.5)
+    # test_pipe.unique_site_test()
 
-    test_pipe.site_loss_plot_test()
+    # test_pipe.concensus_test(consensus_threshold=0.5)
 
-    test_pipe.editing_percent_plot_generate_summaries(
-        editing_min_thresh=30, editing_max_thresh=99, noise_thresh=3, read_thresh=2)
+    # test_pipe.site_loss_plot_test()
 
-    test_pipe.editing_percent_plot_generate_plot()
+    # test_pipe.editing_percent_plot_generate_summaries(
+    #     editing_min_thresh=30, editing_max_thresh=99, noise_thresh=3, read_thresh=2)
+
+    # test_pipe.editing_percent_plot_generate_plot()
 
 
 if __name__ == '__main__':
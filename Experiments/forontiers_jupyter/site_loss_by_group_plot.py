@@ -27,7 +27,7 @@ from Utility.generators_utilities import getLineFromChunk
 import pandas as pd
 import itertools
 import logging
-from Utility.count_utils import  column_delta_df,get_line_count
+from Utility.count_utils import  column_delta_df,get_site_count
 from Experiments.forontiers_jupyter.directory_structure_definer import DirectoryStructure,Stages \
     ,AlignStage,PileupStage,ConcensusStage,SiteLossStage
 
@@ -132,7 +132,7 @@ def site_loss_by_group_plot(lib_name,node_names,group_dict,dirstruct:DirectorySt
     # mapping betweeen node,stage,aux and line count
     line_count_dict={}
     for key,file_name in file_names_dict.items():
-        line_count_dict[key]=get_line_count(file_name)
+        line_count_dict[key]=get_site_count(file_name)
 
     # mapping between group_name,stage,aux to total line count of the group
     group_line_count_dict={}
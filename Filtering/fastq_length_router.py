@@ -0,0 +1,104 @@
+"""Fastq length router
+
+routes the records of a fastq library to length bins in a single pass: every record is written to each bin whose
+length range holds the length of its sequence, or to the reject output if there is none. The records keep their
+input order in every bin, also when chunks of the library are routed in parallel.
+
+Usage:
+  fastq_length_router.py <fastq_filename> (--bin=<name:min:max>)... [--reject=<file>] [--report=<file>] [--processes=<n>]
+  fastq_length_router.py -h | --help
+
+Options:
+  -h --help              Show this screen.
+  --bin=<name:min:max>   A bin of the sequences of min to max nt (inclusive), written to <fastq name>.<name>.fastq
+  --reject=<file>        File of the records that are in no bin.
+  --report=<file>        Json file of the counts of the bins and the length histogram.
+  --processes=<n>        Number of processes routing chunks of the library [default: 1].
+
+"""
+import functools
+import json
+from collections import namedtuple
+import numpy as np
+from docopt import docopt
+from Processing.genome_3nt import transformed_chunks
+
+# min_length and max_length are inclusive
+LengthBin = namedtuple('LengthBin', ['name', 'min_length', 'max_length', 'output'])
+
+WRITE_BUFFER_SIZE = 4 * 1024 * 1024
+
+
+def _route_lines(bins, lines):
+	"""
+	:param bins: list of (min_length, max_length) of the bins
+	:param lines: lines of whole fastq records (bytes)
+	:return: (the records of every bin (bytes), the rejected records (bytes), histogram of the sequence lengths)
+	"""
+	if len(lines) % 4:
+		raise ValueError("the fastq ends with a truncated record")
+	records = [b''.join(lines[index:index + 4]) for index in range(0, len(lines), 4)]
+	lengths = np.fromiter((len(line.rstrip()) for line in lines[1::4]), dtype=np.int64, count=len(records))
+	in_any_bin = np.zeros(len(records), dtype=bool)
+	routed = []
+	for min_length, max_length in bins:
+		in_bin = (lengths >= min_length) & (lengths <= max_length)
+		in_any_bin |= in_bin
+		routed.append(b''.join(records[index] for index in np.flatnonzero(in_bin).tolist()))
+	rejected = b''.join(records[index] for index in np.flatnonzero(~in_any_bin).tolist())
+	return routed, rejected, np.bincount(lengths)
+
+
+def route_fastq_by_length(fastq_filename, bins, reject_output=None, processes=1, report_output=None):
+	"""
+	:param fastq_filename: the fastq library
+	:param bins: list of LengthBin (bins may overlap, a record is written to all of its bins)
+	:param reject_output: file of the records that are in no bin, None to drop them
+	:param processes: number of processes routing chunks of the library in parallel
+	:param report_output: optional json file of the returned report
+	:return: report dict - {"bins": {name: number of records}, "rejected": number of records,
+	"histogram": {sequence length: number of records}}
+	"""
+	transform = functools.partial(_route_lines, [(length_bin.min_length, length_bin.max_length) for length_bin in bins])
+	outputs = [open(length_bin.output, "wb", buffering=WRITE_BUFFER_SIZE) for length_bin in bins]
+	reject = open(reject_output, "wb", buffering=WRITE_BUFFER_SIZE) if reject_output is not None else None
+	counts = [0] * len(bins)
+	rejected_count = 0
+	histogram = np.zeros(0, dtype=np.int64)
+	try:
+		for routed, rejected, chunk_histogram in transformed_chunks(fastq_filename, transform, 4, processes,
+																	keep_blank_lines=True):
+			for index, (out, records) in enumerate(zip(outputs, routed)):
+				out.write(records)
+				counts[index] += records.count(b'\n') // 4
+			rejected_count += rejected.count(b'\n') // 4
+			if reject is not None:
+				reject.write(rejected)
+			if len(chunk_histogram) > len(histogram):
+				histogram = np.pad(histogram, (0, len(chunk_histogram) - len(histogram)))
+			histogram[:len(chunk_histogram)] += chunk_histogram
+	finally:
+		for out in outputs:
+			out.close()
+		if reject is not None:
+			reject.close()
+
+	report = {"bins": {length_bin.name: count for length_bin, count in zip(bins, counts)},
+			  "rejected": rejected_count,
+			  "histogram": {int(length): int(count) for length, count in enumerate(histogram.tolist()) if count}}
+	if report_output is not None:
+		with open(report_output, "w") as fp:
+			json.dump(report, fp, indent=1)
+	return report
+
+
+if __name__ == "__main__":
+	arguments = docopt(__doc__)
+	fastq_filename = arguments['<fastq_filename>']
+	main_name = ".".join(fastq_filename.split(".")[:-1])
+	length_bins = []
+	for bin_argument in arguments['--bin']:
+		name, min_length, max_length = bin_argument.split(":")
+		length_bins.append(LengthBin(name, int(min_length), int(max_length), "%s.%s.fastq" % (main_name, name)))
+	print(json.dumps(route_fastq_by_length(fastq_filename, length_bins, arguments['--reject'],
+										   int(arguments['--processes']), arguments['--report'])["bins"]))
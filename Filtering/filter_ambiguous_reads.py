@@ -12,15 +12,26 @@
 
 ##############################################################################################################################
 # Author:  Roni Haas
-# Main goal: Takes a fastq file and by using biopython library performs several filtering steps for
+# Main goal: Takes a fastq file and performs several filtering steps for
 # ambiguous reads, reflected by the nucleotides appearance in the read, quality scores, %N and more.
 # The output is a new fastq file with only high quality reads
 ##############################################################################################################################
 
 from docopt import docopt
-from Bio import SeqIO
 from math import log
+import functools
 import sys
+import numpy as np
+from Processing.genome_3nt import transformed_chunks, write_chunks
+
+PHRED_OFFSET = 33
+MAX_PHRED = 93
+# the error probability of every phred score, the same floats ave_qual sums
+PHRED_ERROR = np.array([10**(q / -10) for q in range(MAX_PHRED + 1)])
+UPPER_TABLE = np.frombuffer(bytes(range(256)).upper(), dtype=np.uint8)
+NUCLEOTIDES = np.frombuffer(b"ACGT", dtype=np.uint8)
+# reads whose average quality is this close to the threshold are compared with the ave_qual of the read
+QUALITY_TOLERANCE = 1e-6
 
 def filter_by_single_nucleotide_appearance(read_sequance, upper_appearance_thresh=60, lower_appearance_thresh=10,\
  N_max_appearance_thresh=10):
@@ -97,19 +108,107 @@ def filter_by_long_stretches_repeats(seq_string, stretche_max_len=20):
 	return True
 
 
-def extract_from_fastq(fq, output_fq):
+def reads_keep_mask(sequences, qualities, quality_thrsh=25, upper_appearance_thresh=60, lower_appearance_thresh=10,
+					N_max_appearance_thresh=10, stretche_max_len=20):
+	"""
+	vectorized filter_by_quality, filter_by_single_nucleotide_appearance and filter_by_long_stretches_repeats of a
+	batch of reads, with the same results (empty reads are not kept)
+	:param sequences: list of the sequences of the reads (bytes)
+	:param qualities: list of the quality strings of the reads (bytes, phred+33), of the lengths of the sequences
+	:return: boolean array, True for the reads that meet all the requirements
+	"""
+	number_of_reads = len(sequences)
+	lengths = np.fromiter(map(len, sequences), dtype=np.int64, count=number_of_reads)
+	if number_of_reads == 0:
+		return np.zeros(0, dtype=bool)
+	# the reads are joined with a separator, so counts and stretches don't cross reads and no segment is empty
+	starts = np.zeros(number_of_reads, dtype=np.int64)
+	np.cumsum(lengths[:-1] + 1, out=starts[1:])
+	joined = np.frombuffer(b"\n".join(sequences) + b"\n", dtype=np.uint8)
+	keep = lengths > 0
+
+	# nucleotide appearance, in integers: count*100/len <= thresh is count*100 <= thresh*len
+	upper = UPPER_TABLE[joined]
+	total = np.zeros(number_of_reads, dtype=np.int64)
+	for nucl in b"ACGTN":
+		counts = np.add.reduceat(upper == nucl, starts, dtype=np.int64)
+		total += counts
+		if nucl == ord("N"):
+			keep &= counts * 100 < N_max_appearance_thresh * lengths
+		else:
+			keep &= (counts * 100 <= upper_appearance_thresh * lengths) & \
+					(counts * 100 >= lower_appearance_thresh * lengths)
+	# any other character
+	keep &= total == lengths
+
+	# long stretches (of the case sensitive sequence): a stretch at the start of the read is rejected from
+	# stretche_max_len nucleotides, any other from stretche_max_len + 1 (the counter of the scalar function)
+	change = np.ones(len(joined), dtype=bool)
+	change[1:] = joined[1:] != joined[:-1]
+	run_starts = np.flatnonzero(change)
+	run_lengths = np.diff(np.append(run_starts, len(joined)))
+	run_reads = np.searchsorted(starts, run_starts, side="right") - 1
+	at_read_start = run_starts == starts[run_reads]
+	long_runs = np.isin(joined[run_starts], NUCLEOTIDES) & \
+				(run_lengths - np.where(at_read_start, 0, 1) >= stretche_max_len)
+	keep[run_reads[long_runs]] = False
+
+	# average quality, the error probabilities of every read are summed in order like ave_qual
+	phred = np.frombuffer(b"".join(qualities), dtype=np.uint8).astype(np.int64) - PHRED_OFFSET
+	if len(phred) and (phred.min() < 0 or phred.max() > MAX_PHRED):
+		raise ValueError("invalid character in the quality string")
+	errors = PHRED_ERROR[phred]
+	quality_starts = starts - np.arange(number_of_reads)
+	sums = np.zeros(number_of_reads)
+	for column in range(int(lengths.max())):
+		reads = np.flatnonzero(lengths > column)
+		sums[reads] += errors[quality_starts[reads] + column]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		average_quality = -10 * np.log10(sums / lengths)
+	quality_keep = average_quality > quality_thrsh
+	# np.log10 may differ from math.log in the last bit
+	for read in np.flatnonzero(keep & (np.abs(average_quality - quality_thrsh) < QUALITY_TOLERANCE)):
+		start = quality_starts[read]
+		quality_keep[read] = filter_by_quality(phred[start:start + lengths[read]].tolist(), quality_thrsh)
+	keep &= quality_keep
+	return keep
+
+
+def _filter_fastq_lines(filter_kwargs, lines):
+	"""
+	:param filter_kwargs: the thresholds of reads_keep_mask
+	:param lines: lines of whole fastq records (bytes)
+	:return: the records of the reads that are kept (bytes), like SeqIO.write writes them
+	"""
+	if len(lines) % 4:
+		raise ValueError("the fastq ends with a truncated record")
+	headers = [line.rstrip() for line in lines[0::4]]
+	sequences = [line.rstrip() for line in lines[1::4]]
+	qualities = [line.rstrip() for line in lines[3::4]]
+	for header, plus, sequence, quality in zip(headers, lines[2::4], sequences, qualities):
+		if header[:1] != b"@" or plus[:1] != b"+" or len(sequence) != len(quality):
+			raise ValueError("invalid fastq record %r" % header)
+	keep = reads_keep_mask(sequences, qualities, **filter_kwargs)
+	return b"".join(b"%s\n%s\n+\n%s\n" % (headers[read], sequences[read], qualities[read])
+					for read in np.flatnonzero(keep).tolist())
+
+
+def extract_from_fastq(fq, output_fq, processes=1, quality_thrsh=25, upper_appearance_thresh=60,
+					   lower_appearance_thresh=10, N_max_appearance_thresh=10, stretche_max_len=20):
 	"""
 	Takes a fastq file, examines each read using all the above functions, and writes to a 
-	new file the non-ambiguous reads
+	new file the non-ambiguous reads.
+	the reads are filtered in chunks of records (see reads_keep_mask) and the chunks are filtered in parallel
 	:param fq: the fastq file
 	:param output_fq: the output fastq file after filtering
+	:param processes: number of processes filtering chunks of the fastq in parallel
+	:return: output_fq
 	"""
-	input_iterator = SeqIO.parse(fq, "fastq")
-	#gos over each record and tests if the read meets the requirements
-	short_iterator = (rec for rec in input_iterator if filter_by_quality(rec.letter_annotations["phred_quality"]) \
-		and filter_by_single_nucleotide_appearance(rec.seq) and filter_by_long_stretches_repeats(rec.seq))
-	#writes to a new file after the conversion to a fastq format
-	SeqIO.write(short_iterator, output_fq, "fastq")
+	filter_kwargs = {"quality_thrsh": quality_thrsh, "upper_appearance_thresh": upper_appearance_thresh,
+					 "lower_appearance_thresh": lower_appearance_thresh,
+					 "N_max_appearance_thresh": N_max_appearance_thresh, "stretche_max_len": stretche_max_len}
+	transform = functools.partial(_filter_fastq_lines, filter_kwargs)
+	return write_chunks(transformed_chunks(fq, transform, 4, processes, keep_blank_lines=True), output_fq)
 
 def print_params():
 	string = "The parameters are:" + "\n" \
@@ -8,6 +8,7 @@
 from Utility.generators_utilities import class_generator
 from Utility.parallel_generator import parallel_generator
 from Utility.Pileup_class import Pileup_line
+from Utility.pileup_read_counts import count_reads_string, candidate_nucleotide
 from Processing.pileup_sorting import pileup_sort
 from docopt import docopt
 import tempfile
@@ -15,24 +16,11 @@ import os
 import shutil
 
 def get_candidate_nucl(pileup_line):
-    clean_str=pileup_line.split()[4]
-    clean_str = [char for char in clean_str if not char in ('^', '$')]
-    clean_str = ''.join(clean_str)
-    sense_string = clean_str.replace('^','')
-    sense_string = clean_str.replace('$','')
-    sense_string = clean_str.replace(',','.')
-    # TODO before use assumed letters are only upper case. I fix this assumption here
-    #sense_string_upper = sense_string.upper()
-    # Find the candidate nucleotide reads
-    nucl_changes = {"A": 0, "C": 0, "G": 0, "T": 0, "a": 0, "c": 0, "g": 0, "t": 0}
-    for nucl in list(sense_string):
-        if nucl in nucl_changes.keys():
-            nucl_changes[nucl] = nucl_changes[nucl]+1
-        else:
-            continue
-        # get the maximal nucleous change, key is the value of the dict
-    (candidate_nucl, candidate_nucl_reads) = max(nucl_changes.items(), key=lambda x: x[1])
-    return(candidate_nucl)
+    """
+    :param pileup_line: a pileup line string
+    :return: the most frequent mismatch nucleotide of the line, upper case for sense and lower case for antisense
+    """
+    return candidate_nucleotide(count_reads_string(pileup_line.split()[4]))
 
 
 def filter_for_specific_node_XtoY_editing_sites(pileup_file, node_name):
@@ -48,10 +36,11 @@ def filter_for_specific_node_XtoY_editing_sites(pileup_file, node_name):
             for line in pileup:
                 reference_nucl = line.split()[2]
                 reference_nucl = reference_nucl.upper()
-                if reference_nucl == from_nuc and get_candidate_nucl(line) == to_nuc or \
-                 reference_nucl == to_nuc and get_candidate_nucl(line) == from_nuc or \
-                 reference_nucl == nuc_pair_list[to_nuc] and get_candidate_nucl(line) == nuc_pair_list[from_nuc].lower() or \
-                 reference_nucl == nuc_pair_list[from_nuc] and get_candidate_nucl(line) == nuc_pair_list[to_nuc].lower():
+                candidate_nucl = get_candidate_nucl(line)
+                if reference_nucl == from_nuc and candidate_nucl == to_nuc or \
+                 reference_nucl == to_nuc and candidate_nucl == from_nuc or \
+                 reference_nucl == nuc_pair_list[to_nuc] and candidate_nucl == nuc_pair_list[from_nuc].lower() or \
+                 reference_nucl == nuc_pair_list[from_nuc] and candidate_nucl == nuc_pair_list[to_nuc].lower():
                     new_pileup.write(str(line))
 
     return pileup_file
@@ -17,110 +17,205 @@ Options:
 
 """
 
-from Utility.generators_utilities import class_generator
-from Utility.parallel_generator import parallel_generator
-from Utility.Pileup_class import Pileup_line
-from Processing.pileup_sorting import pileup_sort
+from Utility.position_index import PositionIndex, PositionIndexBuilder, is_position_index, POSITION_DTYPE, \
+	index_lock
+from Filtering.filter_pileup_by_multiple_existing_snps import filter_pileup_by_position_index
+from Filtering.filter_hyper_non_relevant_sites import get_candidate_nucl, filter_for_specific_node_XtoY_editing_sites, \
+	filter_hyper_non_relevant_editing_sites
+from Processing.pileup_sorting import pileup_sort, keyed_pileup_lines
 from docopt import docopt
+from array import array
+from contextlib import ExitStack
+from operator import itemgetter
+import heapq
+import itertools
+import multiprocessing
+import numpy as np
 import tempfile
 import os
-import shutil
-
-
-def get_candidate_nucl(pileup_line):
-	clean_str=pileup_line.split()[4]
-	clean_str = [char for char in clean_str if not char in ('^', '$')]
-	clean_str = ''.join(clean_str)
-	sense_string = clean_str.replace('^','')
-	sense_string = clean_str.replace('$','')
-	sense_string = clean_str.replace(',','.')
-	# TODO before use assumed letters are only upper case. I fix this assumption here
-	#sense_string_upper = sense_string.upper()
-	# Find the candidate nucleotide reads
-	nucl_changes = {"A": 0, "C": 0, "G": 0, "T": 0, "a": 0, "c": 0, "g": 0, "t": 0}
-	for nucl in list(sense_string):
-		if nucl in nucl_changes.keys():
-			nucl_changes[nucl] = nucl_changes[nucl]+1
-		else:
-			continue
-		# get the maximal nucleous change, key is the value of the dict
-	(candidate_nucl, candidate_nucl_reads) = max(nucl_changes.items(), key=lambda x: x[1])
-	return(candidate_nucl)
-
-
-def filter_for_specific_node_XtoY_editing_sites(pileup_file, node_name):
-	from_nuc = node_name.split("_")[2]
-	to_nuc = node_name.split("_")[3]
-	nuc_pair_list = {"A":"T", "C":"G", "T":"A", "G":"C"}
-
-	original_pileup_file = os.path.join(pileup_file + "_before_" + from_nuc + "_" + to_nuc + "_filtering")
-	shutil.copyfile(pileup_file, original_pileup_file)
-
-	with open (original_pileup_file,'r') as pileup:
-		with open (pileup_file,'w') as new_pileup:
-			for line in pileup:
-				reference_nucl = line.split()[2]
-				reference_nucl = reference_nucl.upper()
-				if reference_nucl == from_nuc and get_candidate_nucl(line) == to_nuc or \
-				 reference_nucl == to_nuc and get_candidate_nucl(line) == from_nuc or \
-				 reference_nucl == nuc_pair_list[to_nuc] and get_candidate_nucl(line) == nuc_pair_list[from_nuc].lower() or \
-				 reference_nucl == nuc_pair_list[from_nuc] and get_candidate_nucl(line) == nuc_pair_list[to_nuc].lower():
-					new_pileup.write(str(line))
-
-	return pileup_file
-
-def filter_hyper_non_relevant_editing_sites(pileup_filename_list):
-	for file in pileup_filename_list:
-		is_hyper = False
-		node_name = file.split("/")[-3]
-		try:
-			is_hyper = (node_name.split("_")[1] == "hyper")
-		except:
-			is_hyper == False
-		if is_hyper:
-			filter_for_specific_node_XtoY_editing_sites(file, node_name)
-
-def filter_by_consensus(pileup_filename_list, k,filtered_output_list,concensus_file,sorted_input=True):
+
+CONSENSUS_INDEX_SUFFIX = ".pidx"
+
+
+def filter_by_consensus(pileup_filename_list, k,filtered_output_list,concensus_file,sorted_input=True, processes=1):
 	#filter_hyper_non_relevant_editing_sites(pileup_filename_list)
-	create_consensus_file(pileup_filename_list, k, concensus_file, sorted_input)
-	filter_pileups_by_consensus(pileup_filename_list, concensus_file, sorted_input, filtered_output_list)
+	filter_by_consensus_thresholds(pileup_filename_list, [k], [filtered_output_list], [concensus_file], processes,
+								   sorted_input)
+
+
+def filter_by_consensus_thresholds(pileup_filename_list, thresholds, filtered_output_lists, consensus_files,
+								   processes=1, sorted_input=True):
+	'''
+	consensus filtering of the pileups with several thresholds, the support of the sites is counted once for all of
+	them (e.g. for a sensitivity analysis of k)
+	:param thresholds: list of k values, 0<k<1
+	:param filtered_output_lists: for every threshold, the list of the filtered outputs of the pileups
+	:param consensus_files: for every threshold, the name of its consensus file
+	:param processes: number of processes filtering the pileups in parallel
+	:param sorted_input: set to False if the pileups are not sorted
+	:return: filtered_output_lists
+	'''
+	consensus_indexes = create_consensus_files(pileup_filename_list, thresholds, consensus_files,
+											   sorted_input=sorted_input)
+	jobs = [(pileup, consensus_index, pileup_out, True)
+			for consensus_index, output_list in zip(consensus_indexes, filtered_output_lists)
+			for pileup, pileup_out in zip(pileup_filename_list, output_list)]
+	if processes > 1:
+		with multiprocessing.Pool(processes) as pool:
+			pool.starmap(filter_pileup_by_position_index, jobs)
+	else:
+		for job in jobs:
+			filter_pileup_by_position_index(*job)
+	return filtered_output_lists
+
+
+def pileup_position_set(pileup_filename):
+	'''
+	:return: dict of chromosome to the sorted unique positions of the lines of the pileup (the pileup doesn't have
+	to be sorted)
+	'''
+	positions = dict()
+	with open(pileup_filename, 'r') as pileup:
+		for line in pileup:
+			fields = line.split('\t', 2)
+			if len(fields) < 3:
+				continue
+			chromosome_positions = positions.get(fields[0])
+			if chromosome_positions is None:
+				chromosome_positions = positions[fields[0]] = array('I')
+			chromosome_positions.append(int(fields[1]))
+	return {chromosome: np.unique(np.frombuffer(chromosome_positions, dtype=POSITION_DTYPE))
+			for chromosome, chromosome_positions in positions.items()}
+
+
+def library_position_set(library):
+	'''
+	:param library: pileup file, or position index (PositionIndex or its directory) of the sites of a library
+	:return: dict of chromosome to the sorted unique positions of the library
+	'''
+	if not isinstance(library, PositionIndex) and is_position_index(library):
+		library = PositionIndex(library)
+	if isinstance(library, PositionIndex):
+		return {chromosome: library.positions(chromosome) for chromosome in library.chromosomes}
+	return pileup_position_set(library)
+
+
+def consensus_support(position_sets):
+	'''
+	:param position_sets: list of position sets of the libraries (see library_position_set)
+	:return: dict of chromosome to (positions, number of libraries that have each of the positions)
+	'''
+	chromosomes = set().union(*position_sets)
+	support = dict()
+	for chromosome in chromosomes:
+		positions = [position_set[chromosome] for position_set in position_sets if chromosome in position_set]
+		support[chromosome] = np.unique(np.concatenate(positions), return_counts=True)
+	return support
 
 
+def consensus_positions(support, number_of_libraries, k):
+	'''
+	:param support: the support of the sites (see consensus_support)
+	:param k: the percentage of libraries a site must be included in to be within the consensus. 0<k<1
+	:return: dict of chromosome to the sorted positions of the consensus
+	'''
+	return {chromosome: positions[counts / number_of_libraries >= k]
+			for chromosome, (positions, counts) in support.items()}
+
+
+def consensus_file_stat(consensus_file):
+	'''
+	:return: the meta of the position index of a consensus file, it is valid while they don't change
+	'''
+	stat = os.stat(consensus_file)
+	return {"consensus": os.path.abspath(consensus_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_consensus_index_valid(consensus_file, index_dir):
+	'''
+	:return: True if index_dir holds the position index of the current consensus_file
+	'''
+	if not is_position_index(index_dir):
+		return False
+	meta = PositionIndex(index_dir).meta or dict()
+	return all(meta.get(key) == value for key, value in consensus_file_stat(consensus_file).items())
+
+
+def sorted_pileup_sites(pileup_filename_list):
+	'''
+	a single merge pass over sorted pileups
+	:return: yields (chromosome, position, line) of every site of the pileups in sorted order, the line of a site is
+	its line in the first pileup that has it
+	'''
+	keyed_lines = heapq.merge(*[keyed_pileup_lines(pileup) for pileup in pileup_filename_list], key=itemgetter(0))
+	for (chromosome, position), site_lines in itertools.groupby(keyed_lines, key=itemgetter(0)):
+		yield chromosome, position, next(site_lines)[1]
+
+
+def create_consensus_files(pileup_filename_list, thresholds, consensus_filenames, position_sets=None,
+						   sorted_input=True):
+	'''
+	writes the consensus file of every threshold: the sorted lines of the sites that are in at least k of the pileups
+	(the line of a site is its line in the first pileup that has it), and the position index of the consensus
+	(<consensus file>.pidx)
+	:param thresholds: list of k values, 0<k<1
+	:param consensus_filenames: for every threshold, the name of its consensus file
+	:param position_sets: the position sets of the pileups (see library_position_set), read from the pileups if None
+	:param sorted_input: set to False if the pileups are not sorted, they are sorted to temporary files for writing
+	the consensus lines
+	:return: list of the directories of the consensus position indexes
+	'''
+	if position_sets is None:
+		position_sets = [pileup_position_set(pileup) for pileup in pileup_filename_list]
+	support = consensus_support(position_sets)
+	number_of_libraries = len(pileup_filename_list)
+	consensus_list = [consensus_positions(support, number_of_libraries, k) if number_of_libraries else dict()
+					  for k in thresholds]
+
+	with ExitStack() as stack:
+		sorted_pileups = pileup_filename_list
+		if not sorted_input:
+			temp_dir = stack.enter_context(tempfile.TemporaryDirectory())
+			sorted_pileups = [os.path.join(temp_dir, "%d.pileup" % i) for i in range(len(pileup_filename_list))]
+			for pileup, sorted_pileup in zip(pileup_filename_list, sorted_pileups):
+				pileup_sort(pileup, sorted_pileup)
+
+		# the lines of the consensus sites are written in one merge pass over the pileups, for every consensus the
+		# next of its positions (on the chromosome of the pass) is compared with the sites of the pass
+		outputs = [stack.enter_context(open(consensus_filename, 'w')) for consensus_filename in consensus_filenames]
+		chromosome = None
+		for site_chromosome, position, line in sorted_pileup_sites(sorted_pileups):
+			if site_chromosome != chromosome:
+				chromosome = site_chromosome
+				consensus_iterators = [iter(consensus[chromosome].tolist()) if chromosome in consensus else iter(())
+									   for consensus in consensus_list]
+				next_positions = [next(positions, None) for positions in consensus_iterators]
+			for i, next_position in enumerate(next_positions):
+				if next_position == position:
+					outputs[i].write(line)
+					next_positions[i] = next(consensus_iterators[i], None)
+
+	consensus_indexes = []
+	for consensus, consensus_filename in zip(consensus_list, consensus_filenames):
+		builder = PositionIndexBuilder()
+		for chromosome, positions in consensus.items():
+			if len(positions):
+				builder.add_many(chromosome, positions)
+		consensus_indexes.append(builder.write(consensus_filename + CONSENSUS_INDEX_SUFFIX,
+											   meta=consensus_file_stat(consensus_filename)))
+	return consensus_indexes
+
 
 def create_consensus_file(pileup_filename_list, k, consensus_filename, sorted_input=True):
 	'''
 	:param pileup_filename_list: list of pileup files to create a consensus list of pileup lines out of
 	:param k: the percentage of pileup files a line must be included in to be within the consensus. 0<k<1
 	:param consensus_filename: name of output file
-	:param sorted_input: binary flag, set to False if input pileups are not sorted
+	:param sorted_input: set to False if the pileups are not sorted
 	:return: consensus file
 	'''
-	sorted_pileups = []
-	if not sorted_input:
-		for pileup in pileup_filename_list:
-			pileup_sort(pileup, pileup+"_sorted.pileup")
-			sorted_pileups.append(pileup+"_sorted.pileup")
-	else:
-		sorted_pileups = pileup_filename_list
-
-	pileup_files = [open(pileup, 'r') for pileup in sorted_pileups]
-
-	try:
-		generators = [class_generator(Pileup_line, file=file) for file in pileup_files]
-		get_pos_and_id = lambda x: (x.reference_id, x.gene_pos)
-		parallel_gen = parallel_generator(generators, [get_pos_and_id for i in range(len(generators))])
-		number_of_pileups = len(pileup_files)
-		with open(consensus_filename, 'w') as out:
-			for pileuplist_list in parallel_gen:
-				hits = sum(x is not None for x in pileuplist_list) #number of non-None lists, the number of pileups which have the entry
-				if (hits/number_of_pileups) >= k:
-					pileup_list = next(item for item in pileuplist_list if item is not None) #first non-None pileup, all
-															# lines in the list from parallel_gen should have the same line
-					out.write(str(pileup_list[0]) + "\n")
-	finally:
-		for file in pileup_files:
-			file.close()
-		return consensus_filename
+	create_consensus_files(pileup_filename_list, [k], [consensus_filename], sorted_input=sorted_input)
+	return consensus_filename
 
 
 def filter_pileups_by_consensus(pileup_list,consensus_file, sorted_input=True, output_list=None):
@@ -129,39 +224,30 @@ def filter_pileups_by_consensus(pileup_list,consensus_file, sorted_input=True, o
 	:param pileup_list: list of pileup files to be filtered
 	:param consensus_file: consensus pileup, pileups from pileup list will be filtered so that only lines that are in
 	the consensus pileup remain in each pileup file
-	:param sorted_input: binary flag, set to False if input pileups are not sorted
+	:param sorted_input: kept for compatibility, the pileups don't have to be sorted
 	:param output_dir: directory to write output to
 	:return: list of filtered pileup files
 	'''
-	# if not sorted, sort
-	if not sorted_input:
-		sorted_pileups = []
-		for pileup in pileup_list:
-			file_path,extension=os.path.splitext(pileup)
-			out_name=f"{file_path}_sorted.{extension}"
-			pileup_sort(pileup, out_name)
-			sorted_pileups.append(out_name)
-	else:
-		sorted_pileups=pileup_list
-
 	#if no output list, make conensus files in the same place as the input file
 	if output_list is None:
 		output_list=[]
-		for pileup in sorted_pileups:
+		for pileup in pileup_list:
 			file_path,extension=os.path.splitext(pileup)
 			out_name=f"{file_path}_kfiltered.{extension}"
 			output_list.append(out_name)
 
+	# the index of the consensus file is rebuilt when the file changed since it was written
+	consensus_index = consensus_file + CONSENSUS_INDEX_SUFFIX
+	if not is_consensus_index_valid(consensus_file, consensus_index):
+		with index_lock(consensus_index):
+			if not is_consensus_index_valid(consensus_file, consensus_index):
+				builder = PositionIndexBuilder()
+				for chromosome, positions in pileup_position_set(consensus_file).items():
+					builder.add_many(chromosome, positions)
+				builder.write(consensus_index, meta=consensus_file_stat(consensus_file))
 
-	for (pileup,pileup_out) in zip(sorted_pileups, output_list):
-		with open(pileup, 'r') as pileup_object, open(pileup_out, 'w') as out, open(consensus_file,'r') as consensus:
-			pileup_gen = class_generator(Pileup_line, file=pileup_object)
-			con_gen = class_generator(Pileup_line, file=consensus)
-			get_pos_and_id = lambda x: (x.reference_id, x.gene_pos)
-			parallel_gen = parallel_generator([pileup_gen, con_gen], [get_pos_and_id, get_pos_and_id])
-			for [pile, con] in parallel_gen:
-				if pile is not None and con is not None:
-					out.write(str(pile[0])+'\n')
+	for (pileup,pileup_out) in zip(pileup_list, output_list):
+		filter_pileup_by_position_index(pileup, consensus_index, pileup_out, keep_indexed=True)
 	return output_list
 
 
@@ -175,11 +261,11 @@ if __name__ == '__main__':
 
 
 	pileups = arguments['PILEUPS']
-	kpercent = arguments['--percentage']
+	kpercent = float(arguments['--percentage'])
 	output_dir = arguments['--dir']
 	consensus = arguments['--consensus']
 	if consensus is None:
-		consensus = tempfile.TemporaryFile()
+		consensus = tempfile.NamedTemporaryFile(suffix='.pileup', delete=False).name
 	consensus_file = create_consensus_file(pileups, kpercent, consensus, sorted)
 	filter_pileups_by_consensus(pileups, consensus_file, sorted, output_dir)
 
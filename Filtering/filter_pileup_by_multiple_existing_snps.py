@@ -1,55 +1,43 @@
 
+import hashlib
+import json
+import os
+import re
+import numpy as np
 import Utility.generators_utilities as gen_util
 from Utility.Pileup_class import Pileup_line
-from Utility.Vcf_class import VcfClass
+from Utility.position_index import PositionIndex, PositionIndexBuilder, is_position_index, index_lock
+from Utility.vcf_index import vcf_position_index
 from Utility.parallel_generator import parallel_generator
 from Processing.pileup_sorting import pileup_sort
-from Utility.multiline_sort import multiline_sort_pileup
+
+
+SNP_INDEX_BATCH_LINES = 100000
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+# the characters of Pileup_line.is_with_any_change, searched in the reads column of the raw pileup line
+ANY_CHANGE_PATTERN = re.compile("[ACGTRYSWKMBDHVNacgtryswkmbdhvn]")
 
 
 def snp_detect(pileup_line: Pileup_line):
     return pileup_line.is_with_any_change()
 
 
-def snp_algebra_from_vcf_file(pileup_filename, vcf_file, output_file=None, sorted_input=True):
+def snp_algebra_from_vcf_file(pileup_filename, vcf_file, output_file=None, sorted_input=True, index_dir=None):
     """
     :param pileup_filename: positive pileup to be filtered
-    :param vcf_file: vcf file that is a database containing known SNPs
-    :param snp_detector: binary functor that receives a pileup line and returns True if there is an snp in the line
+    :param vcf_file: vcf file that is a database containing known SNPs (plain or .gz, with or without a header)
     :param output_file: file to write output to
-    :param sorted_input: binary flag, set to False if input positive pileups are not sorted
-    :param keep_pos_in_neg: binary flag, set to False if we want positions in the negative pileup to be
-    left out of the output file
-    :return
+    :param sorted_input: kept for compatibility, the lookup in the vcf index doesn't need a sorted pileup
+    :param index_dir: directory of the compiled index of the vcf (see Utility.vcf_index), default <vcf_file>.pidx
+    :return output_file
     """
-
-
-    # sorting pileups if necessary and preparing filenames
-    if not sorted_input:
-        multiline_sort_pileup(1, '~~~', 1, pileup_filename, 2, pileup_filename + "_sorted.pileup")
-        sorted_positive_pileup = pileup_filename + "_sorted.pileup"
-    else:
-        sorted_positive_pileup = pileup_filename
-    #with open(sorted_positive_pileup, "r") as sorted_positive_pileup:
-    #   print("sorted_positive_pileup",sorted_positive_pileup.readlines())
     if output_file is None:
-        splited = sorted_positive_pileup.split(".")
+        splited = pileup_filename.split(".")
         output_file = ".".join(splited[:-1]) + "_no-snp." + splited[-1]
-    get_pos_and_id = lambda x: (x.reference_id, x.gene_pos)
-    # logic of the function
-    try:
-        with open(vcf_file, 'r') as vcf_obj, open(sorted_positive_pileup, 'r') as pileup_obj,\
-             open(output_file, 'w') as out:
-            
-            pos_gen = gen_util.class_generator(Pileup_line, file=pileup_obj)
-            vcf_gen = gen_util.class_generator(VcfClass, file=vcf_obj)
-            parallel_gen = parallel_generator([pos_gen, vcf_gen],
-                                              [get_pos_and_id for i in range(2)])
-            for listlist in parallel_gen:  # listlist: list of lists, each entry in listlist is a list of items from one generator
-                if (listlist[0] is not None and listlist[1] is None):  # listlist[0]: list of pileup_lines(should be 1 line) from the input pileup
-                    out.write(str(listlist[0][0]) + "\n")
-    except Exception as e:
-        print(e)
+    # logic of the function, a vcf that can't be read or compiled raises (no output is written)
+    filter_pileup_by_position_index(pileup_filename, vcf_position_index(vcf_file, index_dir), output_file,
+                                    keep_indexed=False)
     return output_file
 
 def snp_algebra(pileup_filename, negative_pileup_list, snp_detector=snp_detect, output_file=None,
@@ -117,3 +105,133 @@ def snp_algebra(pileup_filename, negative_pileup_list, snp_detector=snp_detect,
         for fd in neg_obj_list:
             fd.close()
         return output_file
+
+
+def negative_snp_index_key(negative_pileup_list, snp_detector=snp_detect):
+    """
+    :return: the key of the snp index of the negative pileups: a hash of their contents (in any order) and the
+    snp detector
+    """
+    digests = []
+    for pileup in negative_pileup_list:
+        digest = hashlib.sha256()
+        with open(pileup, "rb") as fp:
+            for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+                digest.update(block)
+        digests.append(digest.hexdigest())
+    detector = "%s.%s" % (snp_detector.__module__, snp_detector.__qualname__)
+    return hashlib.sha256(json.dumps([sorted(digests), detector]).encode()).hexdigest()[:32]
+
+
+def build_negative_snp_index(negative_pileup_list, index_dir, snp_detector=snp_detect):
+    """
+    writes the position index (see Utility.position_index) of the snps of the negative pileups: the positions where
+    snp_detector is True for a line of any of the negative pileups
+    :return: index_dir
+    """
+    builder = PositionIndexBuilder()
+    for pileup in negative_pileup_list:
+        with open(pileup, "r") as fp:
+            if snp_detector is snp_detect:
+                # the same test as is_with_any_change, without parsing the lines
+                for line in fp:
+                    fields = line.split("\t", 5)
+                    if len(fields) > 4 and ANY_CHANGE_PATTERN.search(fields[4]):
+                        builder.add(fields[0], int(fields[1]))
+            else:
+                for pileup_line in gen_util.class_generator(Pileup_line, file=fp):
+                    if snp_detector(pileup_line):
+                        builder.add(pileup_line.reference_id, pileup_line.gene_pos)
+    return builder.write(index_dir, meta={"negative_pileups": [os.path.abspath(p) for p in negative_pileup_list]})
+
+
+def negative_snp_index(negative_pileup_list, cache_dir, snp_detector=snp_detect):
+    """
+    the snp index of the negative pileups, built once: it is cached in cache_dir by negative_snp_index_key, so runs
+    with the same negative libraries reuse it
+    :return: the directory of the index
+    """
+    index_dir = os.path.join(cache_dir, negative_snp_index_key(negative_pileup_list, snp_detector))
+    if not is_position_index(index_dir):
+        with index_lock(index_dir):
+            if not is_position_index(index_dir):
+                build_negative_snp_index(negative_pileup_list, index_dir, snp_detector)
+    return index_dir
+
+
+def filter_pileup_by_position_index(pileup_filename, position_index, output_file, keep_indexed=False):
+    """
+    filters a pileup by a position index, a vectorized lookup of batches of its lines
+    :param position_index: PositionIndex or its directory (or any object with its contains(chromosome, positions))
+    :param keep_indexed: if False the lines of the positions in the index are removed, else only they are kept
+    :return: output_file
+    """
+    if not hasattr(position_index, "contains"):
+        position_index = PositionIndex(position_index)
+
+    def write_batch(out, lines, chromosomes, positions):
+        positions = np.array(positions, dtype=np.int64)
+        keep = np.empty(len(lines), dtype=bool)
+        start = 0
+        # the lines of a sorted pileup come in runs of the same chromosome
+        while start < len(lines):
+            end = start
+            while end < len(lines) and chromosomes[end] == chromosomes[start]:
+                end += 1
+            keep[start:end] = position_index.contains(chromosomes[start], positions[start:end]) == keep_indexed
+            start = end
+        out.writelines(line for line, kept in zip(lines, keep) if kept)
+
+    with open(pileup_filename, "r") as pileup, open(output_file, "w") as out:
+        lines, chromosomes, positions = [], [], []
+        for line in pileup:
+            fields = line.split("\t", 2)
+            if len(fields) < 3:
+                # blank lines are skipped, like class_generator does
+                continue
+            lines.append(line if line.endswith("\n") else line + "\n")
+            chromosomes.append(fields[0])
+            positions.append(int(fields[1]))
+            if len(lines) >= SNP_INDEX_BATCH_LINES:
+                write_batch(out, lines, chromosomes, positions)
+                lines, chromosomes, positions = [], [], []
+        write_batch(out, lines, chromosomes, positions)
+    return output_file
+
+
+def snp_algebra_indexed(pileup_filename, snp_index, output_file=None):
+    """
+    removes the snps of the negative pileups (see negative_snp_index) from a positive pileup, like snp_algebra with
+    keep_pos_in_neg=False. the positive pileup doesn't have to be sorted
+    :param snp_index: PositionIndex or the directory of the index
+    :return: output_file
+    """
+    if output_file is None:
+        splited = pileup_filename.split(".")
+        output_file = ".".join(splited[:-1]) + "_no-snp." + splited[-1]
+    return filter_pileup_by_position_index(pileup_filename, snp_index, output_file, keep_indexed=False)
+
+
+class IndexedSitesFilter:
+    """
+    site filter of a position index for filter chains (see analyze_editing_percent.site_filter_stage):
+    a pileup line is kept if its position is not in the index (or only if it is, with keep_indexed)
+    """
+
+    def __init__(self, position_index, keep_indexed=False):
+        if not isinstance(position_index, PositionIndex):
+            position_index = PositionIndex(position_index)
+        self.position_index = position_index
+        self.keep_indexed = keep_indexed
+
+    def __call__(self, pileup_line):
+        return ((pileup_line.reference_id, pileup_line.gene_pos) in self.position_index) == self.keep_indexed
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
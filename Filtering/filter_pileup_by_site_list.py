@@ -15,23 +15,148 @@
 import sys
 from docopt import docopt
 import re
+import gzip
+import numpy as np
+from Filtering.filter_pileup_by_multiple_existing_snps import filter_pileup_by_position_index
 
+BED_SUFFIXES = (".bed", ".bed.gz")
 
 
-def filter_pileup_by_site_list(pileup,output,listSites):
+def _open_text(filename):
+    return gzip.open(filename, "rt") if filename.endswith(".gz") else open(filename, "r")
+
+
+def is_bed_file(filename):
+    return filename.lower().endswith(BED_SUFFIXES)
+
+
+def read_site_intervals(site_file, bed=None):
+    """
+    reads the sites of a site list file or the intervals of a bed file
+    :param site_file: site list (lines of "chr, pos" or "chr<tab>pos") or bed file (0 based, end exclusive intervals)
+    :param bed: True for a bed file, default: by the suffix of site_file (.bed or .bed.gz)
+    :return: yields (chromosome, start, end) - 1 based inclusive intervals, (chr, pos, pos) for a site
+    """
+    if bed is None:
+        bed = is_bed_file(site_file)
+    with _open_text(site_file) as sites:
+        for line in sites:
+            if bed:
+                if line.startswith(("#", "track", "browser")):
+                    continue
+                fields = line.split("\t")
+                if len(fields) < 3:
+                    continue
+                yield fields[0].strip(), int(fields[1]) + 1, int(fields[2])
+            else:
+                fields = [field.strip() for field in re.split("[,\t]", line, 2)]
+                if len(fields) < 2 or not fields[0]:
+                    continue
+                yield fields[0], int(fields[1]), int(fields[1])
+
+
+class SiteList:
+    """
+    sites and intervals of chromosomes, kept as sorted and merged interval arrays per chromosome, so the membership
+    of a batch of positions is a vectorized binary search (the contains interface of a position index)
+    """
+
+    def __init__(self, intervals):
+        """
+        :param intervals: iterable of (chromosome, start, end), 1 based inclusive
+        """
+        starts = dict()
+        ends = dict()
+        for chromosome, start, end in intervals:
+            starts.setdefault(chromosome, []).append(start)
+            ends.setdefault(chromosome, []).append(end)
+        self.starts = dict()
+        self.ends = dict()
+        for chromosome in starts:
+            chromosome_starts = np.array(starts[chromosome], dtype=np.int64)
+            chromosome_ends = np.array(ends[chromosome], dtype=np.int64)
+            order = np.argsort(chromosome_starts, kind="stable")
+            chromosome_starts, chromosome_ends = chromosome_starts[order], np.maximum.accumulate(chromosome_ends[order])
+            # merge overlapping and adjacent intervals: an interval starts a new one if it starts after the ends of
+            # all the intervals before it
+            new_interval = np.ones(len(chromosome_starts), dtype=bool)
+            new_interval[1:] = chromosome_starts[1:] > chromosome_ends[:-1] + 1
+            self.starts[chromosome] = chromosome_starts[new_interval]
+            self.ends[chromosome] = chromosome_ends[np.append(new_interval[1:], True)]
+
+    @classmethod
+    def from_file(cls, site_file, bed=None):
+        """
+        :param site_file: site list or bed file (see read_site_intervals)
+        """
+        return cls(read_site_intervals(site_file, bed))
+
+    @classmethod
+    def from_sites(cls, sites):
+        """
+        :param sites: iterable of (chromosome, position), the position may be a string
+        """
+        return cls((chromosome, int(position), int(position)) for chromosome, position in sites)
+
+    def contains(self, chromosome, positions):
+        """
+        :param positions: array of positions of the chromosome
+        :return: boolean array, True for the positions in the sites or intervals
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        starts = self.starts.get(chromosome)
+        if starts is None or len(positions) == 0:
+            return np.zeros(len(positions), dtype=bool)
+        places = np.searchsorted(starts, positions, side="right") - 1
+        found = places >= 0
+        found[found] = positions[found] <= self.ends[chromosome][places[found]]
+        return found
+
+    def __contains__(self, site):
+        chromosome, position = site
+        return bool(self.contains(chromosome, [int(position)])[0])
+
+
+def filter_sorted_pileup_by_site_file(pileup, output, site_file, bed=None):
+    """
+    merge join of a sorted pileup and a site list or bed file sorted the same way (by chromosome name, then
+    position), the memory use doesn't depend on the size of the pileup or of the site file
+    :return: output
+    """
+    intervals = read_site_intervals(site_file, bed)
+    interval = next(intervals, None)
+    with open(pileup, "r") as pileup_object, open(output, "w") as fileout:
+        for line in pileup_object:
+            fields = line.split("\t", 2)
+            if len(fields) < 3:
+                continue
+            chromosome, position = fields[0], int(fields[1])
+            # skip the intervals that end before the site, they end before all the next sites too
+            while interval is not None and (interval[0] < chromosome or
+                                            (interval[0] == chromosome and interval[2] < position)):
+                interval = next(intervals, None)
+            if interval is not None and interval[0] == chromosome and interval[1] <= position:
+                fileout.write(line if line.endswith("\n") else line + "\n")
+    return output
+
+
+def filter_pileup_by_site_list(pileup,output,listSites, sorted_input=False, bed=None):
     """
     :param pileup:  the pile up we want to filter
-    :param listSites: a list of sites - (chr , pos) - we want to filter by
+    :param listSites: a list of sites - (chr , pos) - we want to filter by, a SiteList, or the name of a site list
+    or bed file (see read_site_intervals)
     :param output: the output file that will contain lines with only the sites in listSites as ref base
+    :param sorted_input: set to True if the pileup and the site file are sorted, they are then merge joined instead
+    of loading the site file
+    :param bed: True if listSites is a bed file, default: by its suffix
     """
-    with open(pileup,"r") as file1:
-        line = file1.readline()
-        with open(output,"w") as fileout:
-            while line is not None and line != "":
-                lineParts = line.split()
-                if (lineParts[0],lineParts[1]) in listSites:
-                    fileout.write(line)
-                line=file1.readline()
+    if isinstance(listSites, str):
+        if sorted_input:
+            return filter_sorted_pileup_by_site_file(pileup, output, listSites, bed)
+        listSites = SiteList.from_file(listSites, bed)
+    elif not isinstance(listSites, SiteList):
+        listSites = SiteList.from_sites(listSites)
+    return filter_pileup_by_position_index(pileup, listSites, output, keep_indexed=True)
 
 
 
@@ -42,7 +167,7 @@ def param_description():
     print("The parameters are\n" +
           "pileup_file: the pileup file you want to filter\n" +
           "out_file: the name of the output file\n" +
-          "site_list: the name of the file where each line is (char, pos) that we want to filter by\n")
+          "site_list: the name of the file where each line is (char, pos) that we want to filter by, or a bed file\n")
 
 
 def example_description():
@@ -89,7 +214,7 @@ def example_description():
 """
 :param pileup:  the pile up we want to filter
 :param output: the output file that will contain lines with only the sites in listSites as ref base
-:param listSites: file where each line is (char, pos) that we want to filter by
+:param listSites: file where each line is (char, pos) that we want to filter by, or a bed file of intervals
 :output: output file will contain only the lines in the given (chr, pos) positions
 """
 
@@ -106,12 +231,5 @@ if __name__ == "__main__" :
     pileup = args['<pileup_file>']
     output = args['<out_file>']
     listSites = args['<site_list>']
-    listPos = []
-    with open(listSites,"r") as file1:
-        for item in file1:
-            iList=re.split( ",|\n" , item)
-            if len(iList)==1:
-                iList=item.split("\t")
-            listPos.append((iList[0],iList[1]))
-    filter_pileup_by_site_list(pileup,output,listPos)
+    filter_pileup_by_site_list(pileup,output,listSites)
 
@@ -11,30 +11,17 @@ import sys
 import shutil
 import Utility.generators_utilities as gen_util
 from Utility.Pileup_class import Pileup_line
+from Utility.pileup_read_counts import candidate_nucleotide
 from Utility.parallel_generator import parallel_generator
 from Processing.pileup_sorting import pileup_sort
 from Utility.multiline_sort import multiline_sort_pileup
 
 def get_candidate_nucl(pileup_line):
-    clean_str=pileup_line.reads_string
-    clean_str = [char for char in clean_str if not char in ('^', '$')]
-    clean_str = ''.join(clean_str)
-    sense_string = clean_str.replace('^','')
-    sense_string = clean_str.replace('$','')
-    sense_string = clean_str.replace(',','.')
-    # TODO before use assumed letters are only upper case. I fix this assumption here
-    sense_string_upper = sense_string.upper()
-    # Find the candidate nucleotide reads
-    nucl_A, nucl_C, nucl_T, nucl_G = 0, 0, 0, 0
-    nucl_changes = {"A": 0, "C": 0, "G": 0, "T": 0, "a": 0, "c": 0, "g": 0, "t": 0}
-    for nucl in list(sense_string):
-        if (nucl=='A' or nucl=='C' or nucl=='G' or nucl=='T' or nucl=='a' or nucl=='c' or nucl=='g' or nucl=='t'):
-            nucl_changes[nucl] = nucl_changes[nucl]+1
-        else:
-            continue
-        # get the maximal nucleous change, key is the value of the dict
-    (candidate_nucl, candidate_nucl_reads) = max(nucl_changes.items(), key=lambda x: x[1])
-    return(candidate_nucl)
+    """
+    :param pileup_line: Pileup_line object
+    :return: the most frequent mismatch nucleotide of the line, upper case for sense and lower case for antisense
+    """
+    return candidate_nucleotide(pileup_line.read_counts)
 
 def write_unique_sites_doing_nothing(positive_pileup_list, sorted_input=True):
 
@@ -16,33 +16,31 @@ Options:
 """
 
 
-from Filtering.fastq_seq_size_filtering import *
+from Filtering.fastq_length_router import LengthBin, route_fastq_by_length
 import os
 from docopt import docopt
 
-def filterToPrimarySecondaryLibs(fastqFilename):
+PRIMARY_RANGE = (25, 30)
+SECONDARY_RANGE = (19, 23)
+
+
+def filterToPrimarySecondaryLibs(fastqFilename, processes=1, report=None):
 	"""
 	:param fastqFilename: the fastq we want to create primary and secondary libs from
+	:param processes: number of processes routing chunks of the fastq in parallel
+	:param report: optional json file of the counts of the libs and the length histogram (see route_fastq_by_length)
 	:return: the primary and secondary filenames that we filtered by primary siRNA 25-30nt ,secondary siRNA 19-23nt
 	"""
-
-	open(fastqFilename,'r').close()
-
-
 	fastqName = fastqFilename.split(".")
 	fastqName.pop(len(fastqName)-1)
 	mainName = ".".join(fastqName)
 	primary = mainName + ".primary.fastq"
 	secondary = mainName + ".secondary.fastq"
-	open(primary,"w").close()
-	open(secondary,"w").close()
-	non="non_temp.txt"
-	open(non,"w").close()
-
-	filterFastqFileBySize(fastqFilename, 25, 30,primary, non)	#primaryRange = (25,30)	
-	filterFastqFileBySize(fastqFilename, 19, 23,secondary, non)	#secondaryRange = (19,23)
-	
-	os.remove(non)
+
+	# both libs in a single pass over the fastq
+	route_fastq_by_length(fastqFilename, [LengthBin("primary", *PRIMARY_RANGE, primary),
+										  LengthBin("secondary", *SECONDARY_RANGE, secondary)],
+						  processes=processes, report_output=report)
 
 	return primary, secondary
 
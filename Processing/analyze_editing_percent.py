@@ -20,7 +20,10 @@ Options:
 
 from Utility.generators_utilities import getLineFromChunk, class_generator
 from Utility.Pileup_class import Pileup_line
+from Utility.pileup_read_counts import editing_stats
+from Utility.count_utils import write_site_count
 import itertools
+from collections import namedtuple
 import pandas as pd
 import os
 import re
@@ -31,6 +34,35 @@ from Utility.logger_utils import get_Pipes_dir
 from Experiments.forontiers_jupyter.parallel_commands import parallel_commands
 
 
+def site_editing_stats(pileup_line: Pileup_line):
+    """
+    :return: (candidate_nucl, candidate_nucl_reads, editing_percent, noise_percent) of the pileup line,
+    a single scan of its reads string
+    """
+    return editing_stats(pileup_line.read_counts, pileup_line.base_count)
+
+
+def is_editing_site(pileup_line: Pileup_line, stats, read_thresh_hold=1, editing_min_percent_threshold=0.,
+                    editing_max_percent_threshold=100, noise_percent_threshold=100, editing_read_thresh=0):
+    """
+    :param stats: the site_editing_stats of the pileup line
+    the thresholds are those of is_pileup_line_edited
+    :return: True if the site passes the thresholds
+    """
+    candidate_nucl, candidate_nucl_reads, editing_percent, noise_percent = stats
+    return is_reads_threshold_match(pileup_line, read_thresh_hold) and (editing_percent >= editing_min_percent_threshold
+        and editing_percent <= editing_max_percent_threshold) and (noise_percent <= noise_percent_threshold) and (
+        editing_percent != 0.0) and (candidate_nucl_reads >= editing_read_thresh)
+
+
+def add_editing_tags(pileup_line: Pileup_line, stats):
+    """
+    adds the editing percent and noise percent of the site_editing_stats stats to the tags of the pileup line
+    """
+    pileup_line.tags["editing_percent"] = str(stats[2])
+    pileup_line.tags["noise_percent"] = str(stats[3])
+
+
 def is_pileup_line_edited(pileup_line: Pileup_line, read_thresh_hold=1, editing_min_percent_threshold=0.,
                           editing_max_percent_threshold=100, noise_percent_threshold=100, const_tag='', editing_read_thresh=0):
     """
@@ -46,59 +78,20 @@ def is_pileup_line_edited(pileup_line: Pileup_line, read_thresh_hold=1, editing_
     :return: (editing_type,pileup_line)  where editing_type is a tuple of the form (from_base,to_base)
     and pileupline is the oirginal line with the new fields in
     """
-    clean_str = pileup_line.clean_base_string
-    sense_string = clean_str.replace(',', '.')
-    # TODO before use assumed letters are only upper case. I fix this assumption here
-    sense_string = sense_string.upper()
-
-    # Finds the candidate nucleotide reads
-    nucl_A, nucl_C, nucl_T, nucl_G = 0, 0, 0, 0
-    nucl_changes = {"A": 0, "C": 0, "G": 0, "T": 0}
-
-    for nucl in list(sense_string):
-        if (nucl == 'A' or nucl == 'C' or nucl == 'G' or nucl == 'T'):
-            nucl_changes[nucl] = nucl_changes[nucl] + 1
-        else:
-            continue
-    # get the maximal nucleous change, key is the value of the dict
-    (candidate_nucl, candidate_nucl_reads) = max(nucl_changes.items(), key=lambda x: x[1])
+    # a single scan of the reads string gives the candidate nucleotide, editing percent and noise percent
+    stats = site_editing_stats(pileup_line)
+    is_editing = is_editing_site(pileup_line, stats, read_thresh_hold, editing_min_percent_threshold,
+                                 editing_max_percent_threshold, noise_percent_threshold, editing_read_thresh)
 
-    if candidate_nucl_reads == 0:
-        editing_percent = 0.0
-        noise_percent = 0.0
-    else:
-        editing_percent = round(float(100 * (candidate_nucl_reads / pileup_line.base_count)), 3)
-        # Find the noise reads
-        # all ACTGs that are not candidate_nucl
-        noise_reads = 0
-
-        for nucl in list(pileup_line.reads_string.upper()):
-            if (nucl != candidate_nucl) and (nucl in ['A', 'C', 'T', 'G']):
-                noise_reads += 1
-        noise_percent = round(float(100 * (noise_reads / pileup_line.base_count)), 3)
-    if is_reads_threshold_match(pileup_line, read_thresh_hold) and (editing_percent >= editing_min_percent_threshold 
-        and editing_percent <= editing_max_percent_threshold) and (noise_percent <= noise_percent_threshold) and (
-        editing_percent is not 0.0) and (candidate_nucl_reads >= editing_read_thresh):
-        is_editing_site = True
-    else:
-        is_editing_site = False
-        '''
-        if (pileup_line._gene_pos == "10517276"):
-            print("pileupline",pileup_line, "read_thresh_hold",read_thresh_hold, "editing_percent",editing_percent, 
-                "noise_percent", noise_percent, "candidate_nucl_reads", candidate_nucl_reads)
-            print("editing_min_percent_threshold",editing_min_percent_threshold, "editing_max_percent_threshold",
-                    editing_max_percent_threshold, "noise_percent_threshold",noise_percent_threshold, "editing_read_thresh", editing_read_thresh)
-        '''
     # change pileup line
-    pileup_line.tags["editing_percent"] = str(editing_percent)
-    pileup_line.tags["noise_percent"] = str(noise_percent)
-    if (const_tag != '') and is_editing_site:
+    add_editing_tags(pileup_line, stats)
+    if (const_tag != '') and is_editing:
         pileup_line.tags["const_tag"] = const_tag
 
     # calculate editing type
-    if is_editing_site:
+    if is_editing:
         #TODO patch change to make sure we dont get lowercase reference or nucl change
-        editing_type = (pileup_line.reference.upper(), candidate_nucl.upper())
+        editing_type = (pileup_line.reference.upper(), stats[0].upper())
         #editing_type = (pileup_line.reference, candidate_nucl)
     else:
         editing_type = 'unchanged'
@@ -153,6 +146,98 @@ def filter_pileup_by_categories(pileup_filename, output, reads_threshold=None, a
                     out.write(str(line) + "\n")
 
 
+# a stage of filter_pileup_chain:
+# name - the name of the stage, output - the pileup the stage writes (and output + COUNT_SUFFIX its number of sites),
+# keep - keep(pileup_line, stats) is True for the lines that pass the stage (stats are the site_editing_stats of the
+# line, None if the stage doesn't need them), needs_stats - whether keep uses the stats (the editing tags are then
+# added to the line, like is_pileup_line_edited does), write - whether to write the output pileup or only the count
+FilterStage = namedtuple('FilterStage', ['name', 'output', 'keep', 'needs_stats', 'write'])
+
+FILTER_CHAIN_BATCH_LINES = 10000
+
+
+def any_change_stage(output, write=True, name="no_change"):
+    """
+    :return: FilterStage of the sites with any change (the any_change filter of filter_pileup_by_categories)
+    """
+    return FilterStage(name, output, lambda line, stats: is_editing_site(line, stats), True, write)
+
+
+def reads_threshold_stage(output, reads_threshold, write=True, name="read_threshold"):
+    """
+    :return: FilterStage of the sites with at least reads_threshold reads
+    """
+    return FilterStage(name, output, lambda line, stats: is_reads_threshold_match(line, reads_threshold), False, write)
+
+
+def editing_percent_stage(output, editing_min_percent=0., editing_max_percent=100, noise_percent=100,
+                          editing_read_thresh=0, write=True, name="editing_percent"):
+    """
+    :return: FilterStage of the editing sites by the thresholds of is_pileup_line_edited
+    """
+    def keep(line, stats):
+        return is_editing_site(line, stats, editing_min_percent_threshold=editing_min_percent,
+                               editing_max_percent_threshold=editing_max_percent,
+                               noise_percent_threshold=noise_percent, editing_read_thresh=editing_read_thresh)
+    return FilterStage(name, output, keep, True, write)
+
+
+def site_filter_stage(output, keep_site, name, write=True):
+    """
+    :param keep_site: keep_site(pileup_line) is True for the lines that pass the stage, it is called with the lines
+    in the order of the pileup (e.g. an IndexedSitesFilter)
+    :return: FilterStage of keep_site
+    """
+    return FilterStage(name, output, lambda line, stats: keep_site(line), False, write)
+
+
+def filter_pileup_chain(pileup_filename, stages):
+    """
+    filters a pileup by a chain of stages in a single pass: every stage filters the lines that passed the stages
+    before it, like running the stages one after the other on the output of the previous stage, but the pileup is
+    read and parsed once and the editing stats of a line are computed once for all the stages.
+    every stage writes its number of sites next to its output (see count_utils.get_site_count), and its output pileup
+    if its write is True
+    :param pileup_filename: pileup file path
+    :param stages: list of FilterStage
+    :return: list of the number of sites that passed each stage
+    """
+    counts = [0] * len(stages)
+    outputs = [open(stage.output, "w") if stage.write else None for stage in stages]
+    batches = [[] for _ in stages]
+    try:
+        with open(pileup_filename) as pileup:
+            for line in class_generator(Pileup_line, file=pileup):
+                stats = None
+                text = None
+                for index, stage in enumerate(stages):
+                    if stage.needs_stats and stats is None:
+                        stats = site_editing_stats(line)
+                        add_editing_tags(line, stats)
+                        text = None
+                    if not stage.keep(line, stats):
+                        break
+                    counts[index] += 1
+                    if outputs[index] is not None:
+                        if text is None:
+                            text = str(line) + "\n"
+                        batches[index].append(text)
+                        if len(batches[index]) >= FILTER_CHAIN_BATCH_LINES:
+                            outputs[index].writelines(batches[index])
+                            batches[index] = []
+        for output, batch in zip(outputs, batches):
+            if output is not None:
+                output.writelines(batch)
+    finally:
+        for output in outputs:
+            if output is not None:
+                output.close()
+
+    for stage, count in zip(stages, counts):
+        write_site_count(stage.output, count)
+    return counts
+
+
 def get_header_line(const_tag=''):
     if const_tag == '':
         optional_fields_list = ['editing_min_percent', 'noise_percent']
@@ -298,7 +383,7 @@ def summary_format(summary_dict):
 
 def analyse_multiple_editing_percent_files(pileup_files, out_pileups, summary_files,total_summary_file=None, add_headers=False,
                                            summary_only=False, min_editing=0.0, max_editing=100.0, max_noise=100.0, min_reads=1,
-                                           edit_tag=None, parallel_limit=2,Disable_parallel=True ):
+                                           edit_tag=None, parallel_limit=2,Disable_parallel=True, executor=None):
     """
     analyses pileup file and summarises it
     :param pileup_files: list of pileup_files
@@ -313,6 +398,7 @@ def analyse_multiple_editing_percent_files(pileup_files, out_pileups, summary_fi
     :param edit_tag: tag to add to sites that are classified as editing sites
     :param parallel_limit: cap on number of parallel processes to run (passes to parallel_commands)
     :param Disable_parallel: Bool wether to do processes one by one or run in parallel (passes to parallel_commands)
+    :param executor: the executor of parallel_commands (inline, thread or process)
     :return:
     """
 
@@ -326,7 +412,7 @@ def analyse_multiple_editing_percent_files(pileup_files, out_pileups, summary_fi
         commands.append(command)
 
     # run parallel editing percent + summary printing for the pileup files
-    parallel_commands(commands,parallel_limit=parallel_limit,Disable_parallel=Disable_parallel)
+    parallel_commands(commands,parallel_limit=parallel_limit,Disable_parallel=Disable_parallel,executor=executor)
 
 
     # if total summary was requested,
@@ -6,10 +6,7 @@ Usage:
 Options:
     -FASTA_FILENAME fasta filename
 """
-from numba.roc.hsaimpl import lower
-
 from Utility.generators_utilities import class_generator
-from Utility.parallel_generator import parallel_generator
 import subprocess
 from Utility.Fastq_class import Fastq
 from Utility.Samfile_class import SamLine
@@ -17,28 +14,33 @@ import re
 from Processing import sam_sorting
 from docopt import docopt
 import itertools
-from Utility.multiline_sort import multiline_sort
+import functools
+import collections
+import multiprocessing
+from Utility.fastq_index import FastqIndex, fastq_read_id
 import logging
 import os
 import shutil
 import sys
 
-def pre(fasta_file,fastq_file,out_fasta_file,out_fastq_file, nt_replacement):
+def pre(fasta_file,fastq_file,out_fasta_file,out_fastq_file, nt_replacement, processes=1):
     if type(nt_replacement) is list:
         nt_replacement = "".join(nt_replacement)
         
-    if fasta_file == out_fasta_file:
+    if fasta_file is None:
+        fasta_nt = None
+    elif fasta_file == out_fasta_file:
         fasta_file_temp = fasta_file + "_temp_copy.fasta"
         shutil.copyfile(fasta_file, fasta_file_temp)
-        fasta_nt = fasta_to_3nt(nt_replacement, fasta_file_temp,output_file=out_fasta_file)
+        fasta_nt = fasta_to_3nt(nt_replacement, fasta_file_temp,output_file=out_fasta_file,processes=processes)
         os.remove(fasta_file_temp)
     else:
-        fasta_nt = fasta_to_3nt(nt_replacement, fasta_file,output_file=out_fasta_file)
+        fasta_nt = fasta_to_3nt(nt_replacement, fasta_file,output_file=out_fasta_file,processes=processes)
 
     #logging.info(f"==exec==\nmultiline_to_3nt({2},{'~'}, {nt_replacement}, {fasta_file},output_file={out_fasta_file})")
     #logging.info(f"==exec==\nmultiline_to_3nt({2},chr(127), {nt_replacement}, {fastq_file},output_file={out_fastq_file})")
     if fastq_file is not None:
-        fastq_nt = multiline_to_3nt(4, chr(127), 2, nt_replacement, fastq_file , output_file=out_fastq_file)
+        fastq_nt = multiline_to_3nt(4, chr(127), 2, nt_replacement, fastq_file , output_file=out_fastq_file, processes=processes)
     else:
         fastq_nt = None
 
@@ -56,141 +58,291 @@ def post(fastq_file, sam_file, out_fastq_file, out_sam_file, **kwargs):
     return fastq_ntr, sam_ntr
 
 
+# number of reads looked up together in the index of the original library
+LOOKUP_BATCH_SIZE = 100000
+# approximated number of bytes in a chunk of records of the transcoders
+TRANSCODE_CHUNK_SIZE = 16 * 1024 * 1024
+# first characters of the fasta lines that are converted to 3nt
+SEQUENCE_LINE_START = b"NAGCTnagct"
+COMPLEMENT_TABLE = bytes.maketrans(b'ACGTNacgtn', b'TGCANtgcan')
+
 # nt_pairings = {'AG': 'A', 'GA': 'A', 'CTU': 'U', 'AC': 'C', 'CA': 'C', 'CG': 'G', 'GC': 'G'}
 nt_pairings = {"{x}{y}".format(x=x, y=y): min(x, y) for x, y in itertools.product("AGCT", repeat=2)}
 
 
-def fasta_to_3nt(nt_replacement, filename, output_file=None):
+def nt_translation_table(nt_replacement, lower_case=True):
+    '''
+    :param nt_replacement: nucleotides to combine (ex: 'AG', 'CT')
+    :param lower_case: also combine the lower case nucleotides (into the lower case nt_pairings nucleotide)
+    :return: bytes.translate table that combines the nucleotides into their nt_pairings nucleotide
+    '''
+    replacement = nt_pairings[nt_replacement]
+    source = nt_replacement
+    target = replacement * len(nt_replacement)
+    if lower_case:
+        source += nt_replacement.lower()
+        target += replacement.lower() * len(nt_replacement)
+    return bytes.maketrans(source.encode(), target.encode())
+
+
+def _is_blank_line(line):
+    # same lines as sed -r '/^[ \t]*$/d' deletes
+    return line.rstrip(b'\n').strip(b' \t') == b''
+
+
+def record_chunks(fp, number_of_lines=1, chunk_size=TRANSCODE_CHUNK_SIZE, keep_blank_lines=False):
+    '''
+    reads a multiline format file in chunks of whole records, blank lines are dropped
+    :param fp: file opened in binary mode
+    :param number_of_lines: number of lines in each entry
+    :param chunk_size: approximated number of bytes in a chunk
+    :param keep_blank_lines: keep the blank lines (e.g. the sequence of an empty read), except the blank lines after
+    the last record
+    :return: yields lists of lines (bytes, each ending with a newline), a multiple of number_of_lines except maybe the last
+    '''
+    leftover = []
+    next_lines = fp.readlines(chunk_size)
+    while True:
+        lines = next_lines
+        if not lines:
+            break
+        next_lines = fp.readlines(chunk_size)
+        if not lines[-1].endswith(b'\n'):
+            lines[-1] += b'\n'
+        if not keep_blank_lines:
+            lines = leftover + [line for line in lines if not _is_blank_line(line)]
+        else:
+            lines = leftover + lines
+            if not next_lines:
+                # the blank lines after the last record, a blank last line of a record is kept
+                trailing = 0
+                while trailing < len(lines) and _is_blank_line(lines[len(lines) - 1 - trailing]):
+                    trailing += 1
+                trailing -= (trailing - len(lines)) % number_of_lines
+                lines = lines[:len(lines) - trailing]
+        split = len(lines) - len(lines) % number_of_lines
+        leftover = lines[split:]
+        if split > 0:
+            yield lines[:split]
+    if leftover:
+        yield leftover
+
+
+def transformed_chunks(filename, transform, number_of_lines=1, processes=1, chunk_size=TRANSCODE_CHUNK_SIZE,
+                       keep_blank_lines=False):
+    '''
+    applies transform to the record chunks of a file (see record_chunks), in order
+    :param filename: multiline format file
+    :param transform: function from a list of lines to bytes, must be picklable if processes > 1
+    :param number_of_lines: number of lines in each entry
+    :param processes: number of processes transforming chunks in parallel
+    :param chunk_size: approximated number of bytes in a chunk
+    :param keep_blank_lines: see record_chunks
+    :return: yields the transformed chunks (bytes)
+    '''
+    with open(filename, 'rb') as fp:
+        chunks = record_chunks(fp, number_of_lines, chunk_size, keep_blank_lines)
+        if processes <= 1:
+            for chunk in chunks:
+                yield transform(chunk)
+            return
+
+        with multiprocessing.Pool(processes) as pool:
+            # at most 2 chunks per process are read ahead
+            pending = collections.deque()
+            for chunk in chunks:
+                pending.append(pool.apply_async(transform, (chunk,)))
+                if len(pending) >= 2 * processes:
+                    yield pending.popleft().get()
+            while pending:
+                yield pending.popleft().get()
+
+
+def write_chunks(chunks, output_file):
+    with open(output_file, 'wb') as out:
+        for chunk in chunks:
+            out.write(chunk)
+    return output_file
+
+
+def _fasta_lines_to_3nt(table, lines):
+    # only sequence lines are combined, like sed '/^[NAGCTnagct]/s/...'
+    return b''.join(line.translate(table) if line[:1] in SEQUENCE_LINE_START else line for line in lines)
+
+
+def _multiline_lines_to_3nt(table, number_of_lines, sequence_line, lines):
+    # the sequence line is upper cased and combined, like the awk toupper and gsub
+    for index in range(sequence_line - 1, len(lines), number_of_lines):
+        lines[index] = lines[index].upper().translate(table)
+    return b''.join(lines)
+
+
+def iter_fasta_3nt(nt_replacement, filename, processes=1, chunk_size=TRANSCODE_CHUNK_SIZE):
+    '''
+    streaming version of fasta_to_3nt
+    :return: yields chunks (bytes) of the 3nt fasta
+    '''
+    if type(nt_replacement) is list:
+        nt_replacement = "".join(nt_replacement)
+    transform = functools.partial(_fasta_lines_to_3nt, nt_translation_table(nt_replacement))
+    yield from transformed_chunks(filename, transform, 1, processes, chunk_size)
+
+
+def iter_multiline_3nt(number_of_lines, sequence_line, nt_replacement, multi_filename, processes=1,
+                       chunk_size=TRANSCODE_CHUNK_SIZE):
+    '''
+    streaming version of multiline_to_3nt
+    :return: yields chunks (bytes) of the 3nt file, each chunk holds whole records
+    '''
+    if type(nt_replacement) is list:
+        nt_replacement = "".join(nt_replacement)
+    transform = functools.partial(_multiline_lines_to_3nt, nt_translation_table(nt_replacement, lower_case=False),
+                                  number_of_lines, sequence_line)
+    yield from transformed_chunks(multi_filename, transform, number_of_lines, processes, chunk_size)
+
+
+def fasta_to_3nt(nt_replacement, filename, output_file=None, processes=1):
     '''
     alternative function to multiline_to_3nt for fasta files with multiple lines for the sequence, instead of a single
-    line with the entire sequence
+    line with the entire sequence.
+    blank lines are removed and in every line that starts with a nucleotide (NAGCTnagct) the nucleotides of
+    nt_replacement are combined, keeping their case
     :param nt_replacement: nucleotides to combine (ex: 'AG', 'CT')
     :param filename: filename for the input
     :param output_file: filename for the output, if desired
+    :param processes: number of processes converting chunks of the file in parallel
     :return: output filename
     '''
     if output_file is None:
         splited = filename.split(".")
         output_file = ".".join(splited[:-1])+"_nt."+splited[-1]
-    with open(filename, 'r'), open(output_file, 'w'):
-        # TODO: does case matter?
-        #if type(nt_replacement) is list:
-            #nt_replacement = "".join(nt_replacement)
-        #lower_case_nt = nt_replacement.lower()
-        lower_case_replacement = nt_pairings[nt_replacement].lower()
-        #print(lower_case_replacement)
-        command = f"cat {filename} | sed -r '/^[ \t]*$/d' | sed '/^[NAGCTnagct]/s/[{nt_replacement}]/{nt_pairings[nt_replacement]}/g' "\
-            f" | sed '/^[NAGCTnagct]/s/{[nt_replacement.lower()]}/{lower_case_replacement}/g' > {output_file} "
-        #command = f"cat {filename} | sed -r '/^[ \t]*$/d' | sed '/[AGCTagct]*/s/[{nt_replacement}]/{nt_pairings[nt_replacement]}/ig' > {output_file} "
-        #^ also works
-        # print(command)
-        try:
-            subprocess.run(command, shell=True)
-        except Exception as e:
-            raise e
-    return output_file
+    return write_chunks(iter_fasta_3nt(nt_replacement, filename, processes), output_file)
 
 
-def multiline_to_3nt(number_of_lines, new_delim, sequence_line, nt_replacement, multi_filename=None, output_file=None):
+def multiline_to_3nt(number_of_lines, new_delim, sequence_line, nt_replacement, multi_filename=None, output_file=None,
+                     processes=1):
     '''
-
+    blank lines are removed and the sequence line of every entry is upper cased and its nucleotides of nt_replacement
+    are combined
     :param number_of_lines: number of lines in each entry
-    :param new_delim: any character that is not within the alphabet of possible characters that are used in the format
+    :param new_delim: not used, kept for compatibility (was the delimiter of the joined lines of the shell pipeline)
     :param sequence_line: the number of the line containing the sequence to be modified
     :param nt_replacement: the nucleotides to be combined
     :param multi_filename: name of the file containing the data
     :param output_file: optional filename to write output to. if not specified output goes to input filename with .nt extension
+    :param processes: number of processes converting chunks of the file in parallel
     :return:
     '''
 
     if output_file is None:
         splited = multi_filename.split(".")
         output_file = ".".join(splited[:-1])+"_nt."+splited[-1]
-    with open(multi_filename, 'r'), open(output_file, 'w'):
-        # TODO: does case matter?
-        if type(nt_replacement) is list:
-            nt_replacement = "".join(nt_replacement)
-        #command = f"cat {multi_filename} | sed -r '/^[ \t]*$/d' |paste -d \"{new_delim}\" {' -'*int(number_of_lines)} \
-        #| awk -F{new_delim} 'BEGIN {{OFS = \"{new_delim}\"}}; {{gsub(/[{nt_replacement}]/,\"{nt_pairings[nt_replacement]}\",${sequence_line})}};{{print}};'\
-        #| sed 's/{1}/\\n/g' > {output_file} "
-        #| awk -F{new_delim} 'BEGIN {{OFS = \"{new_delim}\"}}; {{gsub(/[tolower({nt_replacement})]/,tolower(\"{nt_pairings[nt_replacement]}\"),${sequence_line})}};{{print}}' \
-        
-        
-        #OLD command with number variable replacement rather than format string replacement.
-        command = "cat {0} | sed -r '/^[ \t]*$/d' |paste -d \"{1}\" {2}\
-        | awk -F{1} 'BEGIN {{OFS = \"{1}\"}}; {{${5} = toupper(${5}); gsub(/[{3}]/,\"{4}\",${5})}};{{print}}' |" \
-            "sed 's/{1}/\\n/g' > {6} ".format(multi_filename, new_delim, ' -'*int(number_of_lines), nt_replacement, nt_pairings[nt_replacement], sequence_line, output_file)
-        # print(command)
-        
-        #bash command for fastqs, AT/at to A/a
-        #"cat smallseq.fastq | sed -r '/^[ \t]*$/d' |paste -d "~" - - - -| awk -F~ 'BEGIN {OFS="~"};{gsub(/[AT]/,"A",$2);gsub(/[at]/,"a",$2)};{print}' | sed 's/~/\n/g' >smallseq.nt.fastq"
-        
-        try:
-            subprocess.run(command, shell=True)
-        except Exception as e:
-            raise e
-    return output_file
+    chunks = iter_multiline_3nt(number_of_lines, sequence_line, nt_replacement, multi_filename, processes)
+    return write_chunks(chunks, output_file)
 
 
 
 def revert_fastq_to_4nt(fastq_3nt_filename, fastq_4nt_filename, output_filename=None):
     '''
-
+    replaces the sequence of every read of the 3nt fastq with its sequence in the original library.
+    the original library is looked up by read id in its index (see Utility.fastq_index), so no sorting is needed
+    and the output keeps the order of the 3nt fastq
     :param fastq_3nt_filename: negative reads from alignment of 3nt fastq library
     :param fastq_4nt_filename: original 4nt fastq library
     :param output_filename:
     :return:
     '''
-    sorted_fastq_3nt = multiline_sort(4,'~',1, fastq_3nt_filename)
-    sorted_fastq_4nt = multiline_sort(4,'~',1, fastq_4nt_filename)
     if output_filename is None:
         splited = fastq_3nt_filename.split(".")
         output_filename = ".".join(splited[:-1]) + "_ntR." + splited[-1]
 
-    with open(sorted_fastq_3nt, 'r') as fastq_3nt, open(sorted_fastq_4nt, 'r') as fastq_4nt:
+    with open(fastq_3nt_filename, 'r') as fastq_3nt, FastqIndex(fastq_4nt_filename) as library_index, \
+            open(output_filename, 'w') as out:
         gen_3nt = class_generator(Fastq, file = fastq_3nt, number_of_lines=4)
-        gen_4nt = class_generator(Fastq, file = fastq_4nt, number_of_lines=4)
-        get_fastq_id = lambda fq: fq.strings[0]
-        with open(output_filename, 'w') as out:
-            p_gen = parallel_generator([gen_3nt, gen_4nt], [get_fastq_id, get_fastq_id])
-            for [fq_3, fq_4] in p_gen:
-                if (fq_3 is not None) and (fq_4 is not None):
-                    fq_3[0].strings[1] = fq_4[0].strings[1]
-                    out.write(re.sub('\n\n', '\n',str(fq_3[0])))
+        get_fastq_id = lambda fq: fastq_read_id(fq.strings[0])
+        for fq_3_batch, fq_4_batch in lookup_batches(gen_3nt, get_fastq_id, library_index):
+            for fq_3, fq_4 in zip(fq_3_batch, fq_4_batch):
+                if fq_4 is not None:
+                    fq_3.strings[1] = fq_4[1]
+                    out.write(re.sub('\n\n', '\n',str(fq_3)))
 
     return output_filename
-    
-   
-def reverse_multiline(number_of_lines, new_delim, sequence_line, multi_filename, output_file=None):
+
+
+def lookup_batches(gen, get_id, library_index, batch_size=LOOKUP_BATCH_SIZE):
     '''
+    :param gen: generator of objects to look up in the library
+    :param get_id: functor returning the read id of an object
+    :param library_index: FastqIndex of the library
+    :param batch_size: number of objects looked up together
+    :return: yields (objects, library records) batches, a record is None if the read id is not in the library
+    '''
+    while True:
+        batch = list(itertools.islice(gen, batch_size))
+        if not batch:
+            return
+        yield batch, library_index.get_many([get_id(obj) for obj in batch])
+
+
+def _reverse_lines(table, number_of_lines, reversed_lines, lines):
+    # reverses (and complements if table is not None) the reversed_lines of every entry
+    for line_number in reversed_lines:
+        for index in range(line_number - 1, len(lines), number_of_lines):
+            line = lines[index][-2::-1]
+            if table is not None and line_number == reversed_lines[0]:
+                line = line.translate(table)
+            lines[index] = line + b'\n'
+    return b''.join(lines)
+
+
+def iter_reverse_multiline(number_of_lines, sequence_line, multi_filename, quality_line=None, complement=False,
+                           processes=1, chunk_size=TRANSCODE_CHUNK_SIZE):
+    '''
+    streaming version of reverse_multiline
+    :return: yields chunks (bytes) of the reversed file, each chunk holds whole records
+    '''
+    reversed_lines = [sequence_line] if quality_line is None else [sequence_line, quality_line]
+    table = COMPLEMENT_TABLE if complement else None
+    transform = functools.partial(_reverse_lines, table, number_of_lines, reversed_lines)
+    yield from transformed_chunks(multi_filename, transform, number_of_lines, processes, chunk_size)
+
 
+def reverse_multiline(number_of_lines, new_delim, sequence_line, multi_filename, output_file=None, quality_line=None,
+                      complement=False, processes=1):
+    '''
+    reverses the sequence line of every entry of a multiline format file (blank lines are removed).
+    for fastq (4 lines in each entry) the quality line (2 lines after the sequence) is reversed as well,
+    so the qualities stay aligned with their nucleotides
     :param number_of_lines: number of lines in each entry
-    :param new_delim: any character that is not within the alphabet of possible characters that are used in the format
+    :param new_delim: not used, kept for compatibility (was the delimiter of the joined lines of the shell pipeline)
     :param sequence_line: the number of the line containing the sequence to be modified
-    :param nt_replacement: the nucleotides to be combined
     :param multi_filename: name of the file containing the data
     :param output_file: optional filename to write output to. if not specified output goes to input filename with .nt extension
+    :param quality_line: the number of the quality line to reverse, by default sequence_line + 2 for 4 lines entries
+    :param complement: also complement the sequence (reverse complement)
+    :param processes: number of processes reversing chunks of the file in parallel
     :return:
     '''
 
     if output_file is None:
         splited = multi_filename.split(".")
         output_file = ".".join(splited[:-1])+"_nt."+splited[-1]
-    with open(multi_filename, 'r'), open(output_file, 'w'):
-        #OLD command with number variable replacement rather than format string replacement.
-        command = "cat {0} | sed -r '/^[ \t]*$/d' |paste -d \"{1}\" {2}\
-        | awk -F{1} 'BEGIN {{OFS = \"{1}\"}};{{cmd=\"echo \"${3}\" | rev\"; cmd | getline reversed_line ; close(cmd) ;gsub(${3},reversed_line,${3})}};{{print}}' |" \
-            "sed 's/{1}/\\n/g' > {4} ".format(multi_filename, new_delim, ' -'*int(number_of_lines), sequence_line, output_file)
-        # print(command)
-        
-        #bash command for fastqs, AT/at to A/a
-        #"cat smallseq.fastq | sed -r '/^[ \t]*$/d' |paste -d "~" - - - -| awk -F~ 'BEGIN {OFS="~"};{gsub(/[AT]/,"A",$2);gsub(/[at]/,"a",$2)};{print}' | sed 's/~/\n/g' >smallseq.nt.fastq"
-        
-        try:
-            subprocess.run(command, shell=True)
-        except Exception as e:
-            raise e
-    return output_file
+    if quality_line is None and number_of_lines == 4:
+        quality_line = sequence_line + 2
+    chunks = iter_reverse_multiline(number_of_lines, sequence_line, multi_filename, quality_line, complement, processes)
+    return write_chunks(chunks, output_file)
+
+
+def reverse_complement_multiline(number_of_lines, sequence_line, multi_filename, output_file=None, quality_line=None,
+                                 processes=1):
+    '''
+    reverse complements the sequence line of every entry of a multiline format file, see reverse_multiline
+    '''
+    if output_file is None:
+        splited = multi_filename.split(".")
+        output_file = ".".join(splited[:-1])+"_rc."+splited[-1]
+    return reverse_multiline(number_of_lines, None, sequence_line, multi_filename, output_file, quality_line,
+                             complement=True, processes=processes)
 
 def complement_multiline(number_of_lines, new_delim, sequence_line, multi_filename, output_filename=None):
     '''
@@ -284,10 +436,14 @@ def sort_sam_alphabetic(samfile):
 
 def revert_sam_to_4nt(aligned_3nt_sam_filename, output_filename=None, sorted=False, **kwargs):
     '''
+    replaces the sequence of every sam line with the sequence of its read in the original library.
+    the original library is looked up by read id in its index (see Utility.fastq_index), so no sorting is needed
+    and the output keeps the order of the sam file
 
     :param aligned_3nt_sam_filename: filename of sam format file, which should contain sam lines that correspond to
     a library of reads in fastq format to revert the sam file according to.
     :param output_filename: filename to write output to
+    :param sorted: not used, kept for compatibility (the inputs don't need to be sorted)
     :param kwargs: fastq_lib: the original library of sequence reads that was used to align the sam file
     :return: None, in case of error
     '''
@@ -299,41 +455,30 @@ def revert_sam_to_4nt(aligned_3nt_sam_filename, output_filename=None, sorted=Fal
         output_filename = ".".join(splited[:-1]) + "_ntR." + splited[-1]
 
     sequence_library_filename = kwargs['fastq_lib']
-    if not sorted:
-        #sort library of fastq reads according to sequence id
-        sorted_lib_filename = multiline_sort(4, "~", 1, sequence_library_filename)
+    sam_filename = aligned_3nt_sam_filename
 
-        #sort sam file according to query sequence id
-        sorted_sam_filename = sort_sam_alphabetic(aligned_3nt_sam_filename)
-    else:
-        sorted_lib_filename = sequence_library_filename
-        sorted_sam_filename = aligned_3nt_sam_filename
-    
     #create temp file to avoid overwriting input with output if same input and output filenames
     if output_filename == aligned_3nt_sam_filename:
-        temp_name=sorted_sam_filename+"temp_copy"
-        shutil.copyfile(sorted_sam_filename, temp_name)
-        sorted_sam_filename = temp_name
-    
+        temp_name=sam_filename+"temp_copy"
+        shutil.copyfile(sam_filename, temp_name)
+        sam_filename = temp_name
+
     #add the header lines
-    with open(sorted_sam_filename, 'r') as sam_file, open(output_filename, 'w') as out:
+    with open(sam_filename, 'r') as sam_file, open(output_filename, 'w') as out:
         header_gen = class_generator(str, skip_condition = (lambda line: line[0]!='@'), file=sam_file)
         for line in header_gen:
             out.write(str(line))
     #add the reverted sam lines
-    with open(sorted_sam_filename, 'r') as sam_file, open(sorted_lib_filename, 'r') as lib_file, open(output_filename, 'a') as out:
+    with open(sam_filename, 'r') as sam_file, FastqIndex(sequence_library_filename) as library_index, \
+            open(output_filename, 'a') as out:
         aligned_3nt_gen = class_generator(SamLine, skip_condition = (lambda line: line[0]=='@'), file = sam_file)
-        seq_library_gen = class_generator(Fastq, file = lib_file, number_of_lines=4)
 
         #TODO: update functors when fastq_class/samfile_class are updated
         get_sam_qname = lambda x: x.seq_id.split(" ")[0]
-        get_fastq_id = lambda x: x.strings[0][1:].split(" ")[0]
-        p_gen = parallel_generator([aligned_3nt_gen, seq_library_gen], [get_sam_qname, get_fastq_id])
-        for [samlines, fastq_entry] in p_gen:
-            #print("samlines: ",samlines,"fastq_entry: ",fastq_entry)
-            if (samlines is not None and fastq_entry is not None):
-                for samline in samlines:
-                    reverted_samline = revert_samline_to_4nt(samline, fastq_entry[0])
+        for samlines, fastq_entries in lookup_batches(aligned_3nt_gen, get_sam_qname, library_index):
+            for samline, fastq_entry in zip(samlines, fastq_entries):
+                if fastq_entry is not None:
+                    reverted_samline = revert_samline_to_4nt(samline, Fastq(fastq_entry))
                     out.write(str(reverted_samline) + "\n")
     if output_filename == aligned_3nt_sam_filename:
         os.remove(temp_name)
@@ -4,7 +4,7 @@ import subprocess
 from Utility.parallel_generator import parallel_generator
 from Utility.generators_utilities import class_generator
 from Utility.Fastq_class import Fastq
-import multiprocessing
+import functools
 import itertools
 import os
 import re
@@ -14,6 +14,8 @@ from contextlib import nullcontext
 from Experiments.forontiers_jupyter.directory_structure_definer import DirectoryStructure ,Stages,AlignStage
 from Experiments.forontiers_jupyter.aligner_wrapper import AlignerWrapper
 from Processing.genome_3nt import complement_multiline, flip_sam_flags, reverse_multiline
+from Processing.reference_store import ReferenceStore, ANTISENSE
+from Utility.dag_scheduler import DagScheduler, run_in_process
 
 Fathers_list = List[str]
 Specifications = namedtuple('Specifications', ['id', 'flags', 'pre_function', 'post_function'])
@@ -23,51 +25,128 @@ Dict_specifications = Dict[Specifications, Fathers_list]
 bowtie_wrapper = AlignerWrapper("bowtie {flags} --sam {reference_file} {lib} {positive_alignment} --un {negative_library} >> {log}.bowtie 2>&1", "bowtie-build {reference} {reference} {flags}",
                                 index_output_format_list=["{reference_file}"+suff for suff in [".1.ebwt",".2.ebwt",".3.ebwt",".4.ebwt",".rev.1.ebwt",".rev.2.ebwt"]])
 
+# the aligner flag of the number of threads (bowtie -p / --threads)
+THREADS_FLAG_PATTERN = re.compile(r"(?<!\S)(-p|--threads)(\s+|=)(\d+)(?!\S)")
 
-def do_include_exclude_alignment(fastq_file: str, fasta_file: str, dict_data, dict_graph,
-                                 dir_struct:DirectoryStructure, aligner:AlignerWrapper, skip_existing_files=False):
-    # gaol:Combines dict_data and dict_graph information into one dict
-    # from dict_data(spec_dict from the main tool): key and value are given now as the key with fields under
-    # "Specifications" 
-    # from dict_graph: the value will be the value in the new dict
+
+def flags_threads(flags):
+    """
+    :param flags: aligner flags string
+    :return: the number of threads given by the -p flag, 1 if there is none
+    """
+    match = THREADS_FLAG_PATTERN.search(flags or '')
+    return int(match.group(3)) if match is not None else 1
+
+
+def flags_with_threads(flags, threads):
+    """
+    :return: flags with the number of threads of the -p flag replaced by threads (flags without -p are returned as is)
+    """
+    return THREADS_FLAG_PATTERN.sub(lambda match: f"{match.group(1)}{match.group(2)}{threads}", flags or '')
+
+
+def specifications_dict(dict_data, dict_graph):
+    """
+    Combines dict_data and dict_graph information into one dict
+    :param dict_data: spec_dict from the main tool, the step id to its (flags, pre function, post function)
+    :param dict_graph: the step id to the ids of its fathers
+    :return: Dict_specifications, the key is the step fields as "Specifications" and the value is its fathers
+    """
     spec_dict = dict()
     for id1 in dict_graph.keys():
         spec_dict[Specifications(id1, dict_data[id1][0], dict_data[id1][1], dict_data[id1][2])] = dict_graph[id1]
+    return spec_dict
+
+
+def do_include_exclude_alignment(fastq_file: str, fasta_file: str, dict_data, dict_graph,
+                                 dir_struct:DirectoryStructure, aligner:AlignerWrapper, skip_existing_files=False,
+                                 reference_store:ReferenceStore=None, cpu_budget=None, memory_budget=None,
+                                 memory_hints=None):
+    spec_dict = specifications_dict(dict_data, dict_graph)
+    return include_exclude_alignment(fastq_file, fasta_file, spec_dict, dir_struct=dir_struct,aligner=aligner, skip_existing_files=skip_existing_files,
+                              reference_store=reference_store, cpu_budget=cpu_budget, memory_budget=memory_budget,
+                              memory_hints=memory_hints)
+
+
+def do_include_exclude_alignment_libraries(fastq_files, fasta_file: str, dict_data, dict_graph,
+                                           dir_struct:DirectoryStructure, aligner:AlignerWrapper,
+                                           skip_existing_files=False, reference_store:ReferenceStore=None,
+                                           cpu_budget=None, memory_budget=None, memory_hints=None, step_costs=None):
+    spec_dict = specifications_dict(dict_data, dict_graph)
+    return include_exclude_alignment_libraries(fastq_files, fasta_file, spec_dict, dir_struct=dir_struct,
+                                               aligner=aligner, skip_existing_files=skip_existing_files,
+                                               reference_store=reference_store, cpu_budget=cpu_budget,
+                                               memory_budget=memory_budget, memory_hints=memory_hints,
+                                               step_costs=step_costs)
 
-    include_exclude_alignment(fastq_file, fasta_file, spec_dict, dir_struct=dir_struct,aligner=aligner, skip_existing_files=skip_existing_files)
 
 def include_exclude_alignment(fastq_file: str, fasta_file: str, dict_spec: Dict_specifications,
-                                 dir_struct:DirectoryStructure, aligner:AlignerWrapper, skip_existing_files=False):
+                                 dir_struct:DirectoryStructure, aligner:AlignerWrapper, skip_existing_files=False,
+                                 reference_store:ReferenceStore=None, cpu_budget=None, memory_budget=None,
+                                 memory_hints=None):
     """
 
     :param fastq_file: the path to the fastq file we want to work on
     :param fasta_file: the path to the fasta file we want to work on
     :param dict_spec: a dict which its values are named tuples that each tuple contains an id string, a string of flags
     , a pre processing function and a post processing function . and its values are the id of the stage dependencies (fathers)
-    :param action_func: this is the main action function we want our file to go through (after the pre-processing func
-    and before the post processing func
     :param dir_struct : a DirectorySturcture objects that gives the correct paths to give to files
+    :param reference_store: optional ReferenceStore, the derived references and their indexes are taken from it
+    (and built once for all the libraries and nodes) instead of being built per library and node
+    :param cpu_budget: number of cpus all the steps running together may use (default: all the cpus).
+    each step reserves the number of threads of the -p flag of its aligner flags (at most cpu_budget, its -p is
+    lowered to the reservation), and waits until it fits in the budget
+    :param memory_budget: bytes of memory all the steps running together may use (default: no limit)
+    :param memory_hints: dict of step id to the bytes of memory its alignment needs (steps not in it reserve 0)
     :return: the name of the last fastq file created in the graph (the non - aligned sequances of the last graph step)
     """
+    return include_exclude_alignment_libraries([fastq_file], fasta_file, dict_spec, dir_struct, aligner,
+                                               skip_existing_files=skip_existing_files, reference_store=reference_store,
+                                               cpu_budget=cpu_budget, memory_budget=memory_budget,
+                                               memory_hints=memory_hints)[fastq_file]
 
-    # sending a thread for each vertex in "tree"
-    threads = []
-    thread_tree = Utility.threading_tree_utils.ThreadingTree(dict_spec)
-    #thread_tree: the key is the information for each editing type (ID), the valuse is the thread for each vertex
-    for spec, _ in dict_spec.items():
-        t = multiprocessing.Process(target=do_pre_align_post, args=(fastq_file, fasta_file, spec.id, thread_tree, aligner,
-                                                             dir_struct, skip_existing_files))
-        t.start()
-        threads.append(t)
-
-    for thread in threads:
-        thread.join()
 
-    return thread_tree.get_filenames_of_leafs()
+def include_exclude_alignment_libraries(fastq_files, fasta_file: str, dict_spec: Dict_specifications,
+                                        dir_struct:DirectoryStructure, aligner:AlignerWrapper,
+                                        skip_existing_files=False, reference_store:ReferenceStore=None,
+                                        cpu_budget=None, memory_budget=None, memory_hints=None, step_costs=None):
+    """
+    runs the alignment graph of all the libraries as one DAG of (library, step id) nodes, so the steps of different
+    libraries share the cpu budget instead of every library waiting for the slowest step of the previous one.
+    ready steps on the longest remaining chain (e.g. norep -> rep -> hyper steps) start first.
+
+    :param fastq_files: the paths of the fastq files (libraries) we want to work on
+    :param step_costs: dict of step id to its relative running time, used to find the critical path (default 1)
+    the other parameters are those of include_exclude_alignment, and apply to every library
+    :return: dict of fastq file to the names of the last fastq files created in its graph
+    """
+    memory_hints = memory_hints or dict()
+    step_costs = step_costs or dict()
+
+    # every vertex of every library "tree" is a node of the scheduler, started when its fathers are done and its
+    # resources fit. the trees raise a ValueError if the graph has unknown fathers or cycles
+    thread_trees = dict()
+    scheduler = DagScheduler(cpu_budget=cpu_budget, memory_budget=memory_budget)
+    for fastq_file in fastq_files:
+        if fastq_file in thread_trees:
+            continue
+        thread_tree = Utility.threading_tree_utils.ThreadingTree(dict_spec)
+        thread_trees[fastq_file] = thread_tree
+        for spec, fathers in dict_spec.items():
+            # the scheduler calls the step with the number of cpus it reserved, given as the threads argument
+            step = functools.partial(do_pre_align_post, fastq_file, fasta_file, spec.id, thread_tree, aligner,
+                                     dir_struct, skip_existing_files, reference_store)
+            scheduler.add_node((fastq_file, spec.id), step, dependencies=[(fastq_file, father) for father in fathers],
+                               cpus=flags_threads(spec.flags), memory=memory_hints.get(spec.id, 0))
+
+    scheduler.prioritize_critical_path({node_id: step_costs.get(node_id[1], 1) for node_id in scheduler.nodes})
+    scheduler.run()
+
+    return {fastq_file: thread_tree.get_filenames_of_leafs() for fastq_file, thread_tree in thread_trees.items()}
 
 
 def do_pre_align_post(fastq, fasta_file, id_step, tree_threads, aligner:AlignerWrapper, dirstruct:DirectoryStructure
-                      ,skip_existing_files=False):
+                      ,skip_existing_files=False, reference_store:ReferenceStore=None, threads=None):
     """
     :param fastq: the original fastq file name
     :param fasta_file: the fasta file name
@@ -77,6 +156,8 @@ def do_pre_align_post(fastq, fasta_file, id_step, tree_threads, aligner:AlignerW
     :param dirstruct: The Directory sturcture object that generates pathnames for this RESIK run
     :param skip_existing_files: Wether to use existing files instead of recomputing them.
         Used for manual failure recovery
+    :param reference_store: optional ReferenceStore of the derived references and indexes
+    :param threads: if given, the number of threads of the -p flag of the aligner flags is set to it
 
     :return: the name of the negative fastq file (the lines that didn't aligned)
     """
@@ -98,148 +179,183 @@ def do_pre_align_post(fastq, fasta_file, id_step, tree_threads, aligner:AlignerW
         logging.info(f" performing pre-align-post for file {fastq} stage {id_step}  based on {str(fastqs_list)}")
  
         _, spec = tree_threads.get_fathers_and_spec(id_step)
+        if threads is not None:
+            spec = spec._replace(flags=flags_with_threads(spec.flags, threads))
 
-        # if more than 1 father, have to merge them
-        if len(fastqs_list) > 1:
-            #TODO we need to be able to skip this if recover is true too
-            output=dirstruct.pathName(fastq,id_step,Stages.graph_aligner,AlignStage.in_fastq)
-            union_fastqs(fastqs_list, output)
-            in_fastq = output
-        # if only one input, take it
-        elif len(fastqs_list) == 1:
-            in_fastq = fastqs_list[0]
-        # if no input from graph we are a root node, in which case
-        # the original fastq is out input
-        else:
-            in_fastq = fastq
-
-        #set variable to true if on a hyper stage (e.g.: rep_hyper_A_C)
-        hyper = not (id_step == "rep" or id_step == "norep")
-            
-        # define file names
-        pre_fasta = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.pre_fasta) #reference file after converting to 3nt
-        pre_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.pre_fastq) #read library after converting to 3nt
-        aligned_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.aligned_sam) #aligned reads from alignment of pre_fastq to pre_fasta
-        misaligned_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.misaligned_fastq) #misaligned reads from alignment of antisense_fastq to antisense_fasta
-        post_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_sam) #aligned sam after reverting to 4nt
-        post_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_fastq) #misaligned fastq reads after reverting to 4nt
-        if hyper == True:
-            antisense_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_fastq)#antisense fastq, misaligned reads from alignment of pre_fastq to pre_fasta
-            antisense_fasta = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_fasta)#antisense fasta, with nts complemented(A->T, C->G, etc) then converted to 3nt
-            antisense_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_sam)#antisense sam, alignment of misaligned reads to antisense fasta, with 0 flags flipped to 16
-            antisense_post_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_post_sam)#antisense sam after post function
-            sense_filtered_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.sense_filtered_sam) #aligned sam after reverting to 4nt
-            antisense_flipped_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_flipped_sam)#antisense sam after flipping mapped reads to antisense reads (samline flags from 0 to 16)
-            antisense_filtered_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_filtered_sam)#antisense sam after flipping mapped reads to antisense reads (samline flags from 0 to 16)
-            sense_misaligned_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.sense_misaligned_fastq)#misaligned reads from sense alignment
-        #decide if any of the stages need skipping based on skip_exisitng_files
-
-        # if no pre function, give the naive pre function (identity pre) and no point in skipping
-        skip_pre = False
-        if spec.pre_function is None:
-            spec = spec._replace(pre_function = Naive_pre)
-        else:
-            # setting skip pre true only if skip exisiting file and aligned output exist
-            if os.path.isfile(pre_fasta) and os.path.isfile(pre_fastq):
-                if hyper: 
-                    if os.path.isfile(antisense_fasta):
-                        skip_pre = skip_existing_files
-                else:
-                    skip_pre = skip_existing_files
+        # the pre, align and post steps (3nt transcoding, antisense flipping, reverting to 4nt) run in a process of
+        # their own, so the python work of the steps that run together is not serialized by the GIL
+        post_fastq = run_in_process(pre_align_post, fastq, fasta_file, id_step, spec, fastqs_list, aligner, dirstruct,
+                                    skip_existing_files, reference_store, tree_threads.fasta_indexing_lock,
+                                    tree_threads.secondary_fasta_indexing_lock)
 
+        # letting tree threads now what the negative fastq of this step is
+        tree_threads.set_filename_of_finished_alignment(id_step, post_fastq)
 
-        # if no post function, give the naive pre function (identity pre) and no point in skipping
-        # if no post need to have the alinger stage output the post sam
-        skip_post=False
-        if spec.post_function is None:
-            spec = spec._replace(post_function = Naive_post)
-            aligned_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_sam)
-            misaligned_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_fastq)
-        else:
-            # setting skip post true only if skip exisiting file and post output exist
-            if os.path.isfile(post_sam) and os.path.isfile(post_fastq):
-                if hyper: 
-                    if os.path.isfile(antisense_sam) and os.path.isfile(antisense_post_sam):
-                        skip_post = skip_existing_files
-                else:
+        return
+
+
+def pre_align_post(fastq, fasta_file, id_step, spec, fastqs_list, aligner:AlignerWrapper,
+                   dirstruct:DirectoryStructure, skip_existing_files=False, reference_store:ReferenceStore=None,
+                   indexing_lock=nullcontext(), secondary_indexing_lock=nullcontext()):
+    """
+    the pre processing, alignment and post processing of a step (see do_pre_align_post)
+    :param spec: the Specifications of the step
+    :param fastqs_list: the negative fastqs of the fathers of the step (empty for a root step)
+    :param indexing_lock, secondary_indexing_lock: locks held while the aligner builds the sense / antisense index
+    (shared by the steps of a tree, e.g. multiprocessing locks)
+    :return: the name of the negative fastq file (the lines that didn't aligned)
+    """
+    # if more than 1 father, have to merge them
+    if len(fastqs_list) > 1:
+        #TODO we need to be able to skip this if recover is true too
+        output=dirstruct.pathName(fastq,id_step,Stages.graph_aligner,AlignStage.in_fastq)
+        union_fastqs(fastqs_list, output)
+        in_fastq = output
+    # if only one input, take it
+    elif len(fastqs_list) == 1:
+        in_fastq = fastqs_list[0]
+    # if no input from graph we are a root node, in which case
+    # the original fastq is out input
+    else:
+        in_fastq = fastq
+
+    #set variable to true if on a hyper stage (e.g.: rep_hyper_A_C)
+    hyper = not (id_step == "rep" or id_step == "norep")
+
+    # define file names
+    pre_fasta = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.pre_fasta) #reference file after converting to 3nt
+    pre_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.pre_fastq) #read library after converting to 3nt
+    aligned_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.aligned_sam) #aligned reads from alignment of pre_fastq to pre_fasta
+    misaligned_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.misaligned_fastq) #misaligned reads from alignment of antisense_fastq to antisense_fasta
+    post_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_sam) #aligned sam after reverting to 4nt
+    post_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_fastq) #misaligned fastq reads after reverting to 4nt
+    if hyper == True:
+        antisense_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_fastq)#antisense fastq, misaligned reads from alignment of pre_fastq to pre_fasta
+        antisense_fasta = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_fasta)#antisense fasta, with nts complemented(A->T, C->G, etc) then converted to 3nt
+        antisense_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_sam)#antisense sam, alignment of misaligned reads to antisense fasta, with 0 flags flipped to 16
+        antisense_post_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_post_sam)#antisense sam after post function
+        sense_filtered_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.sense_filtered_sam) #aligned sam after reverting to 4nt
+        antisense_flipped_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_flipped_sam)#antisense sam after flipping mapped reads to antisense reads (samline flags from 0 to 16)
+        antisense_filtered_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.antisense_filtered_sam)#antisense sam after flipping mapped reads to antisense reads (samline flags from 0 to 16)
+        sense_misaligned_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.sense_misaligned_fastq)#misaligned reads from sense alignment
+
+    # the derived references and their indexes are shared by all the libraries and nodes through the store
+    if reference_store is not None:
+        pre_fasta = reference_store.index(reference_store.reference(fasta_file, spec.pre_function), aligner)
+        if hyper == True:
+            antisense_fasta = reference_store.index(
+                reference_store.reference(fasta_file, spec.pre_function, ANTISENSE), aligner)
+
+    #decide if any of the stages need skipping based on skip_exisitng_files
+
+    # if no pre function, give the naive pre function (identity pre) and no point in skipping
+    skip_pre = False
+    if spec.pre_function is None:
+        spec = spec._replace(pre_function = Naive_pre)
+    else:
+        # setting skip pre true only if skip exisiting file and aligned output exist
+        if os.path.isfile(pre_fasta) and os.path.isfile(pre_fastq):
+            if hyper: 
+                if os.path.isfile(antisense_fasta):
+                    skip_pre = skip_existing_files
+            else:
+                skip_pre = skip_existing_files
+
+
+    # if no post function, give the naive pre function (identity pre) and no point in skipping
+    # if no post need to have the alinger stage output the post sam
+    skip_post=False
+    if spec.post_function is None:
+        spec = spec._replace(post_function = Naive_post)
+        aligned_sam = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_sam)
+        misaligned_fastq = dirstruct.pathName(fastq, id_step, Stages.graph_aligner, AlignStage.post_fastq)
+    else:
+        # setting skip post true only if skip exisiting file and post output exist
+        if os.path.isfile(post_sam) and os.path.isfile(post_fastq):
+            if hyper: 
+                if os.path.isfile(antisense_sam) and os.path.isfile(antisense_post_sam):
                     skip_post = skip_existing_files
-                
-        #TODO: skipping innacurate, since align and post stage currently share antisense fastq
-        
-        #setting skip allign true only if skip exisiting file and aligned output exist
-        skip_align = False
-        if os.path.isfile(aligned_sam) and os.path.isfile(misaligned_fastq):
-            if hyper:
-                if os.path.isfile(antisense_sam) and os.path.isfile(antisense_fastq):
-                    skip_align = skip_existing_files
             else:
+                skip_post = skip_existing_files
+
+    #TODO: skipping innacurate, since align and post stage currently share antisense fastq
+
+    #setting skip allign true only if skip exisiting file and aligned output exist
+    skip_align = False
+    if os.path.isfile(aligned_sam) and os.path.isfile(misaligned_fastq):
+        if hyper:
+            if os.path.isfile(antisense_sam) and os.path.isfile(antisense_fastq):
                 skip_align = skip_existing_files
-                    
-        ## computing pre
-        if skip_pre :
-            logging.info(f"skipping pre calculation of {id_step} on {fasta_file} and {in_fastq} ")
         else:
-            logging.info(f"computing pre calculation of {id_step} on {fasta_file} and {in_fastq} ")
-            # interface expected is f(in_fasta,in_fastq,out_fasta,out_fastq) where arguemtns are file names
+            skip_align = skip_existing_files
+
+    ## computing pre
+    if skip_pre :
+        logging.info(f"skipping pre calculation of {id_step} on {fasta_file} and {in_fastq} ")
+    else:
+        logging.info(f"computing pre calculation of {id_step} on {fasta_file} and {in_fastq} ")
+        # interface expected is f(in_fasta,in_fastq,out_fasta,out_fastq) where arguemtns are file names
+        if reference_store is not None:
+            # the references are already in the store, only the library is pre processed
+            pre_fastq, _ = spec.pre_function(None, in_fastq, None, pre_fastq)
+        else:
             pre_fastq, pre_fasta = spec.pre_function(fasta_file, in_fastq,pre_fasta,pre_fastq)
-            if hyper == True:
-                complement_multiline(2,'~',2,fasta_file,output_filename=antisense_fasta)#TODO: complement before or after 3nt?                 
-                spec.pre_function(antisense_fasta, None, antisense_fasta, None)
-
-        # computing alignment
-        if skip_align :
-            logging.info(f"skipping alignment  of {id_step} on {pre_fasta} and {pre_fastq} ")
-            if hyper == True:
-                logging.info(f"skipping alignment  of {id_step} on {antisense_fasta} and {misaligned_fastq} ")
+        if hyper == True and reference_store is None:
+            complement_multiline(2,'~',2,fasta_file,output_filename=antisense_fasta)#TODO: complement before or after 3nt?                 
+            spec.pre_function(antisense_fasta, None, antisense_fasta, None)
+
+    # computing alignment
+    if skip_align :
+        logging.info(f"skipping alignment  of {id_step} on {pre_fasta} and {pre_fastq} ")
+        if hyper == True:
+            logging.info(f"skipping alignment  of {id_step} on {antisense_fasta} and {misaligned_fastq} ")
+    else:
+        # the lock is acquired when building index, since we cant have siblings build index together.
+        locking_context = indexing_lock
+        secondary_locking_context = secondary_indexing_lock
+        logging.info(f"computing alignment of {id_step} on {pre_fasta} and {pre_fastq} ")
+
+        if hyper == True:
+            aligner.align(lib=pre_fastq, reference=pre_fasta,flags=spec.flags,
+                    pos=aligned_sam, neg=sense_misaligned_fastq,locking_context=locking_context,build_index=reference_store is None, log=aligned_sam)
+            logging.info(f"computing antisense alignment of {id_step} on {antisense_fasta} and {misaligned_fastq} ")
+            reverse_multiline(4,chr(127),2,sense_misaligned_fastq, antisense_fastq)
+            aligner.align(lib=antisense_fastq, reference=antisense_fasta,flags=spec.flags,
+                    pos=antisense_sam, neg=misaligned_fastq,locking_context=secondary_locking_context,build_index=reference_store is None, log=antisense_sam)
+
         else:
-            # get a lock that will be acquired when building index, since we cant have siblings build index together.
-            locking_context = tree_threads.locking_context()
-            secondary_locking_context = tree_threads.secondary_locking_context()
-            logging.info(f"computing alignment of {id_step} on {pre_fasta} and {pre_fastq} ")
-
-            if hyper == True:
-                aligner.align(lib=pre_fastq, reference=pre_fasta,flags=spec.flags,
-                        pos=aligned_sam, neg=sense_misaligned_fastq,locking_context=locking_context,build_index=True, log=aligned_sam)
-                logging.info(f"computing antisense alignment of {id_step} on {antisense_fasta} and {misaligned_fastq} ")
-                reverse_multiline(4,chr(127),2,sense_misaligned_fastq, antisense_fastq)
-                aligner.align(lib=antisense_fastq, reference=antisense_fasta,flags=spec.flags,
-                        pos=antisense_sam, neg=misaligned_fastq,locking_context=secondary_locking_context,build_index=True, log=antisense_sam)
-                        
-            else:
-                aligner.align(lib=pre_fastq, reference=pre_fasta,flags=spec.flags,
-                        pos=aligned_sam, neg=misaligned_fastq,locking_context=locking_context,build_index=True, log=aligned_sam)
+            aligner.align(lib=pre_fastq, reference=pre_fasta,flags=spec.flags,
+                    pos=aligned_sam, neg=misaligned_fastq,locking_context=locking_context,build_index=reference_store is None, log=aligned_sam)
+
+
+    #post calculation
+    if skip_post :
+        logging.info(f"skipping post calculation of {id_step} on {aligned_sam} and {misaligned_fastq} ")
+
+    else:
+        logging.info(f"computing post calculation of {id_step} on {aligned_sam} and {misaligned_fastq} ")
+        # interface expected is f(in_fastq,in_sam,out_fastq,out_sam, **kwargs) where arguemtns are file names
+
+        if hyper == True:
 
+            command =   f"samtools view -h -F 4 {aligned_sam} | samtools view -h -F 16 > {sense_filtered_sam} &&" +\
+            f"samtools view -h -F 4 {antisense_sam} | samtools view -h -F 16 > {antisense_filtered_sam}"
+            try:
+                subprocess.check_output(command, shell=True)
+            except Exception as e:
+                raise e         
 
-        #post calculation
-        if skip_post :
-            logging.info(f"skipping post calculation of {id_step} on {aligned_sam} and {misaligned_fastq} ")
+            spec.post_function(misaligned_fastq, sense_filtered_sam, post_fastq, post_sam, fastq_lib=fastq)
+            flip_sam_flags(antisense_filtered_sam, 0, 16, output_filename=antisense_flipped_sam)
+            spec.post_function(None, antisense_flipped_sam,None,antisense_post_sam, fastq_lib=fastq)
 
         else:
-            logging.info(f"computing post calculation of {id_step} on {aligned_sam} and {misaligned_fastq} ")
-            # interface expected is f(in_fastq,in_sam,out_fastq,out_sam, **kwargs) where arguemtns are file names
-            
-            if hyper == True:
-            
-                command =   f"samtools view -h -F 4 {aligned_sam} | samtools view -h -F 16 > {sense_filtered_sam} &&" +\
-                f"samtools view -h -F 4 {antisense_sam} | samtools view -h -F 16 > {antisense_filtered_sam}"
-                try:
-                    subprocess.check_output(command, shell=True)
-                except Exception as e:
-                    raise e         
-                
-                spec.post_function(misaligned_fastq, sense_filtered_sam, post_fastq, post_sam, fastq_lib=fastq)
-                flip_sam_flags(antisense_filtered_sam, 0, 16, output_filename=antisense_flipped_sam)
-                spec.post_function(None, antisense_flipped_sam,None,antisense_post_sam, fastq_lib=fastq)
+            post_fastq, post_sam = spec.post_function(misaligned_fastq, aligned_sam,post_fastq,post_sam, fastq_lib=fastq)
 
-            else:
-                post_fastq, post_sam = spec.post_function(misaligned_fastq, aligned_sam,post_fastq,post_sam, fastq_lib=fastq)
-        
-        
-        logging.info(f"setting output of step {id_step} as {post_sam} and {post_fastq}")
-        # letting tree threads now what the negative fastq of this step is
-        tree_threads.set_filename_of_finished_alignment(id_step, post_fastq)
 
-        return
+
+    logging.info(f"setting output of step {id_step} as {post_sam} and {post_fastq}")
+    return post_fastq
 
 def Naive_pre(in_fasta,in_fastq,pre_fasta,pre_fastq,**kwargs):
     """
@@ -12,13 +12,19 @@ Options:
 
 """
 from docopt import docopt
-from Utility.generators_utilities import getLineFromChunk, fileGetChunks
-from Utility.Samfile_class import   split_sam
-from Processing.sam_sorting import sam_sorted
+from Utility.bgzf import BgzfWriter
 from Utility.temp_files import new_temp_file
+from Processing.sam_sorting import sam_extract_range, sam_sorted
+from operator import itemgetter
+import heapq
+import itertools
+import multiprocessing
 import os
 import logging
 
+# the order of the header record types in a merged header, other records (e.g. @CO) are written after them
+HEADER_ORDER = {"@HD": 0, "@SQ": 1, "@RG": 2, "@PG": 3}
+
 
 """
 @param: in_list, list of sam file paths
@@ -47,30 +53,111 @@ def add_newline(in_list):
 
 
 """
-@param: ih_list, list of sam file paths
+@param: header_lines, the header lines of all the sams in their order
+@return: the header lines without duplicates: the first @HD line, the first @SQ line of every reference (SN), the first
+@RG / @PG line of every ID and every other line once, grouped by HEADER_ORDER and in the order they first appear
+"""
+def dedup_header(header_lines):
+    merged = []
+    seen = set()
+    for line in header_lines:
+        fields = line.rstrip("\r\n").split("\t")
+        record_type = fields[0]
+        if record_type == "@HD":
+            key = record_type
+        elif record_type in ("@SQ", "@RG", "@PG"):
+            tag = "SN:" if record_type == "@SQ" else "ID:"
+            key = (record_type, next((field for field in fields[1:] if field.startswith(tag)), line))
+        else:
+            key = line
+        if key in seen:
+            continue
+        seen.add(key)
+        merged.append(line)
+    merged.sort(key=lambda line: HEADER_ORDER.get(line[:3], len(HEADER_ORDER)))
+    return merged
+
+
+"""
+@param: sam_filename, a sam sorted by sam_extract_range (see sam_sorting.sam_sorted)
+@return: (the header lines of the sam, generator of the (sam_extract_range key, line) of its records)
+@raise ValueError: (by the generator) if the records are not sorted
+"""
+def sorted_sam_records(sam_filename):
+    fp = open(sam_filename, "r")
+    header = []
+    first_record = None
+    for line in fp:
+        if not line.startswith("@"):
+            first_record = line
+            break
+        header.append(line if line.endswith("\n") else line + "\n")
+
+    def records():
+        previous_key = None
+        with fp:
+            lines = fp if first_record is None else itertools.chain([first_record], fp)
+            for line in lines:
+                if not line.strip():
+                    continue
+                if not line.endswith("\n"):
+                    line += "\n"
+                key = sam_extract_range(line)
+                if previous_key is not None and key < previous_key:
+                    raise ValueError(f"{sam_filename} is not sorted (a record of {key} after {previous_key})")
+                previous_key = key
+                yield key, line
+
+    return header, records()
+
+
+"""
+@param: in_list, list of sam file paths
 @param: out_sam, path to write merged sam to
+@param: sort_kwargs, parameters of the external sort (see Utility.generators_utilities.external_sort_pairs)
+@param: sorted_inputs, True if the sams are already sorted by sam_extract_range (the output of sam_sorting), otherwise
+every sam is sorted on its own first
+@param: processes, number of sams sorted in parallel
+@param: compress, write the merged sam bgzf compressed (see Utility.bgzf, read by samtools like a bam stream),
+by default when out_sam ends with .gz or .bgz
+
+The merged sam has a single header (see dedup_header), and the records of all the sams merged in sorted order, the
+unaligned records at the end. Records of the same key keep the order of the sams, like a stable sort of the sams one
+after the other.
 """
-def merge_sams(in_list,out_sam):
-    (headers,alligns, misalligns)=([],[],[])
-    # split all files
-    for in_sam in in_list:
-        head,all,misall=split_sam(in_sam)
-        for list,file in zip([headers,alligns,misalligns],[head,all,misall]):
-            list.append(file)
-
-    unsorted_out=new_temp_file()
-
-    # write all headers than all alligned than all un alligned
-    with open(unsorted_out,"w") as out_fp:
-        for part_list in [headers,alligns,misalligns]:
-            for part in part_list:
-                with open(part,"r") as fp:
-                    for chunk in fileGetChunks(fp):
-                        out_fp.writelines(chunk)
-                os.remove(part)
-
-    sam_sorted(unsorted_out,out_sam)
-    os.remove(unsorted_out)
+def merge_sams(in_list,out_sam,sort_kwargs=None,sorted_inputs=False,processes=1,compress=None):
+    if compress is None:
+        compress = out_sam.endswith(".gz") or out_sam.endswith(".bgz")
+
+    sorted_sams = list(in_list)
+    temp_sams = []
+    try:
+        if not sorted_inputs:
+            temp_sams = [new_temp_file() for _ in in_list]
+            sort_arguments = [(in_sam, temp_sam, sort_kwargs) for in_sam, temp_sam in zip(in_list, temp_sams)]
+            if processes > 1 and len(in_list) > 1:
+                with multiprocessing.Pool(min(processes, len(in_list))) as pool:
+                    pool.starmap(sam_sorted, sort_arguments)
+            else:
+                for arguments in sort_arguments:
+                    sam_sorted(*arguments)
+            sorted_sams = temp_sams
+
+        headers, record_streams = [], []
+        for sorted_sam in sorted_sams:
+            header, records = sorted_sam_records(sorted_sam)
+            headers.extend(header)
+            record_streams.append(records)
+
+        # the key of the unaligned records ("~") is after all the chromosomes, so they are merged at the end
+        out_fp = BgzfWriter(out_sam) if compress else open(out_sam, "w")
+        with out_fp:
+            out_fp.writelines(dedup_header(headers))
+            out_fp.writelines(line for _, line in heapq.merge(*record_streams, key=itemgetter(0)))
+    finally:
+        for temp_sam in temp_sams:
+            if os.path.exists(temp_sam):
+                os.remove(temp_sam)
 
     return
 
@@ -79,7 +166,8 @@ def parameters_description():
     string = "The parameters are:" + "\n" \
              + "Infiles: a list of sam file names\n" \
              +"-o Outfile: an \'o\' flag followed by the path of the desired output filename.\n " \
-             + "If non is given the output is printed to the stdout channel "
+             + "If non is given the output is printed to the stdout channel\n" \
+             + "An output name that ends with .gz or .bgz is written bgzf compressed (read by samtools as a bam stream)"
     print (string)
 
 def example_description():
@@ -102,10 +190,6 @@ def example_description():
 
     output_sam = "@HD\tVN:1.6\tbbb\n" \
                 + "@SQ\tSN:ref\tLN:45_2\n" \
-                 + "@HD\tVN:1.6\taaa\n" \
-                 + "@SQ\tSN:ref\tLN:45_1\n" \
-                 +"@HD\tVN:1.6\tccc\n" \
-                 + "@SQ\tSN:ref\tLN:45_3\n" \
                  + "seq1\t16\tchrX\t100\t255\t10M\t*\t0\t0\tAGCTCACGTT\tEEEAAEAEEE\tXA:i:0\tMD:Z:53G7C19A68\tNM:i:3\n" \
                  + "seq1\t16\tchrX\t200\t255\t10M\t*\t0\t0\tAGCTCACGTT\tEEEAAEAEEE\tXA:i:0\tMD:Z:53G7C19A68\tNM:i:3\n" \
                  + "seq1\t16\tchrY\t100\t255\t10M\t*\t0\t0\tAGCTCACGTT\tEEEAAEAEEE\tXA:i:0\tMD:Z:53G7C19A68\tNM:i:3\n" \
@@ -13,9 +13,20 @@ Options:
 from docopt import docopt
 # info : this file recives pileup file name and sort its lines according to their id and pos
 
+import gzip
+import heapq
+import io
+import itertools
+import os
+import uuid
+from operator import itemgetter
 from Utility.Pileup_class import Pileup_line
 from Utility.generators_utilities import key_sorted_gen, class_generator
 
+# size of the write buffer of the sorted output
+WRITE_BUFFER_SIZE = 16 * 1024 * 1024
+# number of sorted lines joined into a single write
+WRITE_BATCH_LINES = 10000
 
 
 #key for sorting according to id and position of each line
@@ -23,17 +34,98 @@ from Utility.generators_utilities import key_sorted_gen, class_generator
 def get_key_tuple_from_pileup(line: Pileup_line):
 	return line.ref(),line.pos()[0]
 
-def pileup_sort(in_pileup, out_pileup):
+def open_sorted_output(filename, compress=False, buffer_size=WRITE_BUFFER_SIZE):
+	"""
+	:param filename: the output file name
+	:param compress: write gzip compressed output
+	:param buffer_size: size of the write buffer
+	:return: an open text file for writing
+	"""
+	raw = open(filename, "wb", buffering=buffer_size)
+	if compress:
+		return io.TextIOWrapper(gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=6), write_through=False)
+	return io.TextIOWrapper(raw, write_through=False)
+
+def write_lines_atomically(lines, out_filename, compress=False, buffer_size=WRITE_BUFFER_SIZE):
+	"""
+	writes the lines to a temporary file next to out_filename and replaces out_filename with it when done,
+	so out_filename is never left half written
+	:param lines: iterable of lines
+	:param out_filename: the output file name
+	:param compress: write gzip compressed output
+	:param buffer_size: size of the write buffer
+	"""
+	temp_name = "%s.%s.tmp" % (out_filename, uuid.uuid4().hex)
+	try:
+		out_fp = open_sorted_output(temp_name, compress, buffer_size)
+		try:
+			batch = []
+			for line in lines:
+				batch.append(line)
+				if len(batch) == WRITE_BATCH_LINES:
+					out_fp.write(''.join(batch))
+					batch = []
+			out_fp.write(''.join(batch))
+		finally:
+			out_fp.close()
+		os.replace(temp_name, out_filename)
+	except BaseException:
+		if os.path.exists(temp_name):
+			os.remove(temp_name)
+		raise
+
+#sort_kwargs are the parameters of the external sort (memory_limit, compress, processes, temp_dir)
+#compress gzips the output, by default when out_pileup ends with .gz
+def pileup_sort(in_pileup, out_pileup, sort_kwargs=None, compress=None, buffer_size=WRITE_BUFFER_SIZE):
+	if compress is None:
+		compress = out_pileup.endswith(".gz")
 	with open(in_pileup , "r") as file_pileup:
 		gen_pileup = class_generator(Pileup_line, file = file_pileup)
-		gen_sorted_pileup=key_sorted_gen(get_key_tuple_from_pileup,file=file_pileup,gen=gen_pileup)
-		open(out_pileup, "w").close()
-
-		for line in gen_sorted_pileup :
-			with open(out_pileup,"a+") as file1:
-				file1.write(line)
-				
-
+		gen_sorted_pileup=key_sorted_gen(get_key_tuple_from_pileup,file=file_pileup,gen=gen_pileup,sort_kwargs=sort_kwargs)
+		write_lines_atomically(gen_sorted_pileup, out_pileup, compress, buffer_size)
+
+
+def keyed_pileup_lines(pileup_filename):
+	"""
+	:return: yields (key, line) of the lines of a sorted pileup, key is (reference id, position) as in
+	get_key_tuple_from_pileup, without parsing the lines
+	:raise ValueError: if the pileup is not sorted by the key
+	"""
+	previous_key = None
+	with open(pileup_filename, "r") as pileup:
+		for line in pileup:
+			if not line.strip():
+				continue
+			fields = line.split("\t", 2)
+			key = (fields[0], int(fields[1]))
+			if previous_key is not None and key < previous_key:
+				raise ValueError("%s is not sorted by reference id and position (%s:%d after %s:%d)" %
+								 ((pileup_filename,) + key + previous_key))
+			previous_key = key
+			yield key, line if line.endswith("\n") else line + "\n"
+
+def merged_pileup_lines(pileup_filenames):
+	"""
+	a streaming merge of pileups sorted like pileup_sort: the lines of a site that is in several pileups are merged
+	by Pileup_line.merge_pileup_lines (their reads and qualities are concatenated and their read counts summed),
+	the other lines are passed as they are
+	:return: yields the sorted lines of the merged pileup
+	"""
+	keyed_lines = heapq.merge(*[keyed_pileup_lines(filename) for filename in pileup_filenames], key=itemgetter(0))
+	for key, site_lines in itertools.groupby(keyed_lines, key=itemgetter(0)):
+		first_line = next(site_lines)[1]
+		other_lines = [line for _, line in site_lines]
+		if not other_lines:
+			yield first_line
+		else:
+			merged = Pileup_line.merge_pileup_lines([Pileup_line(line) for line in [first_line] + other_lines])
+			yield str(merged) + "\n"
+
+#merges sorted pileups (e.g. the sense and antisense pileups of a library) into a sorted pileup of their sites
+def merge_sorted_pileups(pileup_filenames, out_pileup, compress=None, buffer_size=WRITE_BUFFER_SIZE):
+	if compress is None:
+		compress = out_pileup.endswith(".gz")
+	write_lines_atomically(merged_pileup_lines(pileup_filenames), out_pileup, compress, buffer_size)
 
 
 if __name__ == "__main__":
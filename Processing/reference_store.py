@@ -0,0 +1,192 @@
+"""
+Content addressed store of derived references and their aligner indexes
+
+Every library and every node of the alignment graph that uses the same derived reference (for example the A_G 3nt
+genome of norep_hyper_A_G and rep_hyper_A_G, or its complemented antisense version) gets the same fasta and index
+from the store, so each of them is built only once. The store can be kept between runs.
+
+A derived reference is keyed by the content hash of the source fasta, the pre processing function (with its
+arguments, e.g. the nt pair) and the strand. An index is keyed by its reference and the index builder command and
+flags. Artifacts are built holding an exclusive file lock of their directory, so parallel processes wait for a
+single build, and are marked complete only after the build succeeded.
+
+store layout:
+    <store_dir>/hashes/<hash of the source path>.json         cached content hash of a source fasta
+    <store_dir>/references/<key>/reference.fasta               the derived fasta
+    <store_dir>/references/<key>/index_<key>/reference.fasta   link to the derived fasta, the index is built next to it
+"""
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import uuid
+from Processing.genome_3nt import complement_multiline
+
+SENSE = "sense"
+ANTISENSE = "antisense"
+
+REFERENCE_NAME = "reference.fasta"
+DESCRIPTION_NAME = "description.json"
+DONE_MARKER = ".done"
+LOCK_NAME = ".lock"
+HASH_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+def file_content_hash(filename):
+    """
+    :return: sha256 hex digest of the file content
+    """
+    digest = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def derivation_key(function):
+    """
+    :param function: pre processing function (or functools.partial of one), or None for the original reference
+    :return: a string that identifies the function and its bound arguments
+    """
+    if function is None:
+        return None
+    if isinstance(function, functools.partial):
+        return "%s(%r, %r)" % (derivation_key(function.func), function.args, sorted(function.keywords.items()))
+    return "%s.%s" % (function.__module__, function.__qualname__)
+
+
+def artifact_key(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()[:32]
+
+
+@contextlib.contextmanager
+def file_lock(lock_filename):
+    """
+    exclusive lock of lock_filename, between processes and between threads (each acquire opens the file)
+    """
+    with open(lock_filename, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+class ReferenceStore:
+
+    def __init__(self, store_dir):
+        self.store_dir = os.path.abspath(store_dir)
+        os.makedirs(os.path.join(self.store_dir, "hashes"), exist_ok=True)
+        os.makedirs(os.path.join(self.store_dir, "references"), exist_ok=True)
+
+    def content_hash(self, fasta_file):
+        """
+        :return: the content hash of fasta_file, cached in the store while the size and modification time of the
+        file don't change
+        """
+        path = os.path.abspath(fasta_file)
+        stat = os.stat(path)
+        cache = os.path.join(self.store_dir, "hashes", hashlib.sha256(path.encode()).hexdigest() + ".json")
+        try:
+            with open(cache, "r") as fp:
+                cached = json.load(fp)
+            if cached["size"] == stat.st_size and cached["mtime_ns"] == stat.st_mtime_ns:
+                return cached["hash"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+        content_hash = file_content_hash(path)
+        temp_cache = "%s.%s.tmp" % (cache, uuid.uuid4().hex)
+        with open(temp_cache, "w") as fp:
+            json.dump({"path": path, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": content_hash}, fp)
+        os.replace(temp_cache, cache)
+        return content_hash
+
+    def _build_once(self, directory, build, description):
+        """
+        runs build() unless the artifact of directory is complete, holding the lock of directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        marker = os.path.join(directory, DONE_MARKER)
+        if os.path.isfile(marker):
+            return
+        with file_lock(os.path.join(directory, LOCK_NAME)):
+            if os.path.isfile(marker):
+                return
+            logging.info(f"building {description} in {directory}")
+            build()
+            with open(os.path.join(directory, DESCRIPTION_NAME), "w") as fp:
+                json.dump(description, fp, default=str, indent=1)
+            open(marker, "w").close()
+
+    def reference(self, fasta_file, pre_function=None, strand=SENSE):
+        """
+        :param fasta_file: the source reference
+        :param pre_function: pre processing function of the reference, with the interface
+        f(in_fasta, in_fastq, out_fasta, out_fastq) (the fastqs are None), or None for the source reference
+        :param strand: SENSE, or ANTISENSE for the complemented reference (complemented before the pre processing)
+        :return: path of the derived reference in the store
+        """
+        source_hash = self.content_hash(fasta_file)
+        derivation = derivation_key(pre_function)
+        directory = os.path.join(self.store_dir, "references", artifact_key(source_hash, derivation, strand))
+        reference = os.path.join(directory, REFERENCE_NAME)
+
+        def build():
+            temp_names = []
+            source = fasta_file
+            try:
+                if strand == ANTISENSE:
+                    source = reference + ".complement.tmp"
+                    temp_names.append(source)
+                    complement_multiline(2, '~', 2, fasta_file, output_filename=source)
+
+                if pre_function is not None:
+                    temp_reference = reference + ".pre.tmp"
+                    temp_names.append(temp_reference)
+                    _, derived = pre_function(source, None, temp_reference, None)
+                    os.replace(derived, reference)
+                elif source is not fasta_file:
+                    os.replace(source, reference)
+                else:
+                    # the source reference itself, linked when possible
+                    if os.path.lexists(reference):
+                        os.remove(reference)
+                    try:
+                        os.link(os.path.abspath(fasta_file), reference)
+                    except OSError:
+                        shutil.copyfile(fasta_file, reference)
+            finally:
+                for temp_name in temp_names:
+                    if os.path.exists(temp_name):
+                        os.remove(temp_name)
+
+        self._build_once(directory, build, {"source": os.path.abspath(fasta_file), "source_hash": source_hash,
+                                            "derivation": derivation, "strand": strand})
+        return reference
+
+    def index(self, reference, aligner, indexing_flags=''):
+        """
+        builds the aligner index of a store reference once
+        :param reference: a reference returned by reference()
+        :param aligner: AlignerWrapper with an index building command
+        :param indexing_flags: flags of the index builder
+        :return: the reference path to align with (its index files are next to it)
+        """
+        index_key = artifact_key(aligner.index_format_string, aligner.index_output_format_list, indexing_flags)
+        directory = os.path.join(os.path.dirname(reference), "index_" + index_key)
+        indexed_reference = os.path.join(directory, REFERENCE_NAME)
+
+        def build():
+            if not os.path.lexists(indexed_reference):
+                os.symlink(os.path.join(os.pardir, REFERENCE_NAME), indexed_reference)
+            aligner.execute_command(aligner.index_format_string.format(reference=indexed_reference,
+                                                                       flags=indexing_flags))
+
+        self._build_once(directory, build, {"reference": reference, "builder": aligner.index_format_string,
+                                            "flags": indexing_flags})
+        return indexed_reference
@@ -55,9 +55,11 @@ def sam_extract_range(line):
 
 """
 :param sam_filename: the filename of the sam file
+:param sort_kwargs: parameters of the external sort (memory_limit, compress, processes, temp_dir),
+see Utility.generators_utilities.external_sort_pairs
 :return: output file called ${out_filename} that sorted mainly according to the chromosome number, and secondly according to the interval range
 """
-def sam_sorted(sam_filename,out_filename):
+def sam_sorted(sam_filename,out_filename,sort_kwargs=None):
     # Sorting the file
     with open(out_filename,"w") as output_file,\
             open(sam_filename,"r") as file:
@@ -72,7 +74,7 @@ def sam_sorted(sam_filename,out_filename):
             output_file.write(line)
         """
 
-        for line in key_sorted_gen(sam_extract_range, file):
+        for line in key_sorted_gen(sam_extract_range, file, sort_kwargs=sort_kwargs):
             output_file.write(line)
 
 
@@ -0,0 +1,580 @@
+"""
+Native sam to pileup engine
+
+Streams sam files (or the sam output of an aligner) once, walks the CIGAR of every alignment and counts the aligned
+bases of every reference position by strand (A,C,G,T,N on each strand and deletions) with their summed base
+qualities. The counts are kept per chromosome as sorted numpy arrays of the covered (position, column) keys, merged
+chunk by chunk, so there is no intermediate bam, no sort and no mpileup. Several sam files (e.g. the sense and
+antisense alignments of a library) can be counted in parallel processes, and their count arrays are added.
+The reference bases are gathered from a memory map of the fasta (see FastaReference), only for the positions that
+need them, so the genome is not held in memory by any of the processes.
+
+The output is a pileup sorted like pileup_sort (by chromosome name, then position), in the mpileup format:
+    chromosome  position  reference base  depth  reads string  quality string
+or the binary site format (Utility.binary_pileup) for an output named *.rpu.
+
+The reads are selected like samtools mpileup does by default (unmapped, secondary, qc fail and duplicate
+alignments and, unless count_orphans, paired reads that are not properly paired are skipped, bases below
+min_base_quality are not counted), without BAQ and without the overlapping mates correction.
+The reads string of a site holds its counts grouped by kind - '.' and ',' for the reference base on the forward and
+reverse strand, the mismatches (upper case on the forward strand, lower case on the reverse strand) in ACGTN order
+and '*' for deletions - and the quality string holds the average quality of every kind. Read start/end marks and
+insertions are not reported.
+
+With min_mismatches only the sites with at least min_mismatches A,C,G,T reads that differ from the reference base
+(on both strands, the mismatches of the no change filter) are written, so the pileup is the no change pileup of the
+library, and the sites without changes are never written, sorted or parsed. They are summarized in a coverage
+summary instead: a bedgraph of the dropped sites (runs of consecutive positions of the same depth, 0 based half open)
+with a header line of the site counts:
+    # covered_sites  <all the covered sites>  emitted_sites  <the written sites>
+    chromosome  start  end  depth
+
+example:
+    sam_to_pileup(["sense.sam", "antisense.sam"], "genome.fasta", "library.pileup")
+    sam_to_pileup(["sense.sam", "antisense.sam"], "genome.fasta", "library_no_change.pileup", min_mismatches=1,
+                  coverage_summary_file="library_coverage.bedgraph")
+"""
+import functools
+import logging
+import multiprocessing
+import os
+import re
+import numpy as np
+from Utility.Pileup_class import PileupBatch
+from Utility.binary_pileup import RpuWriter
+
+# sam flags skipped by default (like the default --ff of samtools mpileup)
+FLAG_PAIRED = 0x1
+FLAG_PROPER_PAIR = 0x2
+FLAG_UNMAPPED = 0x4
+FLAG_REVERSE = 0x10
+DEFAULT_SKIP_FLAGS = 0x4 | 0x100 | 0x200 | 0x400
+DEFAULT_MIN_BASE_QUALITY = 13
+
+# count columns of a site
+NUCLEOTIDES = "ACGTN"
+SENSE_COLUMN = 0
+ANTISENSE_COLUMN = 5
+DELETION_COLUMN = 10
+NUMBER_OF_COUNT_COLUMNS = 11
+
+PHRED_OFFSET = 33
+# the quality of a read without a quality string ('*'), it passes any base quality threshold
+MISSING_QUALITY = 93
+SAM_BATCH_LINES = 100000
+# pending chunk counts of a chromosome are merged when they hold more keys than this
+MERGE_KEYS = 20000000
+PILEUP_BATCH_SITES = 100000
+
+CIGAR_PATTERN = re.compile(r"(\d+)([MIDNSHP=X])")
+# base code of every ascii code: A,C,G,T,N (and any other letter) and '=' (the reference base)
+EQUAL_CODE = 5
+_base_codes = np.full(256, 4, dtype=np.uint8)
+for _code, _nucl in enumerate("ACGT"):
+    _base_codes[ord(_nucl)] = _base_codes[ord(_nucl.lower())] = _code
+_base_codes[ord('=')] = EQUAL_CODE
+BASE_CODES = _base_codes
+
+
+FAI_SUFFIX = ".fai"
+
+
+def _fasta_layout(fasta_file):
+    """
+    the layout of the sequences in a fasta (like samtools faidx): the .fai of the fasta is used if it is newer than the
+    fasta, else the fasta is scanned once
+    :return: dict of the chromosome name (the first word of its header) to (length, offset of its first base, bases
+    per line, bytes per line), the bases per line is None for a sequence of irregular lines, and then the bytes per
+    line is the offset of its end
+    """
+    fai_file = fasta_file + FAI_SUFFIX
+    if os.path.isfile(fai_file) and os.path.getmtime(fai_file) >= os.path.getmtime(fasta_file):
+        layout = dict()
+        with open(fai_file, "r") as fai:
+            for line in fai:
+                fields = line.split("\t")
+                if len(fields) >= 5:
+                    layout[fields[0]] = tuple(int(field) for field in fields[1:5])
+        return layout
+
+    layout = dict()
+
+    def add_sequence(name, offset, end, line_lengths):
+        bases = [length for length, _ in line_lengths]
+        regular = all(width == line_lengths[0][1] and length == bases[0] for length, width in line_lengths[:-1]) and \
+            (not bases or bases[-1] <= bases[0])
+        if regular and bases:
+            layout[name] = (sum(bases), offset, bases[0], line_lengths[0][1])
+        else:
+            layout[name] = (sum(bases), offset, None, end)
+
+    name, offset, line_lengths = None, 0, []
+    position = 0
+    with open(fasta_file, "rb") as fasta:
+        for line in fasta:
+            if line.startswith(b">"):
+                if name is not None:
+                    add_sequence(name, offset, position, line_lengths)
+                words = line[1:].split()
+                name, offset, line_lengths = (words[0].decode() if words else ""), position + len(line), []
+            elif name is not None:
+                line_lengths.append((len(line.rstrip()), len(line)))
+            position += len(line)
+    if name is not None:
+        add_sequence(name, offset, position, line_lengths)
+    return layout
+
+
+class FastaReference:
+    """
+    the reference bases of a fasta, gathered from a read only memory map of the file: the genome is not loaded into
+    memory, and the processes that read the same fasta share its pages
+    """
+
+    def __init__(self, fasta_file):
+        self.fasta_file = fasta_file
+        self.layout = _fasta_layout(fasta_file)
+        self.fasta = np.memmap(fasta_file, dtype=np.uint8, mode="r") if os.path.getsize(fasta_file) \
+            else np.empty(0, dtype=np.uint8)
+        # the sequences of irregular lines, without their line ends
+        self.irregular = dict()
+
+    def length(self, chromosome):
+        """
+        :return: the length of the sequence of the chromosome, 0 if it is not in the fasta
+        """
+        layout = self.layout.get(chromosome)
+        return 0 if layout is None else layout[0]
+
+    def bases(self, chromosome, positions):
+        """
+        :param positions: array of 0 based positions of the chromosome
+        :return: uint8 array of the (ascii) reference bases of the positions, N beyond the end of the sequence
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        bases = np.full(len(positions), ord("N"), dtype=np.uint8)
+        layout = self.layout.get(chromosome)
+        if layout is None or len(positions) == 0:
+            return bases
+        length, offset, line_bases, line_width = layout
+        inside = (positions >= 0) & (positions < length)
+        inside_positions = positions[inside]
+        if line_bases is None:
+            sequence = self.irregular.get(chromosome)
+            if sequence is None:
+                sequence = self.irregular[chromosome] = np.frombuffer(
+                    b"".join(bytes(self.fasta[offset:line_width]).split()), dtype=np.uint8)
+            bases[inside] = sequence[inside_positions]
+        else:
+            bases[inside] = self.fasta[offset + inside_positions // line_bases * line_width +
+                                       inside_positions % line_bases]
+        return bases
+
+
+@functools.lru_cache(maxsize=2)
+def fasta_reference(fasta_file):
+    """
+    :return: the FastaReference of fasta_file (cached, the layout of a fasta is read once by a process)
+    """
+    return FastaReference(fasta_file)
+
+
+class SiteCounts:
+    """
+    the counts of the sites of one chromosome: sorted unique keys (position * NUMBER_OF_COUNT_COLUMNS + column) with
+    their counts and summed qualities
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.pending_keys = 0
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.qualities = np.zeros(0, dtype=np.int64)
+
+    def add(self, keys, qualities):
+        """
+        :param keys: int64 array, a key of every counted base
+        :param qualities: the base quality of every key
+        """
+        unique_keys, inverse, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        summed = np.bincount(inverse.ravel(), weights=qualities, minlength=len(unique_keys)).astype(np.int64)
+        self.pending.append((unique_keys, counts.astype(np.int64), summed))
+        self.pending_keys += len(unique_keys)
+        if self.pending_keys > MERGE_KEYS:
+            self.merge()
+
+    def add_counts(self, keys, counts, qualities):
+        """
+        adds the counts of sorted unique keys (e.g. the merged counts of another SiteCounts)
+        """
+        self.pending.append((keys, counts, qualities))
+        self.pending_keys += len(keys)
+        if self.pending_keys > MERGE_KEYS:
+            self.merge()
+
+    def merge(self):
+        if not self.pending:
+            return
+        keys = np.concatenate([self.keys] + [part[0] for part in self.pending])
+        counts = np.concatenate([self.counts] + [part[1] for part in self.pending])
+        qualities = np.concatenate([self.qualities] + [part[2] for part in self.pending])
+        self.pending, self.pending_keys = [], 0
+        order = np.argsort(keys, kind='stable')
+        keys, counts, qualities = keys[order], counts[order], qualities[order]
+        starts = np.flatnonzero(np.concatenate(([True], keys[1:] != keys[:-1])))
+        self.keys = keys[starts]
+        self.counts = np.add.reduceat(counts, starts) if len(keys) else counts
+        self.qualities = np.add.reduceat(qualities, starts) if len(keys) else qualities
+
+    def sites(self):
+        """
+        :return: (sorted 0 based positions, counts array of shape (sites, NUMBER_OF_COUNT_COLUMNS), summed qualities
+        of the same shape)
+        """
+        self.merge()
+        positions_of_keys = self.keys // NUMBER_OF_COUNT_COLUMNS
+        columns = self.keys % NUMBER_OF_COUNT_COLUMNS
+        positions, rows = np.unique(positions_of_keys, return_inverse=True)
+        counts = np.zeros((len(positions), NUMBER_OF_COUNT_COLUMNS), dtype=np.int64)
+        qualities = np.zeros((len(positions), NUMBER_OF_COUNT_COLUMNS), dtype=np.int64)
+        counts[rows, columns] = self.counts
+        qualities[rows, columns] = self.qualities
+        return positions, counts, qualities
+
+
+class PileupCounter:
+    """
+    counts the aligned bases of sam lines into a SiteCounts of every chromosome
+    """
+
+    def __init__(self, reference, min_base_quality=DEFAULT_MIN_BASE_QUALITY, min_mapping_quality=0,
+                 skip_flags=DEFAULT_SKIP_FLAGS, count_orphans=False):
+        """
+        :param reference: FastaReference of the reference of the alignments, see fasta_reference
+        """
+        self.reference = reference
+        self.min_base_quality = min_base_quality
+        self.min_mapping_quality = min_mapping_quality
+        self.skip_flags = skip_flags
+        self.count_orphans = count_orphans
+        self.chromosomes = dict()
+
+    def site_counts(self):
+        """
+        :return: dict of chromosome to the (keys, counts, qualities) arrays of its merged SiteCounts
+        """
+        for chromosome_counts in self.chromosomes.values():
+            chromosome_counts.merge()
+        return {chromosome: (chromosome_counts.keys, chromosome_counts.counts, chromosome_counts.qualities)
+                for chromosome, chromosome_counts in self.chromosomes.items()}
+
+    def add_site_counts(self, site_counts):
+        """
+        adds the counts of another counter (see site_counts), the pileup of both is the pileup of all their sams
+        """
+        for chromosome, (keys, counts, qualities) in site_counts.items():
+            self.chromosomes.setdefault(chromosome, SiteCounts()).add_counts(keys, counts, qualities)
+
+    def _reference_codes(self, chromosome, positions):
+        """
+        :return: the base codes of the reference bases of the positions (N beyond the end of the reference)
+        """
+        return BASE_CODES[self.reference.bases(chromosome, positions)].astype(np.int64)
+
+    def add_sam(self, sam):
+        """
+        :param sam: sam file name, or an iterable of sam lines (e.g. the stdout of an aligner)
+        """
+        if isinstance(sam, str):
+            with open(sam, "r") as sam_file:
+                self.add_sam(sam_file)
+            return
+        batch = []
+        for line in sam:
+            if line.startswith("@"):
+                continue
+            batch.append(line)
+            if len(batch) >= SAM_BATCH_LINES:
+                self.add_lines(batch)
+                batch = []
+        self.add_lines(batch)
+
+    def add_lines(self, lines):
+        """
+        counts a batch of sam alignment lines
+        """
+        chromosome_ids = dict()
+        # aligned blocks: chromosome id, strand, reference start, query start (in the batch buffers) and length
+        blocks = ([], [], [], [], [])
+        # deleted blocks: chromosome id, reference start and length
+        deletions = ([], [], [])
+        sequences, qualities = [], []
+        offset = 0
+        for line in lines:
+            fields = line.split("\t", 11)
+            if len(fields) < 11:
+                continue
+            flag = int(fields[1])
+            if flag & self.skip_flags or (not self.count_orphans and flag & FLAG_PAIRED
+                                          and not flag & FLAG_PROPER_PAIR):
+                continue
+            chromosome, cigar, sequence = fields[2], fields[5], fields[9]
+            if chromosome == "*" or cigar == "*" or sequence == "*" or int(fields[4]) < self.min_mapping_quality:
+                continue
+            chromosome_id = chromosome_ids.setdefault(chromosome, len(chromosome_ids))
+            strand = 1 if flag & FLAG_REVERSE else 0
+            quality = fields[10].rstrip("\r\n")
+            sequences.append(sequence)
+            qualities.append(quality if quality != "*" else chr(PHRED_OFFSET + MISSING_QUALITY) * len(sequence))
+
+            reference_position = int(fields[3]) - 1
+            query_position = offset
+            for length, operation in CIGAR_PATTERN.findall(cigar):
+                length = int(length)
+                if operation in "M=X":
+                    blocks[0].append(chromosome_id)
+                    blocks[1].append(strand)
+                    blocks[2].append(reference_position)
+                    blocks[3].append(query_position)
+                    blocks[4].append(length)
+                    reference_position += length
+                    query_position += length
+                elif operation == "I" or operation == "S":
+                    query_position += length
+                elif operation == "D":
+                    deletions[0].append(chromosome_id)
+                    deletions[1].append(reference_position)
+                    deletions[2].append(length)
+                    reference_position += length
+                elif operation == "N":
+                    reference_position += length
+            offset += len(sequence)
+
+        if not chromosome_ids:
+            return
+        sequence_buffer = np.frombuffer("".join(sequences).encode(), dtype=np.uint8)
+        quality_buffer = np.frombuffer("".join(qualities).encode(), dtype=np.uint8)
+
+        block_chromosomes, block_positions, within = self._expand(blocks[0], blocks[2], blocks[4])
+        query_positions = np.repeat(np.array(blocks[3], dtype=np.int64), blocks[4]) + within
+        strands = np.repeat(np.array(blocks[1], dtype=np.int64), blocks[4])
+        base_qualities = quality_buffer[query_positions].astype(np.int64) - PHRED_OFFSET
+        codes = BASE_CODES[sequence_buffer[query_positions]].astype(np.int64)
+        kept = base_qualities >= self.min_base_quality
+
+        deletion_chromosomes, deletion_positions, _ = self._expand(*deletions)
+
+        for chromosome, chromosome_id in chromosome_ids.items():
+            in_chromosome = kept & (block_chromosomes == chromosome_id)
+            positions = block_positions[in_chromosome]
+            chromosome_codes = codes[in_chromosome]
+            equal = chromosome_codes == EQUAL_CODE
+            if equal.any():
+                # '=' is the reference base (N beyond the end of the reference)
+                chromosome_codes[equal] = self._reference_codes(chromosome, positions[equal])
+            columns = chromosome_codes + strands[in_chromosome] * ANTISENSE_COLUMN
+            deleted = deletion_positions[deletion_chromosomes == chromosome_id]
+            keys = np.concatenate((positions * NUMBER_OF_COUNT_COLUMNS + columns,
+                                   deleted * NUMBER_OF_COUNT_COLUMNS + DELETION_COLUMN))
+            site_qualities = np.concatenate((base_qualities[in_chromosome], np.zeros(len(deleted), dtype=np.int64)))
+            if len(keys):
+                self.chromosomes.setdefault(chromosome, SiteCounts()).add(keys, site_qualities)
+
+    @staticmethod
+    def _expand(chromosome_ids, starts, lengths):
+        """
+        :return: (chromosome id, reference position, offset in the block) of every position of the blocks
+        """
+        lengths = np.array(lengths, dtype=np.int64)
+        total = int(lengths.sum())
+        block_starts = np.cumsum(lengths) - lengths
+        within = np.arange(total, dtype=np.int64) - np.repeat(block_starts, lengths)
+        positions = np.repeat(np.array(starts, dtype=np.int64), lengths) + within
+        return np.repeat(np.array(chromosome_ids, dtype=np.int64), lengths), positions, within
+
+    def mismatch_reads(self, chromosome, positions, counts):
+        """
+        :param counts: counts array of the sites (see SiteCounts.sites)
+        :return: the number of A,C,G,T reads of every site that differ from its reference base, on both strands
+        (like Utility.pileup_read_counts.mismatch_counts of its pileup line)
+        """
+        site_codes = self._reference_codes(chromosome, positions)
+        mismatches = counts[:, SENSE_COLUMN:SENSE_COLUMN + 4] + counts[:, ANTISENSE_COLUMN:ANTISENSE_COLUMN + 4]
+        with_reference = np.flatnonzero(site_codes < 4)
+        mismatches[with_reference, site_codes[with_reference]] = 0
+        return mismatches.sum(axis=1)
+
+    def mismatch_sites_filter(self, min_mismatches):
+        """
+        :return: sites_filter of pileup_lines that keeps the sites with at least min_mismatches mismatch reads
+        """
+        def sites_filter(chromosome, positions, counts):
+            return self.mismatch_reads(chromosome, positions, counts) >= min_mismatches
+        return sites_filter
+
+    def pileup_lines(self, sites_filter=None, dropped_sites=None):
+        """
+        :param sites_filter: optional function (chromosome, positions, counts) -> boolean mask of the sites to emit
+        :param dropped_sites: optional function (chromosome, positions, depths) called with the sites that
+        sites_filter dropped (e.g. CoverageSummary.add)
+        :return: yields batches of sorted pileup lines
+        """
+        for chromosome in sorted(self.chromosomes):
+            positions, counts, qualities = self.chromosomes[chromosome].sites()
+            if sites_filter is not None:
+                mask = sites_filter(chromosome, positions, counts)
+                if dropped_sites is not None:
+                    dropped_sites(chromosome, positions[~mask], counts[~mask].sum(axis=1))
+                positions, counts, qualities = positions[mask], counts[mask], qualities[mask]
+            for start in range(0, len(positions), PILEUP_BATCH_SITES):
+                end = start + PILEUP_BATCH_SITES
+                references = self.reference.bases(chromosome, positions[start:end]).tobytes().decode("latin-1")
+                yield [site_line(chromosome, position, reference, site_counts, site_qualities)
+                       for position, reference, site_counts, site_qualities in zip(positions[start:end].tolist(),
+                                                                                   references,
+                                                                                   counts[start:end].tolist(),
+                                                                                   qualities[start:end].tolist())]
+
+
+class CoverageSummary:
+    """
+    run length coverage of the sites that are not written to the pileup, and the number of covered sites
+    """
+
+    def __init__(self):
+        self.runs = []
+        self.dropped_sites = 0
+
+    def add(self, chromosome, positions, depths):
+        """
+        :param positions: sorted 0 based positions of the dropped sites of the chromosome
+        :param depths: their depths
+        """
+        if len(positions) == 0:
+            return
+        self.dropped_sites += len(positions)
+        run_starts = np.flatnonzero(np.concatenate(([True], (np.diff(positions) != 1) | (depths[1:] != depths[:-1]))))
+        run_ends = np.append(run_starts[1:], len(positions))
+        self.runs.extend("%s\t%d\t%d\t%d\n" % (chromosome, start, end, depth)
+                         for start, end, depth in zip(positions[run_starts].tolist(),
+                                                      (positions[run_ends - 1] + 1).tolist(),
+                                                      depths[run_starts].tolist()))
+
+    def write(self, summary_file, emitted_sites):
+        """
+        :param emitted_sites: the number of sites that were written to the pileup
+        """
+        with open(summary_file, "w") as out:
+            out.write("# covered_sites\t%d\temitted_sites\t%d\n" % (self.dropped_sites + emitted_sites, emitted_sites))
+            out.writelines(self.runs)
+
+
+def coverage_summary_counts(summary_file):
+    """
+    :return: (number of covered sites before the mismatch filter, number of sites in the pileup) of a coverage summary
+    """
+    with open(summary_file, "r") as fp:
+        fields = fp.readline().split()
+    return int(fields[2]), int(fields[4])
+
+
+def site_line(chromosome, position, reference, counts, qualities):
+    """
+    :param position: 0 based position of the site
+    :param reference: the reference base of the site (N beyond the end of the reference)
+    :param counts: list of the NUMBER_OF_COUNT_COLUMNS counts of the site
+    :param qualities: list of the summed qualities of the counts
+    :return: the pileup line of the site
+    """
+    reference_code = "ACGT".find(reference.upper())
+    if reference_code == -1:
+        reference_code = 4
+    reads, quality = [], []
+    kinds = [(reference_code, ".", ",")] + [(code, nucl, nucl.lower()) for code, nucl in enumerate(NUCLEOTIDES)
+                                            if code != reference_code]
+    for code, sense_char, antisense_char in kinds:
+        for column, char in ((SENSE_COLUMN + code, sense_char), (ANTISENSE_COLUMN + code, antisense_char)):
+            count = counts[column]
+            if count:
+                reads.append(char * count)
+                quality.append(chr(PHRED_OFFSET + min(round(qualities[column] / count), MISSING_QUALITY)) * count)
+    if counts[DELETION_COLUMN]:
+        reads.append("*" * counts[DELETION_COLUMN])
+        quality.append(chr(PHRED_OFFSET) * counts[DELETION_COLUMN])
+    return "%s\t%d\t%s\t%d\t%s\t%s\n" % (chromosome, position + 1, reference, sum(counts), "".join(reads),
+                                         "".join(quality))
+
+
+def write_pileup(line_batches, output_file):
+    """
+    writes batches of pileup lines as a text pileup, or as a binary site file if output_file ends with .rpu
+    :return: the number of written sites
+    """
+    sites = 0
+    if output_file.endswith(".rpu"):
+        reference_lookup = dict()
+        with RpuWriter(output_file) as writer:
+            for lines in line_batches:
+                writer.write_batch(PileupBatch.from_lines(lines, reference_lookup))
+                sites += len(lines)
+    else:
+        with open(output_file, "w") as out:
+            for lines in line_batches:
+                out.writelines(lines)
+                sites += len(lines)
+    return sites
+
+
+def _count_sam(fasta_file, counter_arguments, sam_file):
+    """
+    :return: the site_counts of a single sam file (runs in a worker process)
+    """
+    counter = PileupCounter(fasta_reference(fasta_file), *counter_arguments)
+    logging.info(f"piling up {sam_file}")
+    counter.add_sam(sam_file)
+    return counter.site_counts()
+
+
+def sam_to_pileup(sam_files, fasta_file, output_file, min_base_quality=DEFAULT_MIN_BASE_QUALITY,
+                  min_mapping_quality=0, skip_flags=DEFAULT_SKIP_FLAGS, count_orphans=False, min_mismatches=0,
+                  coverage_summary_file=None, processes=1):
+    """
+    :param sam_files: sam file name, or list of sam files (or iterables of sam lines) that are piled up together
+    (e.g. the sense and antisense alignments of a library)
+    :param fasta_file: the reference of the alignments
+    :param output_file: the sorted pileup (a text pileup, or a binary site file if it ends with .rpu)
+    :param min_base_quality: bases of a lower quality are not counted
+    :param min_mapping_quality: alignments of a lower mapping quality are skipped
+    :param skip_flags: alignments with any of these flags are skipped
+    :param count_orphans: also count paired reads that are not properly paired
+    :param min_mismatches: if positive only the sites with at least min_mismatches mismatch reads are written
+    :param coverage_summary_file: optional coverage summary of the sites that min_mismatches dropped
+    :param processes: number of processes that count sam files (given by name) in parallel, their counts are added
+    :return: output_file
+    """
+    if isinstance(sam_files, str):
+        sam_files = [sam_files]
+    fasta_file = os.path.abspath(fasta_file)
+    counter_arguments = (min_base_quality, min_mapping_quality, skip_flags, count_orphans)
+    counter = PileupCounter(fasta_reference(fasta_file), *counter_arguments)
+    sam_names = [sam for sam in sam_files if isinstance(sam, str)]
+    if processes > 1 and len(sam_names) > 1:
+        # every sam file is piled up by its own counter, and the count arrays are added
+        with multiprocessing.Pool(min(processes, len(sam_names))) as pool:
+            for site_counts in pool.imap_unordered(functools.partial(_count_sam, fasta_file, counter_arguments),
+                                                   sam_names):
+                counter.add_site_counts(site_counts)
+        sam_files = [sam for sam in sam_files if not isinstance(sam, str)]
+    for sam in sam_files:
+        logging.info(f"piling up {sam}")
+        counter.add_sam(sam)
+    if min_mismatches <= 0:
+        write_pileup(counter.pileup_lines(), output_file)
+        return output_file
+    summary = CoverageSummary()
+    emitted_sites = write_pileup(counter.pileup_lines(counter.mismatch_sites_filter(min_mismatches), summary.add),
+                                 output_file)
+    if coverage_summary_file is not None:
+        summary.write(coverage_summary_file, emitted_sites)
+    return output_file
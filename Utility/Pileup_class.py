@@ -1,7 +1,11 @@
 from Utility.generators_utilities import getLineFromChunk
 import re
-from Utility.Annotated_Sequence_Class import Annotated_Sequence
-from copy import deepcopy
+import itertools
+import logging
+import numpy as np
+from Utility.Annotated_Sequence_Class import Annotated_Sequence, SamLineTags
+from Utility.pileup_read_counts import count_reads_strings, count_reads_string, nucleotide_counts, \
+    clean_reads_string
 
 
 class Pileup_line(Annotated_Sequence):
@@ -136,36 +140,227 @@ class Pileup_line(Annotated_Sequence):
 
         :return: the base_string of the pileup lines without indels and ^/$ marks
         """
+        return clean_reads_string(self.reads_string)
 
-        # TODO currently assumes no idels. fix this.
-
-        raw_string_iter = self.reads_string.__iter__()
-        clean_str = [char for char in raw_string_iter if not char in ('^', '$')]
-        clean_str = ''.join(clean_str)
-        return clean_str
+    @property
+    def read_counts(self):
+        """
+        :return: the count vector of the reads string, see Utility.pileup_read_counts for the columns
+        """
+        return count_reads_string(self.reads_string)
 
     @classmethod
     # merge pileup lines
     def merge_pileup_lines(cls, lines):
-        # checks that all reference bases are the same
-        ids = {line.reference_id for line in lines}
-        if len(ids) is not 1:
-            raise ValueError("Lines have different references strings\n" + str(lines) + "\n")
-        positions = {line.gene_pos for line in lines}
-        if len(positions) is not 1:
-            raise ValueError("Lines have different positions\n" + str(lines) + "\n")
-        ref_bases = {line.reference for line in lines}
-        if len(ref_bases) is not 1:
-            raise ValueError("Lines in same positions have different reference nucleotide\n" + str(lines) + "\n")
-
-        # merges reads and quality
-        merged_reads = ''.join([line.reads_string for line in lines])
-        merged_qual = ''.join([line.quality_string for line in lines])
-        total_count = sum([line.base_count for line in lines])
-
-        # creates merge pileup
-        merged_pileup = deepcopy(lines[0])
-        merged_pileup.reads_string = merged_reads
-        merged_pileup.quality_string = merged_qual
+        """
+        :param lines: pileup lines of the same site (e.g. of the sense and antisense pileups of a library)
+        :return: a new pileup line of the site with the reads and qualities of all the lines, and the tags of the
+        first line (the lines are not changed)
+        """
+        first = lines[0]
+        site = (first.reference_id, first._gene_pos, first.reference)
+        reads, qualities = [], []
+        total_count = 0
+        # checks in a single pass that all the lines are of the same reference, position and reference base
+        for line in lines:
+            if (line.reference_id, line._gene_pos, line.reference) != site:
+                if line.reference_id != site[0]:
+                    raise ValueError("Lines have different references strings\n" + str(lines) + "\n")
+                if line._gene_pos != site[1]:
+                    raise ValueError("Lines have different positions\n" + str(lines) + "\n")
+                raise ValueError("Lines in same positions have different reference nucleotide\n" + str(lines) + "\n")
+            reads.append(line.reads_string)
+            qualities.append(line.quality_string)
+            total_count += line.base_count
+
+        # creates merge pileup, a shallow copy of the first line (its fields are strings) with its own tags
+        merged_pileup = cls.__new__(cls)
+        merged_pileup.__dict__ = dict(first.__dict__)
+        merged_pileup.tags = SamLineTags([])
+        merged_pileup.tags.dict = dict(first.tags.dict)
+        merged_pileup.reads_string = ''.join(reads)
+        merged_pileup.quality_string = ''.join(qualities)
         merged_pileup.base_count = total_count
         return merged_pileup
+
+
+class PileupBatch:
+    """
+    Columnar representation of a chunk of pileup lines.
+
+    Instead of building one Pileup_line per site, the numeric fields of a chunk of lines are kept in numpy arrays
+    and the reads, quality and tag strings are kept in three raw byte buffers indexed by offset arrays.
+    Site i reads string is reads[reads_offsets[i]:reads_offsets[i+1]] (same for quality and tags).
+
+    reference_index: int32 array, index of the site reference name in reference_names
+    position: int64 array, the 1-based position of the site
+    reference: uint8 array, the reference base of the site (as an ascii code)
+    base_count: int32 array, the number of reads covering the site (4th pileup column)
+    counts: int32 array of shape (n,5) the number of observed A,C,G,T,N bases of the site ('.' and ',' are counted
+            as the reference base)
+    read_counts: int32 array of shape (n,NUMBER_OF_COLUMNS) the strand aware count vectors of the reads strings,
+            see Utility.pileup_read_counts for the columns
+    """
+    nucleotides = "ACGTN"
+
+    def __init__(self, reference_lookup, reference_index, position, reference, base_count, counts, read_counts,
+                 reads, reads_offsets, quality, quality_offsets, tags, tags_offsets):
+        """
+        :param reference_lookup: dict of reference name to reference index, shared by all batches of a file
+        the rest of the parameters are the columns described in the class documentation
+        """
+        self.reference_lookup = reference_lookup
+        self.reference_index = reference_index
+        self.position = position
+        self.reference = reference
+        self.base_count = base_count
+        self.counts = counts
+        self.read_counts = read_counts
+        self.reads = reads
+        self.reads_offsets = reads_offsets
+        self.quality = quality
+        self.quality_offsets = quality_offsets
+        self.tags = tags
+        self.tags_offsets = tags_offsets
+
+    @classmethod
+    def from_lines(cls, lines, reference_lookup=None):
+        """
+        parses pileup lines into a batch
+        :param lines: iterable of pileup lines (strings)
+        :param reference_lookup: dict of reference name to index, new references are added to it. pass the same
+        dict to all the batches of a file so that the reference indexes are consistent between batches
+        :return: PileupBatch
+        """
+        if reference_lookup is None:
+            reference_lookup = dict()
+
+        reference_index, position, reference, base_count = [], [], [], []
+        reads, quality, tags = [], [], []
+        for line_num, line in enumerate(lines):
+            fields = line.rstrip('\n').split('\t', 6)
+            try:
+                ref_id, pos, ref_base, count, reads_string, quality_string = fields[:6]
+                pos, count = int(pos), int(count)
+            except ValueError:
+                logging.exception(f"In line {line_num} of batch, could not parse pileup line {line!r}")
+                continue
+            index = reference_lookup.get(ref_id)
+            if index is None:
+                index = reference_lookup[ref_id] = len(reference_lookup)
+            reference_index.append(index)
+            position.append(pos)
+            reference.append(ref_base)
+            base_count.append(count)
+            reads.append(reads_string)
+            quality.append(quality_string)
+            tags.append(fields[6] if len(fields) == 7 else '')
+
+        reads_buffer, reads_offsets = cls._pack_strings(reads)
+        quality_buffer, quality_offsets = cls._pack_strings(quality)
+        tags_buffer, tags_offsets = cls._pack_strings(tags)
+        reference = np.frombuffer(''.join(ref_base[:1] or 'N' for ref_base in reference).encode('ascii'),
+                                  dtype=np.uint8)
+        read_counts = count_reads_strings(reads_buffer, reads_offsets)
+
+        return cls(reference_lookup,
+                   np.array(reference_index, dtype=np.int32),
+                   np.array(position, dtype=np.int64),
+                   reference,
+                   np.array(base_count, dtype=np.int32),
+                   nucleotide_counts(read_counts, reference),
+                   read_counts,
+                   reads_buffer, reads_offsets, quality_buffer, quality_offsets, tags_buffer, tags_offsets)
+
+    @staticmethod
+    def _pack_strings(strings):
+        """
+        :param strings: list of ascii strings
+        :return: (bytes buffer of all the strings concatenated, int64 offsets array of length len(strings)+1)
+        """
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in strings], out=offsets[1:])
+        return ''.join(strings).encode('ascii'), offsets
+
+    def __len__(self):
+        return len(self.position)
+
+    @property
+    def reference_names(self):
+        """
+        :return: list of reference names where the i'th name is the name of reference index i
+        """
+        return list(self.reference_lookup.keys())
+
+    def reference_id(self, i):
+        return self.reference_names[self.reference_index[i]]
+
+    def reads_string(self, i):
+        return self.reads[self.reads_offsets[i]:self.reads_offsets[i + 1]].decode('ascii')
+
+    def quality_string(self, i):
+        return self.quality[self.quality_offsets[i]:self.quality_offsets[i + 1]].decode('ascii')
+
+    def tags_string(self, i):
+        return self.tags[self.tags_offsets[i]:self.tags_offsets[i + 1]].decode('ascii')
+
+    def line(self, i, reference_names=None):
+        """
+        :param i: row number in the batch
+        :param reference_names: optional list of reference names (saves recomputing it when called in a loop)
+        :return: the pileup line of row i as a string (without newline)
+        """
+        if reference_names is None:
+            reference_names = self.reference_names
+        fields = [reference_names[self.reference_index[i]], str(self.position[i]), chr(self.reference[i]),
+                  str(self.base_count[i]), self.reads_string(i), self.quality_string(i)]
+        tags = self.tags_string(i)
+        if tags != '':
+            fields.append(tags)
+        return '\t'.join(fields)
+
+    def lines(self, rows=None):
+        """
+        :param rows: optional boolean mask or index array of the rows to return, by default all rows
+        :return: generator of the pileup lines (strings without newline) of the requested rows
+        """
+        reference_names = self.reference_names
+        if rows is None:
+            rows = range(len(self))
+        elif rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        for i in rows:
+            yield self.line(i, reference_names)
+
+    def to_pileup_line(self, i):
+        """
+        :param i: row number in the batch
+        :return: Pileup_line object of row i
+        """
+        return Pileup_line(self.line(i))
+
+    def pileup_lines(self):
+        """
+        :return: generator of Pileup_line objects of all the rows in the batch
+        """
+        for line in self.lines():
+            yield Pileup_line(line)
+
+
+def pileup_batch_generator(file, batch_size=100000, reference_lookup=None):
+    """
+    :param file: an open pileup file
+    :param batch_size: the number of lines in each batch
+    :param reference_lookup: optional dict of reference name to reference index, to share indexes between files
+    :return: generator of PileupBatch objects, all the batches share the same reference_lookup
+    """
+    if reference_lookup is None:
+        reference_lookup = dict()
+    lines = getLineFromChunk(file)
+    while True:
+        chunk = list(itertools.islice(lines, batch_size))
+        if len(chunk) == 0:
+            return
+        chunk = [line for line in chunk if line.strip() != '']
+        if len(chunk) != 0:
+            yield PileupBatch.from_lines(chunk, reference_lookup)
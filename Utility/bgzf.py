@@ -0,0 +1,78 @@
+"""
+BGZF writer
+
+BGZF is the blocked gzip format of bam files (and of bgzip): a series of independent gzip members of at most 64KB
+of data, each with a BC extra field that holds its compressed size, ended by an empty EOF block. A BGZF file is a
+valid gzip file, and a sam written with BgzfWriter is read by samtools and htslib like a bam stream (and indexed
+with samtools index / tabix).
+
+example:
+    with BgzfWriter("merged.sam.gz") as out:
+        out.write("@HD\tVN:1.6\n")
+"""
+import struct
+import zlib
+
+# the data size of a block (as in htslib), its compressed block fits in the 64KB limit of a block
+BLOCK_DATA_SIZE = 0xff00
+DEFAULT_COMPRESS_LEVEL = 6
+# gzip header of a block: ids, deflate, FEXTRA, mtime, xfl, os (unknown), xlen, and the BC subfield with the block size
+_block_header = struct.Struct("<4BI2BH2BHH")
+_block_footer = struct.Struct("<II")
+EOF_BLOCK = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzf_block(data, level=DEFAULT_COMPRESS_LEVEL):
+    """
+    :param data: at most BLOCK_DATA_SIZE bytes
+    :return: the bgzf block of the data
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    compressed = compressor.compress(data) + compressor.flush()
+    block_size = _block_header.size + len(compressed) + _block_footer.size
+    return (_block_header.pack(31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, block_size - 1) + compressed +
+            _block_footer.pack(zlib.crc32(data) & 0xffffffff, len(data)))
+
+
+class BgzfWriter:
+    """
+    writes text (or bytes) to a bgzf file, in blocks of BLOCK_DATA_SIZE bytes
+    """
+
+    def __init__(self, filename, level=DEFAULT_COMPRESS_LEVEL):
+        self.level = level
+        self.fp = open(filename, "wb")
+        self.buffer = bytearray()
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode()
+        self.buffer += data
+        if len(self.buffer) >= BLOCK_DATA_SIZE:
+            full = len(self.buffer) - len(self.buffer) % BLOCK_DATA_SIZE
+            view = memoryview(self.buffer)
+            self.fp.write(b"".join(bgzf_block(bytes(view[start:start + BLOCK_DATA_SIZE]), self.level)
+                                   for start in range(0, full, BLOCK_DATA_SIZE)))
+            view.release()
+            del self.buffer[:full]
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def close(self):
+        if self.fp.closed:
+            return
+        try:
+            if self.buffer:
+                self.fp.write(bgzf_block(bytes(self.buffer), self.level))
+                self.buffer = bytearray()
+            self.fp.write(EOF_BLOCK)
+        finally:
+            self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
@@ -0,0 +1,326 @@
+"""
+Binary pileup format (.rpu)
+
+A .rpu file holds one fixed width record per pileup site, so a filtering stage can open it with numpy.memmap,
+compute a boolean mask over whole columns and gather the rows it keeps, instead of parsing text lines.
+
+.rpu file layout:
+    header (HEADER_SIZE bytes): magic, format version, number of records, offset of the trailer
+    records: number_of_records * record_dtype
+    trailer: json with the reference names (the i'th name is reference index i)
+
+The raw reads, quality and tag strings of each record are kept in a side blob file (<name>.rpu.blob), record i
+strings are blob[blob_offset:blob_offset+reads_length+quality_length+tags_length] in that order.
+
+Converters to and from the text pileup format are pileup_to_rpu and rpu_to_pileup.
+"""
+import json
+import os
+import struct
+import numpy as np
+from Utility.Pileup_class import Pileup_line, pileup_batch_generator
+from Utility.pileup_read_counts import NUMBER_OF_COLUMNS, OTHER_SENSE, OTHER_ANTISENSE, mismatch_counts, \
+    editing_stats_columns
+
+MAGIC = b"RPU\x01"
+FORMAT_VERSION = 1
+HEADER_SIZE = 64
+_header_struct = struct.Struct("<4sIQQ")
+
+BLOB_SUFFIX = ".blob"
+
+# record flags
+FLAG_ANY_CHANGE = 1  # the reads string has a non reference IUPAC letter (Pileup_line.is_with_any_change)
+FLAG_MISMATCH = 2  # the reads string has an A/C/G/T mismatch (the no change filter keeps these sites)
+
+record_dtype = np.dtype([
+    ('reference_index', '<i4'),
+    ('position', '<i8'),
+    ('reference', 'u1'),
+    ('flags', 'u1'),
+    ('base_count', '<i4'),
+    ('read_counts', '<i4', (NUMBER_OF_COLUMNS,)),
+    ('blob_offset', '<i8'),
+    ('reads_length', '<i4'),
+    ('quality_length', '<i4'),
+    ('tags_length', '<i4'),
+])
+
+
+class IllegalRpuFile(Exception):
+    def __init__(self, filename):
+        self.message = f"{filename} is not a valid rpu file"
+
+    def __str__(self):
+        return self.message
+
+    def __repr__(self):
+        return self.message
+
+
+def blob_name(rpu_filename):
+    return rpu_filename + BLOB_SUFFIX
+
+
+def site_flags(read_counts):
+    """
+    :param read_counts: array of shape (n, NUMBER_OF_COLUMNS)
+    :return: uint8 array of the record flags of each site
+    """
+    mismatch = mismatch_counts(read_counts).sum(axis=1) > 0
+    any_change = mismatch | (read_counts[:, 4] > 0) | (read_counts[:, 9] > 0) | \
+                 (read_counts[:, OTHER_SENSE] > 0) | (read_counts[:, OTHER_ANTISENSE] > 0)
+    return (any_change * FLAG_ANY_CHANGE + mismatch * FLAG_MISMATCH).astype(np.uint8)
+
+
+class RpuWriter:
+    """
+    streaming writer of a .rpu file, use as a context manager:
+
+    with RpuWriter("out.rpu") as writer:
+        for batch in pileup_batch_generator(file):
+            writer.write_batch(batch)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.reference_lookup = dict()
+        self.number_of_records = 0
+        self.blob_size = 0
+        self.records_file = open(filename, "wb")
+        self.blob_file = open(blob_name(filename), "wb")
+        self.records_file.write(bytes(HEADER_SIZE))
+
+    def _reference_map(self, reference_names):
+        """
+        :return: int32 array mapping the reference indexes of reference_names to the indexes of this file
+        """
+        mapping = np.empty(len(reference_names), dtype=np.int32)
+        for index, name in enumerate(reference_names):
+            mapping[index] = self.reference_lookup.setdefault(name, len(self.reference_lookup))
+        return mapping
+
+    def write_batch(self, batch, rows=None):
+        """
+        :param batch: PileupBatch
+        :param rows: optional boolean mask or index array of the rows of the batch to write
+        """
+        if rows is None:
+            rows = np.arange(len(batch))
+        elif rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+
+        records = np.zeros(len(rows), dtype=record_dtype)
+        records['reference_index'] = self._reference_map(batch.reference_names)[batch.reference_index[rows]]
+        records['position'] = batch.position[rows]
+        records['reference'] = batch.reference[rows]
+        records['base_count'] = batch.base_count[rows]
+        records['read_counts'] = batch.read_counts[rows]
+        records['flags'] = site_flags(batch.read_counts[rows])
+
+        blob_parts = []
+        for buffer, offsets, length_field in [(batch.reads, batch.reads_offsets, 'reads_length'),
+                                              (batch.quality, batch.quality_offsets, 'quality_length'),
+                                              (batch.tags, batch.tags_offsets, 'tags_length')]:
+            records[length_field] = offsets[rows + 1] - offsets[rows]
+            blob_parts.append((buffer, offsets))
+
+        lengths = records['reads_length'].astype(np.int64) + records['quality_length'] + records['tags_length']
+        records['blob_offset'] = self.blob_size + np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+
+        blob = bytearray()
+        for row in rows:
+            for buffer, offsets in blob_parts:
+                blob += buffer[offsets[row]:offsets[row + 1]]
+        self._write(records, blob)
+
+    def write_records(self, records, blob, reference_names):
+        """
+        writes records gathered from another rpu file
+        :param records: array of record_dtype, their blob_offset are offsets into blob
+        :param blob: bytes-like object holding the strings of the records
+        :param reference_names: the reference names the records reference_index refer to
+        """
+        records = np.array(records, dtype=record_dtype)
+        blob = memoryview(blob)
+        records['reference_index'] = self._reference_map(reference_names)[records['reference_index']]
+        lengths = records['reads_length'].astype(np.int64) + records['quality_length'] + records['tags_length']
+        new_blob = bytearray()
+        for offset, length in zip(records['blob_offset'], lengths):
+            new_blob += blob[offset:offset + length]
+        records['blob_offset'] = self.blob_size + np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+        self._write(records, new_blob)
+
+    def _write(self, records, blob):
+        self.records_file.write(records.tobytes())
+        self.blob_file.write(blob)
+        self.number_of_records += len(records)
+        self.blob_size += len(blob)
+
+    def close(self):
+        trailer_offset = self.records_file.tell()
+        self.records_file.write(json.dumps({"reference_names": list(self.reference_lookup.keys())}).encode())
+        self.records_file.seek(0)
+        self.records_file.write(_header_struct.pack(MAGIC, FORMAT_VERSION, self.number_of_records, trailer_offset))
+        self.records_file.close()
+        self.blob_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RpuFile:
+    """
+    memory mapped reader of a .rpu file.
+    records is a numpy memmap of record_dtype, so filters are computed on whole columns, e.g:
+
+    rpu = RpuFile("sites.rpu")
+    rpu.filter(rpu.records['base_count'] >= 2, "sites_threshold.rpu")
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, "rb") as fp:
+            header = fp.read(HEADER_SIZE)
+            if len(header) < _header_struct.size:
+                raise IllegalRpuFile(filename)
+            magic, version, number_of_records, trailer_offset = _header_struct.unpack_from(header)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise IllegalRpuFile(filename)
+            fp.seek(trailer_offset)
+            self.reference_names = json.loads(fp.read().decode())["reference_names"]
+
+        if number_of_records == 0:
+            self.records = np.zeros(0, dtype=record_dtype)
+        else:
+            self.records = np.memmap(filename, dtype=record_dtype, mode='r', offset=HEADER_SIZE,
+                                     shape=(number_of_records,))
+        if os.path.getsize(blob_name(filename)) == 0:
+            self.blob = b''
+        else:
+            self.blob = np.memmap(blob_name(filename), dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.records)
+
+    def strings(self, i):
+        """
+        :return: (reads_string, quality_string, tags_string) of record i
+        """
+        record = self.records[i]
+        start = int(record['blob_offset'])
+        reads_end = start + int(record['reads_length'])
+        quality_end = reads_end + int(record['quality_length'])
+        tags_end = quality_end + int(record['tags_length'])
+        raw = bytes(self.blob[start:tags_end])
+        return (raw[:reads_end - start].decode('ascii'), raw[reads_end - start:quality_end - start].decode('ascii'),
+                raw[quality_end - start:].decode('ascii'))
+
+    def line(self, i):
+        """
+        :return: the text pileup line of record i (without newline)
+        """
+        record = self.records[i]
+        reads_string, quality_string, tags_string = self.strings(i)
+        fields = [self.reference_names[record['reference_index']], str(record['position']),
+                  chr(record['reference']), str(record['base_count']), reads_string, quality_string]
+        if tags_string != '':
+            fields.append(tags_string)
+        return '\t'.join(fields)
+
+    def lines(self, rows=None):
+        """
+        :param rows: optional boolean mask or index array of the records, by default all records
+        :return: generator of text pileup lines (without newline)
+        """
+        if rows is None:
+            rows = range(len(self))
+        elif rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        for i in rows:
+            yield self.line(i)
+
+    def to_pileup_line(self, i):
+        return Pileup_line(self.line(i))
+
+    def filter(self, mask, output_filename, chunk_size=1000000):
+        """
+        writes the records selected by mask into a new rpu file
+        :param mask: boolean array over the records (or index array)
+        :param output_filename: the output rpu file name
+        :param chunk_size: number of selected records gathered at a time
+        :return: output_filename
+        """
+        rows = np.flatnonzero(mask) if np.asarray(mask).dtype == bool else np.asarray(mask)
+        with RpuWriter(output_filename) as writer:
+            for start in range(0, len(rows), chunk_size):
+                records = self.records[rows[start:start + chunk_size]]
+                writer.write_records(records, self.blob, self.reference_names)
+        return output_filename
+
+
+def pileup_to_rpu(pileup_filename, rpu_filename, batch_size=100000):
+    """
+    converts a text pileup into a rpu file
+    :return: rpu_filename
+    """
+    with open(pileup_filename, "r") as pileup, RpuWriter(rpu_filename) as writer:
+        for batch in pileup_batch_generator(pileup, batch_size=batch_size):
+            writer.write_batch(batch)
+    return rpu_filename
+
+
+def rpu_to_pileup(rpu_filename, pileup_filename, rows=None):
+    """
+    converts a rpu file (or the rows of it selected by a mask) into a text pileup
+    :return: pileup_filename
+    """
+    rpu = RpuFile(rpu_filename)
+    with open(pileup_filename, "w") as out:
+        for line in rpu.lines(rows):
+            out.write(line + "\n")
+    return pileup_filename
+
+
+def categories_mask(records, reads_threshold=None, any_change=None, editing_min_percent=None,
+                    editing_max_percent=None, noise_percent=None, editing_read_thresh=0):
+    """
+    vectorized version of the filters of Processing.analyze_editing_percent.filter_pileup_by_categories
+    :param records: array of record_dtype
+    the rest of the parameters are the same as in filter_pileup_by_categories
+    :return: boolean mask of the records that pass the filter
+    """
+    mask = np.zeros(len(records), dtype=bool)
+    base_count = records['base_count']
+    if reads_threshold is None and not any_change and editing_min_percent is None:
+        return mask
+
+    _, candidate_reads, editing_percent, noise = editing_stats_columns(records['read_counts'], base_count)
+
+    if reads_threshold is not None:
+        mask |= base_count >= reads_threshold
+
+    if any_change:
+        mask |= (base_count >= 1) & (editing_percent != 0.0)
+
+    if editing_min_percent is not None:
+        editing_max_percent = 100 if editing_max_percent is None else editing_max_percent
+        noise_percent = 100 if noise_percent is None else noise_percent
+        mask |= (base_count >= 1) & (editing_percent >= editing_min_percent) & \
+                (editing_percent <= editing_max_percent) & (noise <= noise_percent) & (editing_percent != 0.0) & \
+                (candidate_reads >= editing_read_thresh)
+    return mask
+
+
+def filter_rpu_by_categories(rpu_filename, output, **categories):
+    """
+    filters a rpu file by the categories of filter_pileup_by_categories (see categories_mask)
+    :param rpu_filename: input rpu file
+    :param output: output rpu file
+    :return: output
+    """
+    rpu = RpuFile(rpu_filename)
+    return rpu.filter(categories_mask(rpu.records, **categories), output)
@@ -1,5 +1,9 @@
+import os
 import pandas as pd
 
+# suffix of the file that holds the number of sites of a pileup, written by the filter chain
+COUNT_SUFFIX = ".count"
+
 def column_delta_df(df:pd.DataFrame)->pd.DataFrame:
     """
     returns a DataFrame where each colum j but the last takes the value of col[j]-col[j-1]
@@ -28,3 +32,27 @@ def get_line_count(filename):
     f = open(filename, 'rb')
     f_gen = _make_gen(f.raw.read)
     return sum(buf.count(b'\n') for buf in f_gen)
+
+
+def write_site_count(filename, count):
+    """
+    writes the number of sites (lines) of filename next to it, to filename + COUNT_SUFFIX
+    :param filename: file name (that may not be written)
+    :param count: number of lines of the file
+    """
+    with open(filename + COUNT_SUFFIX, "w") as fp:
+        fp.write("%d\n" % count)
+
+
+def get_site_count(filename):
+    """
+    :param filename: file name
+    :return: number of lines in file, taken from its count file if the count file is not older than the file
+    (or the file was not written)
+    """
+    count_filename = filename + COUNT_SUFFIX
+    if os.path.isfile(count_filename) and (not os.path.isfile(filename) or
+                                           os.path.getmtime(count_filename) >= os.path.getmtime(filename)):
+        with open(count_filename, "r") as fp:
+            return int(fp.read())
+    return get_line_count(filename)
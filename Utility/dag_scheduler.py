@@ -0,0 +1,253 @@
+"""
+Resource aware scheduler of a DAG of tasks
+
+Nodes are added with their dependencies and resource needs (number of cpus and a memory hint). The graph is
+validated before anything runs (unknown dependencies and cycles are errors). Nodes whose dependencies finished enter
+a ready queue ordered by priority, and a ready node is started in a worker thread once its cpus and memory fit in
+the global budget of the scheduler, so parallel nodes never oversubscribe the machine.
+
+example:
+    scheduler = DagScheduler(cpu_budget=12)
+    scheduler.add_node("norep", align_norep, cpus=12)
+    scheduler.add_node("rep", align_rep, dependencies=["norep"], cpus=12)
+    results = scheduler.run()  # {"norep": align_norep(12), "rep": align_rep(12)}
+
+a node function is called with the number of cpus reserved for it (at most cpu_budget).
+the nodes run in threads of the scheduler, a node whose python work should not share the GIL with the other nodes
+runs it in a child process with run_in_process, and keeps its reservation until the process is done.
+"""
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import threading
+import traceback
+from collections import namedtuple
+
+DagNode = namedtuple('DagNode', ['id', 'function', 'dependencies', 'cpus', 'memory', 'priority'])
+
+
+class DagError(ValueError):
+    pass
+
+
+class DagNodeError(Exception):
+    def __init__(self, node_id, error):
+        self.node_id = node_id
+        self.error = error
+        self.message = f"node {node_id} failed: {error!r}"
+        super().__init__(self.message)
+
+
+def _run_and_send(sender, function, args, kwargs):
+    try:
+        result = (True, function(*args, **kwargs))
+    except BaseException as e:
+        result = (False, e, traceback.format_exc())
+    try:
+        sender.send(result)
+    except Exception:
+        # the result or the exception can't be pickled
+        message = result[2] if not result[0] else traceback.format_exc()
+        sender.send((False, RuntimeError(message), message))
+    finally:
+        sender.close()
+
+
+def run_in_process(function, *args, **kwargs):
+    """
+    runs function(*args, **kwargs) in a child process (multiprocessing.Process) and waits for it, so the python work of
+    a node runs in parallel with the other nodes instead of sharing the GIL of the scheduler threads
+    :return: the return value of the function
+    :raise: the exception of the function (a RuntimeError with its traceback if it can't be pickled)
+    """
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=_run_and_send, args=(sender, function, args, kwargs))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    finally:
+        receiver.close()
+        process.join()
+    if result is None:
+        raise RuntimeError(f"the process of {function} exited with code {process.exitcode} without a result")
+    if not result[0]:
+        raise result[1]
+    return result[1]
+
+
+def validate_dag(dependencies):
+    """
+    :param dependencies: dict of node id to an iterable of the ids of its dependencies
+    :return: the node ids in a topological order
+    :raise DagError: if a dependency is not a node of the graph, or the graph has a cycle
+    """
+    for node_id, node_dependencies in dependencies.items():
+        for dependency in node_dependencies:
+            if dependency not in dependencies:
+                raise DagError(f"{node_id} depends on {dependency} which is not in the graph")
+
+    remaining = {node_id: len(set(node_dependencies)) for node_id, node_dependencies in dependencies.items()}
+    dependents = {node_id: [] for node_id in dependencies}
+    for node_id, node_dependencies in dependencies.items():
+        for dependency in set(node_dependencies):
+            dependents[dependency].append(node_id)
+
+    order = [node_id for node_id, count in remaining.items() if count == 0]
+    for node_id in order:
+        for dependent in dependents[node_id]:
+            remaining[dependent] -= 1
+            if remaining[dependent] == 0:
+                order.append(dependent)
+
+    if len(order) != len(dependencies):
+        cycle_nodes = sorted(str(node_id) for node_id, count in remaining.items() if count > 0)
+        raise DagError(f"the graph has a cycle between the nodes {cycle_nodes}")
+    return order
+
+
+def critical_path_priorities(dependencies, weights=None):
+    """
+    :param dependencies: dict of node id to an iterable of the ids of its dependencies
+    :param weights: optional dict of node id to its cost (e.g. expected running time), 1 for nodes not in it
+    :return: dict of node id to the cost of the longest path from the node to the end of the graph (the node
+    included), so nodes on the critical path get the highest priority
+    """
+    weights = weights or dict()
+    dependents = {node_id: [] for node_id in dependencies}
+    for node_id, node_dependencies in dependencies.items():
+        for dependency in set(node_dependencies):
+            dependents[dependency].append(node_id)
+
+    priorities = dict()
+    for node_id in reversed(validate_dag(dependencies)):
+        longest_tail = max((priorities[dependent] for dependent in dependents[node_id]), default=0)
+        priorities[node_id] = weights.get(node_id, 1) + longest_tail
+    return priorities
+
+
+class DagScheduler:
+
+    def __init__(self, cpu_budget=None, memory_budget=None):
+        """
+        :param cpu_budget: number of cpus the running nodes may reserve together (default: all the cpus)
+        :param memory_budget: bytes of memory the running nodes may reserve together (default: no limit)
+        """
+        self.cpu_budget = cpu_budget if cpu_budget is not None else os.cpu_count() or 1
+        self.memory_budget = memory_budget
+        self.nodes = dict()
+
+    def add_node(self, node_id, function, dependencies=(), cpus=1, memory=0, priority=0):
+        """
+        :param node_id: hashable id of the node
+        :param function: called with the number of reserved cpus when the dependencies are done
+        :param dependencies: ids of the nodes that must finish before this node starts
+        :param cpus: number of cpus the node uses (reserved from the budget, at most the budget)
+        :param memory: memory hint of the node in bytes (reserved from the memory budget)
+        :param priority: ready nodes with a higher priority start first
+        """
+        if node_id in self.nodes:
+            raise DagError(f"node {node_id} was added twice")
+        cpus = max(1, min(int(cpus), self.cpu_budget))
+        if self.memory_budget is not None:
+            memory = min(memory, self.memory_budget)
+        self.nodes[node_id] = DagNode(node_id, function, tuple(dependencies), cpus, memory, priority)
+
+    def validate(self):
+        return validate_dag({node_id: node.dependencies for node_id, node in self.nodes.items()})
+
+    def prioritize_critical_path(self, weights=None):
+        """
+        sets the priority of every node to the cost of its longest path to the end of the graph
+        (see critical_path_priorities), so long chains of dependent nodes start as early as possible
+        """
+        priorities = critical_path_priorities({node_id: node.dependencies for node_id, node in self.nodes.items()},
+                                              weights)
+        for node_id, node in self.nodes.items():
+            self.nodes[node_id] = node._replace(priority=priorities[node_id])
+
+    def run(self):
+        """
+        runs all the nodes, after the first failure no new node is started
+        :return: dict of node id to the return value of its function
+        :raise DagNodeError: of the first node that failed (after the running nodes finished)
+        """
+        self.validate()
+
+        condition = threading.Condition()
+        remaining = {node_id: len(set(node.dependencies)) for node_id, node in self.nodes.items()}
+        dependents = {node_id: [] for node_id in self.nodes}
+        for node_id, node in self.nodes.items():
+            for dependency in set(node.dependencies):
+                dependents[dependency].append(node_id)
+
+        counter = itertools.count()
+        ready = []
+        results = dict()
+        errors = []
+        state = {"cpus": 0, "memory": 0, "running": 0}
+
+        def push_ready(node_id):
+            heapq.heappush(ready, (-self.nodes[node_id].priority, next(counter), node_id))
+
+        def fits(node):
+            if state["cpus"] + node.cpus > self.cpu_budget:
+                return False
+            if self.memory_budget is not None and state["memory"] + node.memory > self.memory_budget:
+                return False
+            return True
+
+        def worker(node):
+            try:
+                result = node.function(node.cpus)
+                error = None
+            except BaseException as e:
+                logging.exception(f"node {node.id} failed")
+                result, error = None, e
+            with condition:
+                state["cpus"] -= node.cpus
+                state["memory"] -= node.memory
+                state["running"] -= 1
+                if error is not None:
+                    errors.append(DagNodeError(node.id, error))
+                else:
+                    results[node.id] = result
+                    for dependent in dependents[node.id]:
+                        remaining[dependent] -= 1
+                        if remaining[dependent] == 0:
+                            push_ready(dependent)
+                condition.notify_all()
+
+        for node_id, count in remaining.items():
+            if count == 0:
+                push_ready(node_id)
+
+        with condition:
+            while True:
+                if not errors:
+                    # start the ready nodes that fit, in priority order
+                    waiting = []
+                    while ready:
+                        entry = heapq.heappop(ready)
+                        node = self.nodes[entry[2]]
+                        if not fits(node):
+                            waiting.append(entry)
+                            continue
+                        state["cpus"] += node.cpus
+                        state["memory"] += node.memory
+                        state["running"] += 1
+                        threading.Thread(target=worker, args=(node,), name=f"dag-{node.id}", daemon=True).start()
+                    for entry in waiting:
+                        heapq.heappush(ready, entry)
+
+                if state["running"] == 0 and (errors or not ready):
+                    break
+                condition.wait()
+
+        if errors:
+            raise errors[0]
+        return results
@@ -0,0 +1,188 @@
+"""
+Read id index of a fastq library
+
+The index maps the id of every read (the first word of its header line, without the '@') to the byte offset of its
+record in the fastq. It is built once, stored next to the fastq (<fastq>.rdx.npy, with <fastq>.rdx.json holding the
+size and modification time of the indexed fastq) and loaded as a memory map, so reverting 3nt reads to their
+original 4nt sequence is a streaming lookup that needs no sort of the library or of the reads.
+
+The index is a (2, number of reads) uint64 array of the hashes (row 0) and the offsets (row 1) sorted by hash, where
+hash is a 64 bit blake2b digest of the read id.
+Reads are found with a binary search and the id in the fastq is compared, so hash collisions are handled.
+"""
+import hashlib
+import json
+import mmap
+import os
+import uuid
+from array import array
+import numpy as np
+
+INDEX_SUFFIX = ".rdx.npy"
+META_SUFFIX = ".rdx.json"
+INDEX_VERSION = 1
+
+
+def read_id_hash(read_id):
+    """
+    :param read_id: read id (str or bytes)
+    :return: 64 bit hash of the read id
+    """
+    if isinstance(read_id, str):
+        read_id = read_id.encode()
+    return int.from_bytes(hashlib.blake2b(read_id, digest_size=8).digest(), 'little')
+
+
+def fastq_read_id(header):
+    """
+    :param header: fastq header line (str or bytes), with or without the '@'
+    :return: the read id - the first word of the header without the '@'
+    """
+    words = header.split(None, 1)
+    if not words:
+        return header[:0]
+    read_id = words[0]
+    return read_id[1:] if read_id[:1] in ('@', b'@') else read_id
+
+
+def _fastq_stat(fastq_filename):
+    stat = os.stat(fastq_filename)
+    return {"version": INDEX_VERSION, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def is_index_valid(fastq_filename):
+    """
+    :return: True if the index of fastq_filename exists and was built from the current fastq
+    """
+    try:
+        with open(fastq_filename + META_SUFFIX, "r") as fp:
+            meta = json.load(fp)
+    except (OSError, ValueError):
+        return False
+    if not os.path.isfile(fastq_filename + INDEX_SUFFIX):
+        return False
+    current = _fastq_stat(fastq_filename)
+    return all(meta.get(key) == value for key, value in current.items())
+
+
+def build_fastq_index(fastq_filename):
+    """
+    builds the index of a fastq file (blank lines between records are skipped).
+    the index files are written to temporary names and renamed, so concurrent builders of the same index are safe
+    :param fastq_filename: the fastq file
+    :return: number of indexed reads
+    """
+    meta = _fastq_stat(fastq_filename)
+    hashes = array('Q')
+    offsets = array('Q')
+    with open(fastq_filename, "rb") as fp:
+        offset = 0
+        for header in fp:
+            if header.strip() == b'':
+                offset += len(header)
+                continue
+            hashes.append(read_id_hash(fastq_read_id(header)))
+            offsets.append(offset)
+            offset += len(header)
+            for _ in range(3):
+                offset += len(fp.readline())
+
+    index = np.array([hashes, offsets], dtype=np.uint64).reshape(2, len(hashes))
+    index = index[:, np.argsort(index[0], kind='stable')]
+
+    unique = uuid.uuid4().hex
+    temp_index = "%s.%s%s" % (fastq_filename, unique, INDEX_SUFFIX)
+    temp_meta = "%s.%s%s" % (fastq_filename, unique, META_SUFFIX)
+    np.save(temp_index, index)
+    meta["records"] = len(hashes)
+    with open(temp_meta, "w") as fp:
+        json.dump(meta, fp)
+    os.replace(temp_index, fastq_filename + INDEX_SUFFIX)
+    os.replace(temp_meta, fastq_filename + META_SUFFIX)
+    return len(hashes)
+
+
+class FastqIndex:
+    """
+    memory mapped read id index of a fastq library, built on first use:
+
+    with FastqIndex(fastq_lib) as index:
+        record = index.get(read_id)  # the 4 lines of the read (without newlines) or None
+    """
+
+    def __init__(self, fastq_filename, build=True):
+        """
+        :param fastq_filename: the indexed fastq
+        :param build: build the index if it is missing or older than the fastq
+        """
+        self.fastq_filename = fastq_filename
+        if not is_index_valid(fastq_filename):
+            if not build:
+                raise FileNotFoundError(f"no valid index for {fastq_filename}")
+            build_fastq_index(fastq_filename)
+
+        self.index = np.load(fastq_filename + INDEX_SUFFIX, mmap_mode='r')
+        self.hashes = self.index[0]
+        self.offsets = self.index[1]
+        self._fastq_file = open(fastq_filename, "rb")
+        if os.path.getsize(fastq_filename) > 0:
+            self._fastq = mmap.mmap(self._fastq_file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._fastq = b''
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def record_at(self, offset):
+        """
+        :param offset: byte offset of a record in the fastq
+        :return: list of the 4 lines of the record (str, without newlines)
+        """
+        lines = []
+        start = offset
+        for _ in range(4):
+            end = self._fastq.find(b'\n', start)
+            if end == -1:
+                end = len(self._fastq)
+            lines.append(self._fastq[start:end].rstrip(b'\r').decode())
+            start = end + 1
+        return lines
+
+    def _find(self, read_id, start, end):
+        for position in range(start, end):
+            record = self.record_at(int(self.offsets[position]))
+            if fastq_read_id(record[0]) == read_id:
+                return record
+        return None
+
+    def get(self, read_id):
+        """
+        :param read_id: the read id (without '@')
+        :return: list of the 4 lines of the read (without newlines) or None if the read is not in the library
+        """
+        hash_value = np.uint64(read_id_hash(read_id))
+        start = int(np.searchsorted(self.hashes, hash_value, side='left'))
+        end = int(np.searchsorted(self.hashes, hash_value, side='right'))
+        return self._find(read_id, start, end)
+
+    def get_many(self, read_ids):
+        """
+        batched version of get, the binary searches of all read ids are done together
+        :param read_ids: list of read ids
+        :return: list of the records (or None) of the read ids
+        """
+        hash_values = np.array([read_id_hash(read_id) for read_id in read_ids], dtype=np.uint64)
+        starts = np.searchsorted(self.hashes, hash_values, side='left')
+        ends = np.searchsorted(self.hashes, hash_values, side='right')
+        return [self._find(read_id, int(start), int(end)) for read_id, start, end in zip(read_ids, starts, ends)]
+
+    def close(self):
+        if isinstance(self._fastq, mmap.mmap):
+            self._fastq.close()
+        self._fastq_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
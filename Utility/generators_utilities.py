@@ -1,9 +1,22 @@
 from Utility.temp_files import new_temp_file
-from Utility.strip_last_newline import strip_last_NL
 import os
+import sys
+import gzip
+import heapq
+import pickle
 import operator
 import itertools
 import logging
+import multiprocessing
+
+# memory budget of the lines buffered by the external sort before a sorted run is spilled to disk
+DEFAULT_SORT_MEMORY = 2 ** 30
+# estimated memory of a buffered (key, line) pair on top of the line itself
+SORT_PAIR_OVERHEAD = 200
+# number of (key, line) pairs pickled together in a run file
+RUN_BLOCK_SIZE = 10000
+# maximal number of runs merged at once, more runs are first merged in intermediate passes
+MAX_MERGE_FANIN = 128
 
 def fileGetChunks(file1, size=10000):
     """
@@ -61,27 +74,183 @@ def getKLinesFromChunk(file, size=40000, k=4, remove_header=False):
     return
 
 
-def key_sorted_gen(key, file=None, gen=None, *args, **kwargs):
-    is_gen = True  # incdicate wheather gen param was received
-    if not gen:
-        is_gen = False
-        gen = getLineFromChunk(file, *args, **kwargs)
-
-    sorted_file = new_temp_file()
-    with open(sorted_file, "w+") as fp:
-        for obj in sorted(gen, key=key):
-            if not is_gen:
-                fp.write(str(obj))
+def _open_run(run, mode, compress):
+    if compress:
+        return gzip.open(run, mode, compresslevel=1)
+    return open(run, mode)
+
+
+def _write_run(pairs, compress=False, temp_dir=None, is_sorted=False):
+    """
+    writes a run file of (key, value) pairs
+    :param pairs: list (or iterable if is_sorted) of (key, value) pairs
+    :param compress: write the run gzip compressed
+    :param temp_dir: directory of the run file (default of new_temp_file if None)
+    :param is_sorted: the pairs are already sorted by key, else the list is sorted (stable) before it is written
+    :return: the run file name
+    """
+    if not is_sorted:
+        pairs.sort(key=operator.itemgetter(0))
+    run = new_temp_file() if temp_dir is None else new_temp_file(dir=temp_dir)
+    with _open_run(run, "wb", compress) as fp:
+        pairs = iter(pairs)
+        block = list(itertools.islice(pairs, RUN_BLOCK_SIZE))
+        while block:
+            pickle.dump(block, fp, protocol=pickle.HIGHEST_PROTOCOL)
+            block = list(itertools.islice(pairs, RUN_BLOCK_SIZE))
+    return run
+
+
+def _read_run(run, compress=False):
+    """
+    :return: generator of the (key, value) pairs of a run file
+    """
+    with _open_run(run, "rb", compress) as fp:
+        while True:
+            try:
+                block = pickle.load(fp)
+            except EOFError:
+                return
+            yield from block
+
+
+def _merge_runs(runs, compress=False):
+    """
+    stable k-way merge of run files (pairs with equal keys are taken from the earlier run first)
+    :return: generator of (key, value) pairs
+    """
+    return heapq.merge(*[_read_run(run, compress) for run in runs], key=operator.itemgetter(0))
+
+
+def _spilled_runs(pairs, memory_limit, compress, processes, temp_dir):
+    """
+    buffers pairs up to memory_limit, sorts each buffer and spills it to a run file
+    :return: (runs, last buffer) - the last buffer is not spilled (and not sorted)
+    """
+    runs = []
+    pending = []
+    pool = multiprocessing.Pool(processes) if processes > 1 else None
+    # with a pool, processes buffers can be in flight at once
+    buffer_limit = memory_limit // processes if pool else memory_limit
+    try:
+        buffer = []
+        buffer_size = 0
+        for pair in pairs:
+            buffer.append(pair)
+            buffer_size += sys.getsizeof(pair[1]) + SORT_PAIR_OVERHEAD
+            if buffer_size < buffer_limit:
+                continue
+
+            if pool:
+                pending.append(pool.apply_async(_write_run, (buffer, compress, temp_dir)))
+                if len(pending) >= processes:
+                    runs.append(pending.pop(0).get())
             else:
-                fp.write(str(obj) + '\n')
+                runs.append(_write_run(buffer, compress, temp_dir))
+            buffer = []
+            buffer_size = 0
+
+        runs.extend(result.get() for result in pending)
+        return runs, buffer
+    except BaseException:
+        runs.extend(result.get() for result in pending if result.ready() and result.successful())
+        for run in runs:
+            os.remove(run)
+        raise
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+
+def external_sort_pairs(pairs, memory_limit=DEFAULT_SORT_MEMORY, compress=False, processes=1, temp_dir=None):
+    """
+    bounded memory stable sort of (key, value) pairs.
+    pairs are buffered up to memory_limit, each buffer is sorted and spilled to a temporary run file,
+    and the runs are merged while streaming. if the input fits in memory it is sorted without touching the disk.
+    :param pairs: iterable of (key, value) pairs, keys and values must be picklable
+    :param memory_limit: approximated memory (in bytes) of the buffered pairs
+    :param compress: gzip the run files (less disk and IO, more cpu)
+    :param processes: number of processes sorting and spilling the runs in parallel
+    :param temp_dir: directory of the run files
+    :return: generator of the values sorted by their keys
+    """
+    runs, buffer = _spilled_runs(pairs, memory_limit, compress, processes, temp_dir)
+    try:
+        buffer.sort(key=operator.itemgetter(0))
+        if not runs:
+            for pair in buffer:
+                yield pair[1]
+            return
 
-    strip_last_NL(sorted_file)
+        if buffer:
+            runs.append(_write_run(buffer, compress, temp_dir, is_sorted=True))
+        buffer = None
+
+        # intermediate merge passes, so the number of open run files is bounded
+        # (runs[:index] are merged runs of this pass, runs[index:] are not merged yet)
+        while len(runs) > MAX_MERGE_FANIN:
+            for index in range((len(runs) + MAX_MERGE_FANIN - 1) // MAX_MERGE_FANIN):
+                group = runs[index:index + MAX_MERGE_FANIN]
+                merged_run = _write_run(_merge_runs(group, compress), compress, temp_dir, is_sorted=True)
+                runs[index:index + MAX_MERGE_FANIN] = [merged_run]
+                for run in group:
+                    os.remove(run)
+
+        for pair in _merge_runs(runs, compress):
+            yield pair[1]
+    finally:
+        for run in runs:
+            if os.path.exists(run):
+                os.remove(run)
+
+
+def external_sorted(iterable, key, **sort_kwargs):
+    """
+    bounded memory version of sorted(iterable, key=key), see external_sort_pairs for the sort parameters
+    """
+    return external_sort_pairs(((key(obj), obj) for obj in iterable), **sort_kwargs)
 
-    with open(sorted_file, "r") as sorted_fp:
-        for line in getLineFromChunk(sorted_fp):
-            yield line
 
-    os.remove(sorted_file)
+def lines_sorted_gen(key, lines, **sort_kwargs):
+    """
+    sorts text lines with the external sort.
+    every line gets a newline except the last line of the output (like key_sorted_gen)
+    :param key: key function of a line
+    :param lines: iterable of lines
+    :param sort_kwargs: parameters of external_sort_pairs
+    :return: generator of the sorted lines
+    """
+    lines = (line if line.endswith('\n') else line + '\n' for line in lines)
+    yield from _strip_last_newline_gen(external_sort_pairs(((key(line), line) for line in lines), **sort_kwargs))
+
+
+def _strip_last_newline_gen(lines):
+    previous = None
+    for line in lines:
+        if previous is not None:
+            yield previous
+        previous = line
+    if previous is not None:
+        yield previous.rstrip('\r\n')
+
+
+def key_sorted_gen(key, file=None, gen=None, *args, sort_kwargs=None, **kwargs):
+    """
+    sorts the lines of a file (or the objects of a generator) by key, with a bounded memory external sort
+    :param key: key function of the lines (or objects)
+    :param file: an open file, used if gen is not given
+    :param gen: generator of objects, their str() is sorted
+    :param sort_kwargs: parameters of external_sort_pairs (memory_limit, compress, processes, temp_dir)
+    :return: generator of the sorted lines, the last line without a newline
+    """
+    sort_kwargs = sort_kwargs or {}
+    if not gen:
+        yield from lines_sorted_gen(key, getLineFromChunk(file, *args, **kwargs), **sort_kwargs)
+        return
+
+    pairs = ((key(obj), str(obj) + '\n') for obj in gen)
+    yield from _strip_last_newline_gen(external_sort_pairs(pairs, **sort_kwargs))
 
 
 def skip_broken_lines_factory(class_name):
@@ -1,99 +1,126 @@
+import heapq
 
-def parallel_generator(generators, functors):
+
+def parallel_generator(generators, functors, index_tuples=False):
     """
-    :param generators: A list of k generators (initialized) repersenting files, 
+    :param generators: A list of k generators (initialized) repersenting files,
                                        file are sorted with respect to the functors.
     :param functors: A list of k functors (must be the same size as the generators),
                                        that return a comparable object (comaprable with < ).
+    :param index_tuples: If True, instead of a k-list each yield is a tuple of (index, objects) pairs,
+                                       one for each generator that has objects in the equivalence class,
+                                       ordered by the generator index.
+                                       For example (where k = 3): ((1, [object1]), (2, [object2, object3]))
     :output: Each yield returns the next equivalence class according to the sorting
                      in a format of a k-list with None if the generator didn't have an
                      object of that equivalence class. Each entry in the list is also
-                     a list of the objects in that equivalence class that the 
+                     a list of the objects in that equivalence class that the
                      corresponding generator produced.
                      For example output may look like this (where k = 3): [None,[object1], [object2, object3]]
+
+    The merge keeps a heap of the (key, generator index) of the current object of each generator,
+    the key of every object is computed once by its functor.
     """
+    if len(generators) == 2:
+        yield from _parallel_generator_two(generators, functors, index_tuples)
+        return
 
-    # Work buffer, lines that aren't in output yet reside here
-    #current_lines = [generator.__next__() if generator is not None else None for generator in generators]
-    current_lines = []
-    for generator in generators:
+    number_of_files = len(generators)
+    # current object of each generator, the heap holds the keys of the generators that didn't finish
+    current_lines = [None] * number_of_files
+    heap = []
+    for index, (generator, func) in enumerate(zip(generators, functors)):
         try:
             line = next(generator)
         except StopIteration:
-            line = None
-        current_lines.append(line)
-
-    if len(current_lines) == current_lines.count(None):
-        return
-
-    finished_files = 0
-    number_of_files = len(generators)
-    # Boolean array for which generator finished
-    listOfFinished = [0 for index in range(len(generators))]
-
-
-    # Actual logic
-    while (finished_files < number_of_files) :  # As long as not all files ended
-        current_intervals = [func(line) if line is not None else None for line, func in zip(
-            current_lines, functors)]  # Extracting (str,int)
-
-        # Sort the intervals according to the (default) sorting of the given
-        # object
-        current_intervals_sorted = sorted(
-            [interval for interval in current_intervals if interval is not None])
+            continue
+        current_lines[index] = line
+        heap.append((func(line), index))
+    heapq.heapify(heap)
+
+    while heap:
+        min_interval, index = heapq.heappop(heap)
+        equivalence_class_indexes = [index]
+        while heap and heap[0][0] == min_interval:
+            equivalence_class_indexes.append(heapq.heappop(heap)[1])
+        equivalence_class_indexes.sort()
+
+        if index_tuples:
+            next_equivalence_class = []
+        else:
+            next_equivalence_class = [None] * number_of_files
+
+        # take from each generator all of its consecutive objects of the equivalence class
+        for i in equivalence_class_indexes:
+            objects = _take_equivalence_class(generators[i], functors[i], current_lines, i, min_interval, heap)
+            if index_tuples:
+                next_equivalence_class.append((i, objects))
+            else:
+                next_equivalence_class[i] = objects
 
-        min_interval = current_intervals_sorted[0]  # Minimum interval
+        yield tuple(next_equivalence_class) if index_tuples else next_equivalence_class
 
-        # Get all the indexes (in the original list) of the lines with the same
-        # minimal equivalence class
-        equivalence_class_indexes = [index for index in range(
-            len(current_intervals)) if (current_intervals[index] == min_interval)]
+    return  # When all generators finished
 
-        # Number of generators that generated in current eq. class
-        num_gen_curr_eq_class = len(equivalence_class_indexes)
 
-        # Init output list with Nones
-        next_equivalence_class = [None] * len(generators)
-        # Init lists for generators that outputed
-        for i in equivalence_class_indexes:
-            next_equivalence_class[i] = []
-
-        # For each generator check if he generated an object(line) in the equivalence class,
-        # If it did add the object to the output list and try to add next line
-        # until he stops generating from this eq. class (else it stays None)
-        while(num_gen_curr_eq_class > 0):
-            for i in equivalence_class_indexes:
-                next_equivalence_class[i].append(current_lines[i])
-                try:
-                    current_lines[i] = next(generators[i])
-                    new_interval = functors[i](current_lines[i])
-                except StopIteration:
-                    current_lines[i] = None
-                    equivalence_class_indexes.remove(i)
-                    num_gen_curr_eq_class -= 1
+def _take_equivalence_class(generator, func, current_lines, i, min_interval, heap):
+    """
+    collects the current object of generator i and its following objects that are not greater than min_interval,
+    the first greater object becomes the current object of the generator and its key is pushed to the heap
+    :return: list of the collected objects
+    """
+    objects = [current_lines[i]]
+    for line in generator:
+        new_interval = func(line)
+        if new_interval > min_interval:
+            current_lines[i] = line
+            heapq.heappush(heap, (new_interval, i))
+            return objects
+        objects.append(line)
+    current_lines[i] = None
+    return objects
+
+
+def _parallel_generator_two(generators, functors, index_tuples):
+    """
+    parallel_generator of two generators, compares the two current keys directly instead of using a heap
+    """
+    gen_a, gen_b = generators
+    func_a, func_b = functors
+    line_a = next(gen_a, None)
+    line_b = next(gen_b, None)
+    key_a = func_a(line_a) if line_a is not None else None
+    key_b = func_b(line_b) if line_b is not None else None
+
+    while line_a is not None or line_b is not None:
+        if line_b is None or (line_a is not None and key_a < key_b):
+            take_a, take_b, min_interval = True, False, key_a
+        elif line_a is None or key_b < key_a:
+            take_a, take_b, min_interval = False, True, key_b
+        else:
+            take_a, take_b, min_interval = True, True, key_a
+
+        objects_a = objects_b = None
+        if take_a:
+            objects_a = [line_a]
+            line_a = None
+            for line in gen_a:
+                key_a = func_a(line)
+                if key_a > min_interval:
+                    line_a = line
                     break
-
-                if(new_interval > min_interval):
-                    equivalence_class_indexes.remove(i)
-                    num_gen_curr_eq_class -= 1
+                objects_a.append(line)
+        if take_b:
+            objects_b = [line_b]
+            line_b = None
+            for line in gen_b:
+                key_b = func_b(line)
+                if key_b > min_interval:
+                    line_b = line
                     break
+                objects_b.append(line)
 
-        yield next_equivalence_class  # Yield the equivlanece class
-
-        # Setting up lists for next iteration
-        # For each generator that generated an outputted line, get his next
-        # line
-        for i in equivalence_class_indexes:
-            try:
-                current_lines[i] = next(generators[i])
-            except StopIteration:
-                current_lines[i] = None
-
-        # Check if any generator finished yielding eveyrthing
-        for index in range(len(current_lines)):
-            if current_lines[index] == None:  # Meaning no more output
-                if listOfFinished[index] == 0:  # If not already finished
-                    finished_files += 1
-                    listOfFinished[index] = 1
-
-    return  # When all generators finished
+        if index_tuples:
+            yield tuple(pair for pair in ((0, objects_a), (1, objects_b)) if pair[1] is not None)
+        else:
+            yield [objects_a, objects_b]
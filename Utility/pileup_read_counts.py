@@ -0,0 +1,227 @@
+"""
+Single pass tokenizer of mpileup reads strings.
+
+A reads string is scanned once and turned into a vector of counts, the columns of the vector are:
+
+    SENSE_A..SENSE_N            upper case A,C,G,T,N (mismatch on the forward strand)
+    ANTISENSE_A..ANTISENSE_N    lower case a,c,g,t,n (mismatch on the reverse strand)
+    MATCH_SENSE, MATCH_ANTISENSE    '.' and ','
+    DELETED                     '*' or '#' (a deleted base of a previous read deletion)
+    OTHER_SENSE, OTHER_ANTISENSE    other IUPAC letters
+    INSERTIONS, DELETIONS       +N<seq> / -N<seq> indels (the indel sequence itself is skipped)
+    READ_STARTS, READ_ENDS      '^' (together with the mapping quality char after it) and '$'
+
+The kernel is compiled with numba when it is available, otherwise the same code runs as plain python.
+"""
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+SENSE_A, SENSE_C, SENSE_G, SENSE_T, SENSE_N = range(0, 5)
+ANTISENSE_A, ANTISENSE_C, ANTISENSE_G, ANTISENSE_T, ANTISENSE_N = range(5, 10)
+MATCH_SENSE = 10
+MATCH_ANTISENSE = 11
+DELETED = 12
+OTHER_SENSE = 13
+OTHER_ANTISENSE = 14
+INSERTIONS = 15
+DELETIONS = 16
+READ_STARTS = 17
+READ_ENDS = 18
+NUMBER_OF_COLUMNS = 19
+
+NUCLEOTIDES = "ACGTN"
+
+
+def _make_column_table():
+    """
+    :return: list of 256 entries mapping an ascii code of a reads string char to its count column (-1 to ignore)
+    """
+    table = [-1] * 256
+    for index, nucl in enumerate(NUCLEOTIDES):
+        table[ord(nucl)] = SENSE_A + index
+        table[ord(nucl.lower())] = ANTISENSE_A + index
+    for nucl in "RYSWKMBDHV":
+        table[ord(nucl)] = OTHER_SENSE
+        table[ord(nucl.lower())] = OTHER_ANTISENSE
+    table[ord('.')] = MATCH_SENSE
+    table[ord(',')] = MATCH_ANTISENSE
+    table[ord('*')] = DELETED
+    table[ord('#')] = DELETED
+    table[ord('$')] = READ_ENDS
+    return table
+
+
+_column_table_list = _make_column_table()
+_column_table_array = np.array(_column_table_list, dtype=np.int8)
+
+
+def _count_kernel(buffer, offsets, column_table, counts):
+    """
+    :param buffer: the reads strings concatenated (bytes or uint8 array)
+    :param offsets: offsets of each reads string in the buffer, of length number of strings + 1
+    :param column_table: 256 entries table from ascii code to column (see _make_column_table)
+    :param counts: output, indexable as counts[site][column], zeroed by the caller
+    """
+    for site in range(len(offsets) - 1):
+        row = counts[site]
+        i = offsets[site]
+        end = offsets[site + 1]
+        while i < end:
+            char = buffer[i]
+            if char == 94:  # '^' followed by the mapping quality of the read
+                row[READ_STARTS] += 1
+                i += 2
+            elif char == 43 or char == 45:  # '+' or '-' followed by the length and the sequence of the indel
+                j = i + 1
+                length = 0
+                while j < end and 48 <= buffer[j] <= 57:
+                    length = length * 10 + buffer[j] - 48
+                    j += 1
+                if char == 43:
+                    row[INSERTIONS] += 1
+                else:
+                    row[DELETIONS] += 1
+                i = j + length
+            else:
+                column = column_table[char]
+                if column >= 0:
+                    row[column] += 1
+                i += 1
+
+
+if njit is not None:
+    _compiled_count_kernel = njit(cache=True, nogil=True)(_count_kernel)
+else:
+    _compiled_count_kernel = None
+
+
+def count_reads_strings(buffer, offsets):
+    """
+    :param buffer: bytes of the reads strings concatenated
+    :param offsets: int64 array of the offsets of each reads string in buffer (length number of strings + 1)
+    :return: int32 array of shape (number of strings, NUMBER_OF_COLUMNS)
+    """
+    number_of_strings = len(offsets) - 1
+    if _compiled_count_kernel is not None:
+        counts = np.zeros((number_of_strings, NUMBER_OF_COLUMNS), dtype=np.int32)
+        _compiled_count_kernel(np.frombuffer(buffer, dtype=np.uint8), np.asarray(offsets, dtype=np.int64),
+                               _column_table_array, counts)
+        return counts
+
+    counts = [[0] * NUMBER_OF_COLUMNS for _ in range(number_of_strings)]
+    _count_kernel(bytes(buffer), [int(offset) for offset in offsets], _column_table_list, counts)
+    return np.array(counts, dtype=np.int32).reshape(number_of_strings, NUMBER_OF_COLUMNS)
+
+
+def count_reads_string(reads_string):
+    """
+    :param reads_string: a single mpileup reads string
+    :return: int32 array of length NUMBER_OF_COLUMNS
+    """
+    buffer = reads_string.encode('ascii')
+    return count_reads_strings(buffer, np.array([0, len(buffer)], dtype=np.int64))[0]
+
+
+def nucleotide_counts(read_counts, reference):
+    """
+    folds the strands and the reference matches into per nucleotide counts
+    :param read_counts: array of shape (n, NUMBER_OF_COLUMNS)
+    :param reference: uint8 array of length n of the reference bases ascii codes
+    :return: int32 array of shape (n,5) of the observed A,C,G,T,N bases ('.' and ',' counted as the reference base)
+    """
+    counts = read_counts[:, SENSE_A:SENSE_N + 1] + read_counts[:, ANTISENSE_A:ANTISENSE_N + 1]
+    reference_column = np.full(len(reference), 4, dtype=np.int64)
+    upper_reference = np.asarray(reference, dtype=np.uint8) & 0xDF  # ascii upper case
+    for index, nucl in enumerate(NUCLEOTIDES[:4]):
+        reference_column[upper_reference == ord(nucl)] = index
+    counts[np.arange(len(reference)), reference_column] += \
+        read_counts[:, MATCH_SENSE] + read_counts[:, MATCH_ANTISENSE]
+    return counts
+
+
+def mismatch_counts(read_counts):
+    """
+    :param read_counts: array of shape (..., NUMBER_OF_COLUMNS)
+    :return: array of shape (..., 4) of the A,C,G,T mismatches of both strands
+    """
+    return read_counts[..., SENSE_A:SENSE_T + 1] + read_counts[..., ANTISENSE_A:ANTISENSE_T + 1]
+
+
+def candidate_nucleotide(read_counts, case_sensitive=True):
+    """
+    :param read_counts: count vector of a single reads string
+    :param case_sensitive: if True, sense and antisense mismatches are separate candidates and the result is upper
+    case for sense and lower case for antisense. Otherwise the strands are summed and the result is upper case
+    :return: the most frequent mismatch nucleotide, ties are broken by the order A,C,G,T(,a,c,g,t)
+    """
+    if case_sensitive:
+        candidates = np.concatenate((read_counts[SENSE_A:SENSE_T + 1], read_counts[ANTISENSE_A:ANTISENSE_T + 1]))
+        return "ACGTacgt"[int(np.argmax(candidates))]
+    return "ACGT"[int(np.argmax(mismatch_counts(read_counts)))]
+
+
+def editing_stats(read_counts, base_count):
+    """
+    calculates the candidate editing nucleotide of a site and its editing and noise percents
+    :param read_counts: count vector of a single reads string
+    :param base_count: the number of reads of the site
+    :return: (candidate_nucl, candidate_nucl_reads, editing_percent, noise_percent)
+    """
+    mismatches = mismatch_counts(read_counts)
+    candidate_index = int(np.argmax(mismatches))
+    candidate_nucl_reads = int(mismatches[candidate_index])
+    if candidate_nucl_reads == 0 or base_count == 0:
+        return "ACGT"[candidate_index], candidate_nucl_reads, 0.0, 0.0
+    noise_reads = int(mismatches.sum()) - candidate_nucl_reads
+    editing_percent = round(float(100 * (candidate_nucl_reads / base_count)), 3)
+    noise_percent = round(float(100 * (noise_reads / base_count)), 3)
+    return "ACGT"[candidate_index], candidate_nucl_reads, editing_percent, noise_percent
+
+
+def clean_reads_string(reads_string):
+    """
+    :param reads_string: mpileup reads string
+    :return: the reads string without the ^ marks (and their mapping quality), $ marks and indels
+    """
+    clean = []
+    i = 0
+    end = len(reads_string)
+    while i < end:
+        char = reads_string[i]
+        if char == '^':
+            i += 2
+        elif char == '+' or char == '-':
+            j = i + 1
+            while j < end and reads_string[j].isdigit():
+                j += 1
+            i = j + int(reads_string[i + 1:j] or 0)
+        elif char == '$':
+            i += 1
+        else:
+            clean.append(char)
+            i += 1
+    return ''.join(clean)
+
+
+def editing_stats_columns(read_counts, base_count):
+    """
+    vectorized version of editing_stats for many sites
+    :param read_counts: array of shape (n, NUMBER_OF_COLUMNS)
+    :param base_count: array of length n of the number of reads of each site
+    :return: (candidate_index, candidate_nucl_reads, editing_percent, noise_percent) arrays of length n, where
+    candidate_index is the index of the candidate nucleotide in "ACGT"
+    """
+    mismatches = mismatch_counts(read_counts)
+    candidate_index = np.argmax(mismatches, axis=1)
+    candidate_nucl_reads = mismatches[np.arange(len(mismatches)), candidate_index]
+    noise_reads = mismatches.sum(axis=1) - candidate_nucl_reads
+    base_count = np.asarray(base_count, dtype=np.float64)
+    valid = (candidate_nucl_reads > 0) & (base_count > 0)
+    safe_count = np.where(valid, base_count, 1)
+    editing_percent = np.where(valid, np.round(100 * candidate_nucl_reads / safe_count, 3), 0.0)
+    noise_percent = np.where(valid, np.round(100 * noise_reads / safe_count, 3), 0.0)
+    return candidate_index, candidate_nucl_reads, editing_percent, noise_percent
@@ -0,0 +1,252 @@
+"""
+Per chromosome sorted position index
+
+A set of genome positions stored as a directory of .npy files, one sorted uint32 array of unique positions per
+chromosome, and an index.json that maps the chromosome names to their files. The arrays are loaded as memory maps, so
+processes that filter with the same index share its pages, and membership of many positions is a vectorized binary
+search (np.searchsorted).
+
+index layout:
+    <index_dir>/index.json       {"version": ..., "chromosomes": {name: file name}, "sizes": {name: count}, "meta": ...,
+                                  "normalize_chromosomes": ...}
+    <index_dir>/chr_<i>.npy      the sorted positions of the i-th chromosome
+
+index_dir is a symbolic link to a version directory next to it (.<index name>.<id>.version), a rebuilt index is
+written to a new version directory and the link is swapped atomically, so a reader (that resolved the link when it
+opened the index) keeps reading the files of its version.
+
+an index written with normalize_chromosomes holds normalized chromosome names (see normalize_chromosome), and the
+chromosome names of its lookups are normalized too, so "1", "chr1" and "CHR1" are the same chromosome.
+
+example:
+    builder = PositionIndexBuilder()
+    builder.add("chr1", 12345)
+    builder.write(index_dir)
+    index = PositionIndex(index_dir)
+    index.contains("chr1", np.array([12345, 12346]))  # array([ True, False])
+"""
+import contextlib
+import fcntl
+import json
+import os
+import shutil
+import threading
+import uuid
+from array import array
+import numpy as np
+
+INDEX_NAME = "index.json"
+INDEX_VERSION = 1
+POSITION_DTYPE = np.uint32
+VERSION_SUFFIX = ".version"
+LOCK_SUFFIX = ".lock"
+
+# the index locks held by the thread, so a thread that holds the lock of an index can write it
+_held_locks = threading.local()
+
+
+def normalize_chromosome(name):
+    """
+    :return: the UCSC style name of a chromosome: with a chr prefix, and chrM for the mitochondrial chromosome
+    ("1" -> "chr1", "MT" -> "chrM")
+    """
+    base = name[3:] if name[:3].lower() == "chr" else name
+    if base.upper() in ("M", "MT"):
+        base = "M"
+    return "chr" + base
+
+
+def is_position_index(index_dir):
+    """
+    :return: True if index_dir holds a complete position index
+    """
+    return os.path.isfile(os.path.join(index_dir, INDEX_NAME))
+
+
+@contextlib.contextmanager
+def index_lock(index_dir):
+    """
+    exclusive lock of the index (between processes and between threads), held while it is built so an index is built
+    once, e.g.:
+        with index_lock(index_dir):
+            if not is_position_index(index_dir):
+                builder.write(index_dir)
+    """
+    lock_filename = os.path.abspath(index_dir) + LOCK_SUFFIX
+    held = getattr(_held_locks, "filenames", None)
+    if held is None:
+        held = _held_locks.filenames = set()
+    if lock_filename in held:
+        yield
+        return
+    os.makedirs(os.path.dirname(lock_filename), exist_ok=True)
+    with open(lock_filename, "a") as fp:
+        fcntl.flock(fp, fcntl.LOCK_EX)
+        held.add(lock_filename)
+        try:
+            yield
+        finally:
+            held.discard(lock_filename)
+            fcntl.flock(fp, fcntl.LOCK_UN)
+
+
+def _remove_old_versions(index_dir, keep):
+    """
+    removes the version directories of the index other than the ones in keep (the current and the previous version,
+    which readers that opened the index before it was rebuilt may still read)
+    """
+    parent = os.path.dirname(os.path.abspath(index_dir))
+    prefix = ".%s." % os.path.basename(os.path.abspath(index_dir))
+    for name in os.listdir(parent):
+        if name.startswith(prefix) and name.endswith(VERSION_SUFFIX) and name not in keep:
+            shutil.rmtree(os.path.join(parent, name), ignore_errors=True)
+
+
+class PositionIndexBuilder:
+    """
+    collects positions per chromosome and writes them as a position index
+    """
+
+    def __init__(self):
+        self.positions = dict()
+
+    def add(self, chromosome, position):
+        positions = self.positions.get(chromosome)
+        if positions is None:
+            positions = self.positions[chromosome] = array('I')
+        positions.append(position)
+
+    def add_many(self, chromosome, positions):
+        """
+        :param positions: iterable (or numpy array) of positions of the chromosome
+        """
+        chromosome_positions = self.positions.get(chromosome)
+        if chromosome_positions is None:
+            chromosome_positions = self.positions[chromosome] = array('I')
+        chromosome_positions.extend(np.asarray(positions, dtype=POSITION_DTYPE).tolist())
+
+    def write(self, index_dir, meta=None, normalize_chromosomes=False, chromosome_writer=None):
+        """
+        writes the index to a new version directory and points index_dir to it by an atomic swap of the link, so a
+        reader never sees a partial index (an existing index_dir is replaced), the writers of an index are serialized
+        by index_lock
+        :param meta: optional json serializable description of the index
+        :param normalize_chromosomes: True if the chromosome names were normalized (by normalize_chromosome), the
+        lookups of the index are then normalized too
+        :param chromosome_writer: optional function that writes additional files of a chromosome, called as
+        chromosome_writer(directory, file_prefix, chromosome, unique_positions)
+        :return: index_dir
+        """
+        index_path = os.path.abspath(index_dir)
+        parent = os.path.dirname(index_path)
+        os.makedirs(parent, exist_ok=True)
+        unique = uuid.uuid4().hex
+        version_name = ".%s.%s%s" % (os.path.basename(index_path), unique, VERSION_SUFFIX)
+        version_dir = os.path.join(parent, version_name)
+        temp_link = os.path.join(parent, ".%s.%s.link" % (os.path.basename(index_path), unique))
+        with index_lock(index_dir):
+            os.makedirs(version_dir)
+            try:
+                chromosomes = dict()
+                sizes = dict()
+                for i, (chromosome, positions) in enumerate(sorted(self.positions.items())):
+                    file_name = "chr_%d.npy" % i
+                    unique_positions = np.unique(np.frombuffer(positions, dtype=POSITION_DTYPE))
+                    np.save(os.path.join(version_dir, file_name), unique_positions)
+                    if chromosome_writer is not None:
+                        chromosome_writer(version_dir, "chr_%d" % i, chromosome, unique_positions)
+                    chromosomes[chromosome] = file_name
+                    sizes[chromosome] = int(len(unique_positions))
+                with open(os.path.join(version_dir, INDEX_NAME), "w") as fp:
+                    json.dump({"version": INDEX_VERSION, "chromosomes": chromosomes, "sizes": sizes, "meta": meta,
+                               "normalize_chromosomes": normalize_chromosomes}, fp, indent=1)
+
+                previous_version = os.readlink(index_path) if os.path.islink(index_path) else None
+                if os.path.isdir(index_path) and not os.path.islink(index_path):
+                    # an index written as a plain directory can't be swapped atomically, it is moved aside first
+                    previous_version = ".%s.%s.old%s" % (os.path.basename(index_path), unique, VERSION_SUFFIX)
+                    os.replace(index_path, os.path.join(parent, previous_version))
+                os.symlink(version_name, temp_link)
+                os.replace(temp_link, index_path)
+            except BaseException:
+                for path in (temp_link, version_dir):
+                    if os.path.islink(path):
+                        os.remove(path)
+                    elif os.path.isdir(path):
+                        shutil.rmtree(path)
+                raise
+            _remove_old_versions(index_dir, {version_name, previous_version})
+        return index_dir
+
+
+class PositionIndex:
+    """
+    memory mapped position index written by PositionIndexBuilder
+    """
+
+    def __init__(self, index_dir, mmap=True):
+        self.index_dir = index_dir
+        # the files are read from the version the index had when it was opened, even if it is rebuilt meanwhile
+        self.version_dir = os.path.realpath(index_dir)
+        with open(os.path.join(self.version_dir, INDEX_NAME), "r") as fp:
+            description = json.load(fp)
+        self.meta = description.get("meta")
+        self.sizes = description["sizes"]
+        self._files = description["chromosomes"]
+        self.normalize_chromosomes = description.get("normalize_chromosomes", False)
+        self._mmap_mode = 'r' if mmap else None
+        self._positions = dict()
+
+    @property
+    def chromosomes(self):
+        return list(self._files.keys())
+
+    def __len__(self):
+        return sum(self.sizes.values())
+
+    def positions(self, chromosome):
+        """
+        :return: the sorted positions of the chromosome (an empty array if it has none)
+        """
+        positions = self._positions.get(chromosome)
+        if positions is None:
+            file_name = self._files.get(normalize_chromosome(chromosome) if self.normalize_chromosomes else chromosome)
+            if file_name is None:
+                positions = np.empty(0, dtype=POSITION_DTYPE)
+            else:
+                positions = np.load(os.path.join(self.version_dir, file_name), mmap_mode=self._mmap_mode)
+            self._positions[chromosome] = positions
+        return positions
+
+    def chromosome_file(self, chromosome):
+        """
+        :return: the path of the .npy file of the chromosome without its suffix (for the additional files of the
+        chromosome), None if the index has no positions of the chromosome
+        """
+        if self.normalize_chromosomes:
+            chromosome = normalize_chromosome(chromosome)
+        file_name = self._files.get(chromosome)
+        return None if file_name is None else os.path.join(self.version_dir, file_name[:-len(".npy")])
+
+    def contains(self, chromosome, positions):
+        """
+        :param positions: array of positions of the chromosome
+        :return: boolean array, True for the positions in the index
+        """
+        positions = np.asarray(positions, dtype=np.int64)
+        chromosome_positions = self.positions(chromosome)
+        if len(chromosome_positions) == 0 or len(positions) == 0:
+            return np.zeros(len(positions), dtype=bool)
+        places = np.searchsorted(chromosome_positions, positions)
+        found = places < len(chromosome_positions)
+        found[found] = chromosome_positions[places[found]] == positions[found]
+        return found
+
+    def __contains__(self, site):
+        """
+        :param site: (chromosome, position)
+        """
+        chromosome, position = site
+        chromosome_positions = self.positions(chromosome)
+        place = int(np.searchsorted(chromosome_positions, position))
+        return place < len(chromosome_positions) and int(chromosome_positions[place]) == int(position)
@@ -1,6 +1,8 @@
 
 from contextlib import contextmanager
 import multiprocessing
+import threading
+from Utility.dag_scheduler import validate_dag
 
 from typing import Dict
 from typing import List
@@ -13,42 +15,26 @@ Dict_specifications = Dict[Specifications, Fathers_list]
 
 """ this class handles the waiting of the child vertexes to thier fathers, 
 handles the dict of filenames that contains the "output" file of each step for it's children ,
-and in general handles the tree structure by the given Dict_specifications """
+and in general handles the tree structure by the given Dict_specifications.
+the vertexes run as threads of one process (see Utility.dag_scheduler), so the state is kept in process,
+the pre, align and post work of a vertex runs in a child process and returns its output file name """
 class ThreadingTree:
 
     def __init__(self, dict_spec: Dict_specifications):
         self.dict_tree = copy.deepcopy(dict_spec)
 
-        if not self.is_not_circular_dependency(dict_spec):
-            raise ValueError("The dictionary of specification must have a step without prior dependencies")
+        # raises DagError (a ValueError) if a father is not a step of the tree or the steps have a cycle
+        validate_dag({spec.id: fathers for spec, fathers in dict_spec.items()})
 
         # filling dict of events for each vertex of "tree"
-        self.events_by_id_dict = {spec.id: multiprocessing.Event() for spec in dict_spec.keys()}
-        self.filenames_dict = multiprocessing.Manager().dict({spec.id: None for spec in dict_spec.keys()})
-        self.filenames_dict_lock = multiprocessing.Lock()
+        self.events_by_id_dict = {spec.id: threading.Event() for spec in dict_spec.keys()}
+        self.filenames_dict = {spec.id: None for spec in dict_spec.keys()}
+        self.filenames_dict_lock = threading.Lock()
+        # the alignment of a vertex runs in a child process (see include_exclude_alignment.pre_align_post), so the
+        # index building locks are shared with it
         self.fasta_indexing_lock = multiprocessing.Lock()
         self.secondary_fasta_indexing_lock = multiprocessing.Lock()
 
-    def is_not_circular_dependency(self, dict_spec: Dict_specifications):
-        """
-
-        :param dict_spec:
-        :return: True if there is a head to start the threading from
-        """
-        hist_dict = dict()
-        for tuple in dict_spec.keys():
-
-            id = tuple[0]
-            if id not in hist_dict:
-                hist_dict[id] = 1
-            else:
-                hist_dict[id] = hist_dict[id] + 1
-        for id, number in hist_dict.items():
-            if number == 1:
-                return True
-
-        return False
-
     @contextmanager
     def threading_context(self, id_step):
         """
@@ -0,0 +1,123 @@
+"""
+Compiled position index of a vcf snp database (e.g. dbSNP)
+
+The vcf is parsed once into a position index (see Utility.position_index): the header lines are skipped and the
+chromosome names are normalized ("1", "chr1" and "MT"/"chrM" of the vcf match the "chr1" and "chrM" of the
+pileups). The index is cached next to the vcf (<vcf>.pidx) while the size and modification time of the vcf don't
+change, and it is memory mapped, so every filter process of a run shares one copy of it.
+
+The positions are kept as uint32 .npy arrays (4 bytes a site instead of a text line), which are read as memory maps
+as they are, and can be shared between processes, unlike a gzip compressed index.
+With with_alleles the REF>ALT of every indexed position is stored too:
+    <index_dir>/chr_<i>.alleles.npy    offsets (uint64, one more than the positions) of the alleles of the positions
+    <index_dir>/chr_<i>.alleles.bin    the "REF>ALT" strings of the positions (comma separated for repeated positions)
+
+example:
+    index = vcf_position_index("dbsnp.vcf.gz")
+    index.contains("chr1", np.array([10177, 10178]))  # array([ True, False])
+"""
+import gzip
+import os
+import numpy as np
+from Utility.position_index import PositionIndex, PositionIndexBuilder, is_position_index, normalize_chromosome, \
+    index_lock
+
+INDEX_SUFFIX = ".pidx"
+ALLELE_OFFSETS_SUFFIX = ".alleles.npy"
+ALLELES_SUFFIX = ".alleles.bin"
+
+
+def _vcf_stat(vcf_file):
+    stat = os.stat(vcf_file)
+    return {"vcf": os.path.abspath(vcf_file), "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+
+
+def _open_vcf(vcf_file):
+    return gzip.open(vcf_file, "rt") if vcf_file.endswith(".gz") else open(vcf_file, "r")
+
+
+def compile_vcf_index(vcf_file, index_dir, with_alleles=False):
+    """
+    compiles a vcf (plain or gzip compressed, with or without a header) into a position index with normalized
+    chromosome names
+    :param with_alleles: also store the REF>ALT of the positions (see vcf_alleles)
+    :return: index_dir
+    """
+    builder = PositionIndexBuilder()
+    alleles = dict()
+    with _open_vcf(vcf_file) as vcf:
+        for line in vcf:
+            if line.startswith("#"):
+                continue
+            fields = line.rstrip("\r\n").split("\t", 5)
+            if len(fields) < 2:
+                continue
+            chromosome = normalize_chromosome(fields[0])
+            position = int(fields[1])
+            builder.add(chromosome, position)
+            if with_alleles:
+                alleles.setdefault(chromosome, []).append((position, "%s>%s" % (fields[3], fields[4])))
+
+    def write_alleles(directory, file_prefix, chromosome, unique_positions):
+        grouped = dict()
+        for position, allele in alleles.get(chromosome, ()):
+            grouped.setdefault(position, []).append(allele)
+        encoded = [",".join(grouped[position]).encode() for position in unique_positions.tolist()]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        np.cumsum([len(allele) for allele in encoded], out=offsets[1:])
+        np.save(os.path.join(directory, file_prefix + ALLELE_OFFSETS_SUFFIX), offsets)
+        with open(os.path.join(directory, file_prefix + ALLELES_SUFFIX), "wb") as fp:
+            fp.write(b"".join(encoded))
+
+    meta = dict(_vcf_stat(vcf_file), with_alleles=with_alleles)
+    return builder.write(index_dir, meta=meta, normalize_chromosomes=True,
+                         chromosome_writer=write_alleles if with_alleles else None)
+
+
+def is_vcf_index_valid(vcf_file, index_dir, with_alleles=False):
+    """
+    :return: True if index_dir holds an index compiled from the current vcf_file (with its alleles if with_alleles)
+    """
+    if not is_position_index(index_dir):
+        return False
+    meta = PositionIndex(index_dir).meta or dict()
+    current = _vcf_stat(vcf_file)
+    if any(meta.get(key) != value for key, value in current.items()):
+        return False
+    return meta.get("with_alleles", False) or not with_alleles
+
+
+def vcf_position_index(vcf_file, index_dir=None, with_alleles=False):
+    """
+    the position index of a vcf, compiled on first use and reused while the vcf doesn't change
+    :param index_dir: directory of the index (default: <vcf_file>.pidx)
+    :return: PositionIndex of the vcf
+    """
+    if index_dir is None:
+        index_dir = vcf_file + INDEX_SUFFIX
+    if not is_vcf_index_valid(vcf_file, index_dir, with_alleles):
+        # a stale index is compiled once, by the first of the concurrent callers
+        with index_lock(index_dir):
+            if not is_vcf_index_valid(vcf_file, index_dir, with_alleles):
+                compile_vcf_index(vcf_file, index_dir, with_alleles)
+    return PositionIndex(index_dir)
+
+
+def vcf_alleles(position_index, chromosome, position):
+    """
+    :param position_index: PositionIndex compiled with_alleles
+    :return: the "REF>ALT" of the position (comma separated if the vcf has several lines of it), or None if the
+    position is not in the index
+    """
+    prefix = position_index.chromosome_file(chromosome)
+    if prefix is None:
+        return None
+    positions = position_index.positions(chromosome)
+    place = int(np.searchsorted(positions, position))
+    if place == len(positions) or int(positions[place]) != int(position):
+        return None
+    offsets = np.load(prefix + ALLELE_OFFSETS_SUFFIX, mmap_mode='r')
+    start, end = int(offsets[place]), int(offsets[place + 1])
+    with open(prefix + ALLELES_SUFFIX, "rb") as fp:
+        fp.seek(start)
+        return fp.read(end - start).decode()